@@ -0,0 +1,646 @@
+"""ip_processor 的离线基准测试
+
+不访问外部网络：在回环地址上启动接受/拒绝/丢弃/慢响应四类假端点，
+在本地模拟Cloudflare DNS API，并生成 1千 ~ 1千万 行的合成 ips/*.csv / *.txt 文件。
+每个场景在独立子进程中运行以单独统计峰值内存，结果保存为JSON，便于比较不同版本：
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+"""
+import os
+import sys
+import argparse
+import asyncio
+import importlib.util
+import json
+import multiprocessing
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+import hashlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+SCENARIOS = ('ingest', 'probe', 'sync', 'pipeline')
+MODES = ('accept', 'refuse', 'blackhole', 'slow')
+CLOUDFLARE_API = 'https://api.cloudflare.com/client/v4'
+CSV_HEADER = "IP地址,端口,TLS,数据中心,源IP位置,地区,城市,地区(中文),国家,城市(中文),国旗,网络延迟,下载速度\n"
+
+class FakeEndpoints:
+    """只监听127.0.0.1的假端点，每类行为使用pool个临时端口，不占用固定端口也不对外暴露
+
+    accept: 立即接受连接，收到HTTP请求时返回200
+    refuse: 端口已绑定但未监听，连接立即被拒绝
+    blackhole: 监听队列已占满且从不accept，SYN被丢弃直到超时
+    slow: 接受连接，HTTP响应延迟slow_ms毫秒（port检测时与accept相同）
+    ports为 {类型: [端口]}，http检测时由子进程把accept/slow端口登记为明文HTTP端口。
+    """
+
+    RESPONSE = (b"HTTP/1.1 200 OK\r\nCF-RAY: 0000000000000000-HKG\r\n"
+                b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+
+    def __init__(self, slow_ms, pool=64):
+        self.slow_ms = slow_ms
+        self.loop = asyncio.new_event_loop()
+        self.sockets = []
+        self.ports = {mode: [] for mode in MODES}
+        servers = []
+        for _ in range(pool):
+            refuse = self.bind()
+            self.ports['refuse'].append(refuse.getsockname()[1])
+
+            blackhole = self.bind()
+            blackhole.listen(0)
+            self.ports['blackhole'].append(blackhole.getsockname()[1])
+            # 占满监听队列，之后的SYN全部被丢弃
+            self.sockets.append(socket.create_connection(('127.0.0.1', self.ports['blackhole'][-1])))
+
+            for mode, delay in (('accept', 0), ('slow', slow_ms / 1000)):
+                sock = self.bind()
+                self.ports[mode].append(sock.getsockname()[1])
+                servers.append((sock, delay))
+
+        async def start():
+            for sock, delay in servers:
+                await asyncio.start_server(self.handler(delay), sock=sock, backlog=4096)
+
+        self.loop.run_until_complete(start())
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def bind(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        self.sockets.append(sock)
+        return sock
+
+    def handler(self, delay):
+        async def handle(reader, writer):
+            try:
+                await reader.readuntil(b'\r\n\r\n')
+                if delay:
+                    await asyncio.sleep(delay)
+                writer.write(self.RESPONSE)
+                await writer.drain()
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                # port检测只建立连接，随即关闭
+                pass
+            finally:
+                writer.close()
+        return handle
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+        for sock in self.sockets:
+            sock.close()
+
+def parse_mix(text):
+    """解析 accept=0.3,refuse=0.2,... 为归一化的比例"""
+    mix = dict.fromkeys(MODES, 0.0)
+    for part in text.split(','):
+        mode, _, weight = part.partition('=')
+        mode = mode.strip()
+        if mode not in mix:
+            raise argparse.ArgumentTypeError(f"未知的端点类型: {mode}")
+        mix[mode] = float(weight)
+    total = sum(mix.values())
+    if total <= 0:
+        raise argparse.ArgumentTypeError("端点比例之和必须大于0")
+    return {mode: weight / total for mode, weight in mix.items()}
+
+def endpoints(count, mix, ports, seed):
+    """按比例生成 (IP, 端口, 类型)，IP均为127.0.0.1，每类在端口池中轮流取端口；
+    数量超过端口池大小时端点会重复，检测时按端点去重"""
+    rng = random.Random(seed)
+    modes = list(mix)
+    weights = [mix[mode] for mode in modes]
+    used = dict.fromkeys(modes, 0)
+    for _ in range(count):
+        mode = rng.choices(modes, weights)[0]
+        pool = ports[mode]
+        yield '127.0.0.1', pool[used[mode] % len(pool)], mode
+        used[mode] += 1
+
+def write_csv(path, rows, region='HK'):
+    """写入与ips/HK.csv相同列格式的CSV，region为标签所在的"源IP位置"列"""
+    rng = random.Random(str(path))
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write(CSV_HEADER)
+        batch = []
+        for ip, port, _ in rows:
+            batch.append(f"{ip},{port},true,HKG,{region},Asia Pacific,Hong Kong,亚洲,香港,香港,🇭🇰,"
+                         f"{rng.randrange(20, 300)} ms,{rng.randrange(1000, 60000)} kB/s\n")
+            if len(batch) >= 10000:
+                f.writelines(batch)
+                batch.clear()
+        f.writelines(batch)
+
+def write_txt(path, rows):
+    """txt文件只有IP，检测时使用CHECK_PORT，因此只用于ingest场景"""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.writelines(f"{ip}\n" for ip, _, _ in rows)
+
+class MockCloudflare:
+    """本地Cloudflare DNS API：支持列表（分页、名称过滤）、增删改、批量接口，
+    GET /__stats 返回并清零各方法的调用次数；fail_batches中的批量请求序号（从1开始）返回400"""
+
+    def __init__(self):
+        self.records = {}
+        self.calls = {}
+        self.batch_calls = 0
+        self.fail_batches = set()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.api_base = f"http://127.0.0.1:{self.server.server_address[1]}/client/v4"
+
+    def create(self, data):
+        record = {'id': uuid.uuid4().hex, 'name': data['name'], 'type': data['type'],
+                  'content': data['content'], 'ttl': data.get('ttl', 1), 'proxied': data.get('proxied', False)}
+        self.records[record['id']] = record
+        return record
+
+    def handle(self, method, path, query, data):
+        """返回 (状态码, 响应对象)"""
+        if path == '/__stats':
+            stats, self.calls = self.calls, {}
+            return 200, stats
+        self.calls[method] = self.calls.get(method, 0) + 1
+        parts = path.rstrip('/').split('/')
+        if 'dns_records' not in parts:
+            return 404, {'success': False, 'errors': [{'code': 7003, 'message': 'not found'}]}
+        target = parts[parts.index('dns_records') + 1:] or [None]
+        target = target[0]
+
+        if target is None and method == 'GET':
+            records = sorted(self.records.values(), key=lambda record: record['id'])
+            for key, test in (('name', str.__eq__), ('type', str.__eq__), ('name.endswith', str.endswith)):
+                if key in query:
+                    field = 'name' if key.startswith('name') else key
+                    records = [record for record in records if test(record[field], query[key][0])]
+            per_page = int(query.get('per_page', ['100'])[0])
+            page = int(query.get('page', ['1'])[0])
+            chunk = records[(page - 1) * per_page:page * per_page]
+            info = {'page': page, 'per_page': per_page, 'count': len(chunk), 'total_count': len(records),
+                    'total_pages': max(1, -(-len(records) // per_page))}
+            return 200, {'success': True, 'result': chunk, 'result_info': info}
+        if target is None and method == 'POST':
+            return 200, {'success': True, 'result': self.create(data)}
+        if target == 'batch' and method == 'POST':
+            self.batch_calls += 1
+            if self.batch_calls in self.fail_batches:
+                return 400, {'success': False, 'errors': [{'code': 1004, 'message': 'injected failure'}]}
+            result = {'deletes': [], 'patches': [], 'puts': [], 'posts': []}
+            for kind in ('deletes', 'patches', 'puts'):
+                for item in data.get(kind) or []:
+                    if item['id'] not in self.records:
+                        return 400, {'success': False, 'errors': [{'code': 81044, 'message': 'record not found'}]}
+            for item in data.get('deletes') or []:
+                result['deletes'].append(self.records.pop(item['id']))
+            for kind in ('patches', 'puts'):
+                for item in data.get(kind) or []:
+                    record = self.records[item['id']]
+                    record.update({k: v for k, v in item.items() if k != 'id'})
+                    result[kind].append(record)
+            for item in data.get('posts') or []:
+                result['posts'].append(self.create(item))
+            return 200, {'success': True, 'result': result}
+
+        record = self.records.get(target)
+        if record is None:
+            return 404, {'success': False, 'errors': [{'code': 81044, 'message': 'record not found'}]}
+        if method == 'DELETE':
+            del self.records[target]
+            return 200, {'success': True, 'result': {'id': target}}
+        if method in ('PUT', 'PATCH'):
+            record.update(data)
+            return 200, {'success': True, 'result': record}
+        return 405, {'success': False, 'errors': [{'code': 10000, 'message': 'method not allowed'}]}
+
+    def handler_class(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def dispatch(self):
+                url = urlsplit(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                data = json.loads(self.rfile.read(length)) if length else None
+                with mock.lock:
+                    status, body = mock.handle(self.command, url.path, parse_qs(url.query), data)
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = dispatch
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def fetch_stats(api_base):
+    """读取并清零模拟API的调用计数"""
+    import requests
+    base = api_base.split('/client/')[0]
+    return requests.get(f"{base}/__stats", timeout=10).json()
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, max(0, int(len(ordered) * pct / 100 + 0.5) - 1))], 3)
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux单位为KB，macOS为字节
+    return round(peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+
+def load_module(path):
+    spec = importlib.util.spec_from_file_location('ip_processor', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['ip_processor'] = module
+    spec.loader.exec_module(module)
+    return module
+
+def base_config(ipp, params):
+    config = ipp.load_config()
+    check = config['IP_CHECK']
+    check['CHECK_METHOD'] = params['method']
+    check['CHECK_ENGINE'] = params['engine']
+    check['CHECK_TIMEOUT'] = str(params['timeout'])
+    if config.has_section('CACHE'):
+        config['CACHE']['ENABLE'] = 'false'
+    cloudflare = config['cloudflare']
+    cloudflare['enable'] = 'true'
+    cloudflare['api_base'] = params['api_base']
+    cloudflare['api_token'] = cloudflare['zone_id'] = 'bench'
+    cloudflare['domain'] = 'bench.test'
+    # 不受真实API速率限制，只统计请求次数
+    cloudflare['api_rate'] = '0'
+    if params['method'] == 'http' and hasattr(ipp, 'CF_HTTP_PORTS'):
+        # 假端点使用临时端口，登记为明文HTTP端口后http检测不走TLS
+        ipp.CF_HTTP_PORTS.update(params['ports']['accept'] + params['ports']['slow'])
+    for key, value in params.get('overrides', {}).items():
+        section, _, option = key.partition('.')
+        config[section][option] = value
+    return config
+
+def bench_ingest(ipp, params):
+    """逐行读取合成CSV/TXT，统计每秒行数"""
+    results = {}
+    for path in params['files']:
+        # 旧版本没有流式读取接口时使用extract_*
+        if path.endswith('.csv'):
+            reader = getattr(ipp, 'iter_ips_from_csv', None) or ipp.extract_ips_from_csv
+        else:
+            reader = getattr(ipp, 'iter_ips_from_txt', None) or ipp.extract_ips_from_txt
+        start = time.perf_counter()
+        rows = sum(1 for _ in reader(path, Path(path).stem))
+        elapsed = time.perf_counter() - start
+        results[Path(path).name] = {'rows': rows, 'seconds': round(elapsed, 3),
+                                    'rows_per_sec': round(rows / elapsed) if elapsed else None}
+    return results
+
+def bench_probe(ipp, params):
+    """直接驱动probe_stream，统计每秒检测数、单个检测从发出到返回的延迟和误判数"""
+    config = base_config(ipp, params)
+    targets = list(endpoints(params['endpoints'], params['mix'], params['ports'], params['seed']))
+    live = {'accept', 'slow'}
+    dispatched = [0.0] * len(targets)
+    latencies = []
+    outcome = {'passed': 0, 'false_negative': 0, 'false_positive': 0}
+
+    def jobs():
+        for index, (ip, port, _) in enumerate(targets):
+            dispatched[index] = time.perf_counter()
+            yield ip, port, index
+
+    def on_result(index, result):
+        latencies.append((time.perf_counter() - dispatched[index]) * 1000)
+        expected = targets[index][2] in live
+        if result:
+            outcome['passed'] += 1
+        if expected and not result:
+            outcome['false_negative'] += 1
+        elif result and not expected:
+            outcome['false_positive'] += 1
+
+    start = time.perf_counter()
+    if hasattr(ipp, 'probe_stream'):
+        ipp.probe_stream(jobs(), config, on_result, total=len(targets))
+    else:
+        # 旧版本只有check_ips，只能统计整体耗时，单个检测的延迟记为整批耗时
+        dispatched[:] = [start] * len(targets)
+        # 旧版本的check_ips只在带标签时读取端口
+        results = ipp.check_ips([f"{ip}:{port}#bench" for ip, port, _ in targets], config)
+        for index, result in enumerate(results):
+            on_result(index, result)
+    elapsed = time.perf_counter() - start
+    return {'probes': len(targets), 'seconds': round(elapsed, 3),
+            'probes_per_sec': round(len(targets) / elapsed, 1),
+            'p50_ms': percentile(latencies, 50), 'p99_ms': percentile(latencies, 99), **outcome}
+
+class LegacyClock:
+    """代替旧版本模块中的time：跳过固定sleep并累计跳过的时长，其余属性转给time模块"""
+
+    def __init__(self):
+        self.slept = 0.0
+
+    def sleep(self, seconds):
+        self.slept += seconds
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+def legacy_cloudflare(ipp, params):
+    """旧版本（CloudflareManager没有sync）的API地址写死为api.cloudflare.com，每个请求之间固定sleep：
+    把请求改发到本地模拟API，并跳过sleep（与api_rate=0的新版本可比），返回LegacyClock；新版本返回None"""
+    if hasattr(ipp.CloudflareManager, 'sync'):
+        return None
+    import requests
+    request = requests.Session.request
+
+    def redirected(self, method, url, *args, **kwargs):
+        if url.startswith(CLOUDFLARE_API):
+            url = params['api_base'] + url[len(CLOUDFLARE_API):]
+        return request(self, method, url, *args, **kwargs)
+
+    requests.Session.request = redirected
+    ipp.time = LegacyClock()
+    return ipp.time
+
+def sync_entries(subdomains, per_subdomain, seed):
+    """{标签: 按延迟排序的[(IP, 延迟)]}"""
+    rng = random.Random(seed)
+    entries = {}
+    for n in range(subdomains):
+        ranked = []
+        for _ in range(per_subdomain):
+            ip = (104 << 24) | rng.randrange(1 << 24)
+            ranked.append((socket.inet_ntoa(ip.to_bytes(4, 'big')), rng.uniform(10, 300)))
+        ranked.sort(key=lambda pair: pair[1])
+        entries[f'tag{n}'] = ranked
+    return entries
+
+def bench_sync(ipp, params):
+    """DNS同步：空区域首次同步、无变化重同步、部分候选变化后同步的API请求数
+
+    新版本直接调用CloudflareManager.sync；旧版本写出每个标签的结果文件，走upload_ips_to_cloudflare逐文件上传。
+    """
+    config = base_config(ipp, params)
+    upload_dir = Path(params['workdir']) / 'sync'
+    config['cloudflare']['upload_dir'] = str(upload_dir)
+    legacy = legacy_cloudflare(ipp, params)
+    fetch_stats(params['api_base'])
+    results = {}
+    phases = (('cold', params['seed']), ('unchanged', params['seed']), ('churn', None))
+    entries = None
+    for phase, seed in phases:
+        if seed is not None:
+            entries = sync_entries(params['subdomains'], params['candidates'], seed)
+        else:
+            # 每个标签排名前列的候选中约20%被新IP取代
+            fresh = sync_entries(params['subdomains'], params['candidates'], params['seed'] + 1)
+            entries = {tag: sorted(ranked[:len(ranked) * 4 // 5] + fresh[tag][:len(ranked) // 5],
+                                   key=lambda pair: pair[1])
+                       for tag, ranked in entries.items()}
+        manager = ipp.CloudflareManager(config)
+        if legacy is None:
+            ranked = {manager.subdomain_for(tag): [(ipp.Candidate.parse(f"{ip}:443#{tag}"), ipp.ProbeResult(True, rtt))
+                                                   for ip, rtt in pairs]
+                      for tag, pairs in entries.items()}
+        else:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+            upload_dir.mkdir(parents=True)
+            for tag, pairs in entries.items():
+                (upload_dir / f'{tag}.txt').write_text(''.join(f"{ip}#{tag}\n" for ip, _ in pairs), encoding='utf-8')
+            legacy.slept = 0.0
+        start = time.perf_counter()
+        if legacy is None:
+            manager.sync(ranked)
+        else:
+            manager.upload_ips_to_cloudflare()
+        elapsed = time.perf_counter() - start
+        calls = fetch_stats(params['api_base'])
+        results[phase] = {'seconds': round(elapsed, 3), 'api_calls': sum(calls.values()), 'by_method': calls}
+        if legacy is not None:
+            results[phase]['skipped_sleep_s'] = round(legacy.slept, 1)
+    return results
+
+def bench_pipeline(ipp, params):
+    """端到端process_files：首次运行、无变化重跑、修改一个文件后重跑"""
+    config = base_config(ipp, params)
+    workdir = Path(params['workdir'])
+    config['INPUT']['INPUT_DIR'] = str(workdir / 'ips')
+    config['OUTPUT']['OUTPUT_DIR'] = str(workdir / 'output')
+    if config.has_section('PUBLISH'):
+        config['PUBLISH']['STATE_FILE'] = str(workdir / 'state.json')
+    if config.has_section('CACHE'):
+        # 与定时任务一样启用检测缓存：回环地址的延迟抖动不应让重跑看起来像结果有变化
+        config['CACHE']['ENABLE'] = 'true'
+        config['CACHE']['CACHE_FILE'] = str(workdir / 'probe_cache.sqlite')
+    legacy = legacy_cloudflare(ipp, params)
+    fetch_stats(params['api_base'])
+
+    # 记录每个文件写出结果的时间，作为流水线延迟；旧版本没有write_output，不统计
+    finished = []
+    if hasattr(ipp, 'write_output'):
+        write_output = ipp.write_output
+
+        def timed_write_output(*args, **kwargs):
+            finished.append(time.perf_counter() - start)
+            return write_output(*args, **kwargs)
+
+        ipp.write_output = timed_write_output
+    results = {}
+    for phase in ('cold', 'unchanged', 'changed'):
+        if phase == 'changed':
+            rows = endpoints(params['rows'], params['mix'], params['ports'], params['seed'] + 1)
+            write_csv(workdir / 'ips' / 'changed.csv', rows, 'CHANGED')
+        finished.clear()
+        if legacy is not None:
+            legacy.slept = 0.0
+        start = time.perf_counter()
+        ipp.process_files(config)
+        elapsed = time.perf_counter() - start
+        calls = fetch_stats(params['api_base'])
+        results[phase] = {'seconds': round(elapsed, 3), 'api_calls': sum(calls.values()), 'by_method': calls,
+                          'file_p50_s': percentile(finished, 50), 'file_p99_s': percentile(finished, 99)}
+        if legacy is not None:
+            results[phase]['skipped_sleep_s'] = round(legacy.slept, 1)
+    return results
+
+BENCHMARKS = {'ingest': bench_ingest, 'probe': bench_probe, 'sync': bench_sync, 'pipeline': bench_pipeline}
+
+def child_main(module_path, name, params, queue):
+    """子进程入口：在工作目录中导入被测模块并运行一个场景"""
+    os.chdir(params['workdir'])
+    os.environ['TQDM_DISABLE'] = '1'
+    # 空的config.ini：只使用默认配置；旧版本的load_config在找不到配置文件时会生成带环境变量占位符的模板
+    Path('config.ini').touch()
+    try:
+        ipp = load_module(module_path)
+        import logging
+        logging.getLogger().setLevel(logging.WARNING)
+        result = BENCHMARKS[name](ipp, params)
+        queue.put({'result': result, 'peak_rss_mb': peak_rss_mb()})
+    except Exception as e:
+        queue.put({'error': f"{type(e).__name__}: {e}"})
+
+def run_child(module_path, name, params):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=child_main, args=(module_path, name, params, queue))
+    process.start()
+    outcome = queue.get()
+    process.join()
+    return outcome
+
+def version_info(module_path):
+    info = {'module': str(module_path),
+            'sha256': hashlib.sha256(Path(module_path).read_bytes()).hexdigest()[:16]}
+    try:
+        info['git'] = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=Path(module_path).parent,
+                                     capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except OSError:
+        info['git'] = None
+    return info
+
+def flatten(prefix, value, out):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key != 'by_method':
+                flatten(f"{prefix}.{key}" if prefix else key, item, out)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        out[prefix] = value
+    return out
+
+def compare(report, baseline_path):
+    """逐项输出当前结果相对基线的变化"""
+    baseline = json.loads(Path(baseline_path).read_text(encoding='utf-8'))
+    old = flatten('', baseline['results'], {})
+    new = flatten('', report['results'], {})
+    print(f"\n与基线比较: {baseline_path} ({baseline['version'].get('git')})")
+    for key in sorted(new):
+        if key in old:
+            change = f"{(new[key] - old[key]) / old[key] * 100:+.1f}%" if old[key] else "n/a"
+            print(f"  {key:<48} {old[key]:>12g} -> {new[key]:>12g}  {change}")
+
+def main():
+    parser = argparse.ArgumentParser(description="ip_processor 离线基准测试")
+    parser.add_argument('--module', default=str(Path(__file__).with_name('ip_processor.py')),
+                        help="被测的ip_processor.py路径，可用于比较不同版本")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="运行的场景，逗号分隔")
+    parser.add_argument('--rows', default='1000,100000', help="ingest场景的文件行数，逗号分隔（可到10000000）")
+    parser.add_argument('--endpoints', type=int, default=2000, help="probe场景的端点数")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('accept=0.2,refuse=0.2,blackhole=0.5,slow=0.1'),
+                        help="端点类型比例，如 accept=0.2,refuse=0.2,blackhole=0.5,slow=0.1")
+    parser.add_argument('--slow-ms', type=float, default=300, help="slow端点的HTTP响应延迟（毫秒）")
+    parser.add_argument('--port-pool', type=int, default=64, help="每类假端点监听的端口数")
+    parser.add_argument('--method', default='port', choices=('port', 'http'), help="检测方法")
+    parser.add_argument('--engine', default='asyncio', choices=('thread', 'asyncio'), help="检测引擎")
+    parser.add_argument('--timeout', type=float, default=1.0, help="CHECK_TIMEOUT（秒）")
+    parser.add_argument('--subdomains', type=int, default=100, help="sync场景的子域名数")
+    parser.add_argument('--pipeline-files', type=int, default=4, help="pipeline场景的输入文件数")
+    parser.add_argument('--pipeline-rows', type=int, default=500, help="pipeline场景每个输入文件的行数")
+    parser.add_argument('--set', action='append', default=[], metavar='SECTION.KEY=VALUE',
+                        help="覆盖配置项，如 --set IP_CHECK.ADAPTIVE_TIMEOUT=false")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', help="生成文件的目录，默认使用临时目录并在结束后删除")
+    parser.add_argument('--output', help="结果JSON文件")
+    parser.add_argument('--compare', help="与之前保存的结果JSON比较")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    for name in scenarios:
+        if name not in BENCHMARKS:
+            parser.error(f"未知的场景: {name}")
+    overrides = {}
+    for item in args.set:
+        key, _, value = item.partition('=')
+        if '.' not in key:
+            parser.error(f"配置项格式应为 SECTION.KEY=VALUE: {item}")
+        overrides[key] = value
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix='ipp-bench-')).resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    fake = FakeEndpoints(args.slow_ms, args.port_pool)
+    mock = MockCloudflare()
+    common = {'workdir': str(workdir), 'method': args.method, 'engine': args.engine, 'timeout': args.timeout,
+              'mix': args.mix, 'ports': fake.ports, 'seed': args.seed, 'api_base': mock.api_base,
+              'overrides': overrides}
+    report = {'version': version_info(args.module), 'python': platform.python_version(),
+              'platform': platform.platform(), 'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'params': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+              'results': {}}
+
+    try:
+        for name in scenarios:
+            params = dict(common)
+            if name == 'ingest':
+                files = []
+                for rows in (int(value) for value in args.rows.split(',')):
+                    for ext, writer in (('csv', write_csv), ('txt', write_txt)):
+                        path = workdir / f"ingest-{rows}.{ext}"
+                        if not path.exists():
+                            print(f"生成 {path.name} ...", flush=True)
+                            writer(path, endpoints(rows, args.mix, fake.ports, args.seed))
+                        files.append(str(path))
+                params['files'] = files
+            elif name == 'probe':
+                params['endpoints'] = args.endpoints
+            elif name == 'sync':
+                params.update(subdomains=args.subdomains, candidates=20)
+            elif name == 'pipeline':
+                pipeline_dir = workdir / 'pipeline'
+                shutil.rmtree(pipeline_dir, ignore_errors=True)
+                (pipeline_dir / 'ips').mkdir(parents=True)
+                for n in range(args.pipeline_files):
+                    rows = endpoints(args.pipeline_rows, args.mix, fake.ports, args.seed * 100 + n)
+                    write_csv(pipeline_dir / 'ips' / f"bench{n}.csv", rows, f"R{n}")
+                params.update(workdir=str(pipeline_dir), rows=args.pipeline_rows)
+
+            print(f"运行场景 {name} ...", flush=True)
+            outcome = run_child(args.module, name, params)
+            report['results'][name] = outcome
+            print(json.dumps(outcome, ensure_ascii=False, indent=2), flush=True)
+    finally:
+        fake.close()
+        mock.close()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding='utf-8')
+        print(f"结果已保存到 {args.output}")
+    if args.compare:
+        compare(report, args.compare)
+
+if __name__ == '__main__':
+    main()
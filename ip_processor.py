@@ -1,33 +1,277 @@
 import os
+import sys
+import argparse
 import re
 import csv
-import ipaddress
 from pathlib import Path
 import socket
+import ssl
 import subprocess
 import platform
 import concurrent.futures
 import threading
-from tqdm import tqdm
+import asyncio
+import collections
+import itertools
+import math
+import random
+import bisect
+import heapq
+import select
+import struct
+import errno
+import statistics
 import time
 import configparser
-import requests
 import json
+import hashlib
+import zlib
+import sqlite3
+from urllib.parse import urlsplit, quote
+import signal
 import logging
+import contextlib
 
-# 设置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('ip_processor.log', encoding='utf-8')
-    ]
-)
+# 导入本模块没有副作用：不配置日志、不打开日志文件（由命令行入口调用setup_logging），
+# requests、tqdm等第三方依赖在用到时才导入
 logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+def setup_logging(log_file='ip_processor.log'):
+    """命令行运行时的日志设置：输出到终端，同时写入log_file（为空时不写文件）"""
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file, encoding='utf-8'))
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=handlers
+    )
+
+class Metrics:
+    """进程内的计数器、直方图和各阶段耗时，输出为JSON运行报告和Prometheus文本格式
+
+    计数器和直方图以 (名称, 标签) 区分，直方图使用固定分桶，内存占用与检测数量无关。
+    可能在检测引擎、写出线程和API线程中同时调用，所有更新都加锁。
+    """
+
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)  # 毫秒
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = collections.defaultdict(float)  # (名称, 标签) -> 值
+        self.histograms = {}  # (名称, 标签) -> [各分桶计数..., 超出最大分桶的计数, 总和]
+        self.stages = collections.defaultdict(lambda: [0.0, 0])  # 阶段 -> [累计秒数, 次数]
+        self.profile_dir = None  # 设置后按阶段收集cProfile数据
+        self.profiles = {}
+        self.profiling = False  # 同一时间只能有一个cProfile在运行，嵌套的阶段只计时
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] += value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        index = bisect.bisect_left(self.BUCKETS, value)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += value
+
+    def add_stage(self, name, seconds, runs=1):
+        with self.lock:
+            stage = self.stages[name]
+            stage[0] += seconds
+            stage[1] += runs
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """统计一个阶段的耗时，启用性能分析时同时收集该阶段的cProfile数据"""
+        profile = None
+        if self.profile_dir is not None:
+            with self.lock:
+                if not self.profiling:
+                    import cProfile
+                    self.profiling = True
+                    profile = self.profiles.setdefault(name, cProfile.Profile())
+        start = time.perf_counter()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                self.profiling = False
+            self.add_stage(name, time.perf_counter() - start)
+
+    def timed(self, iterable, name):
+        """逐项读取iterable，把读取本身花费的时间计入name阶段（例如解析输入文件）"""
+        clock = time.perf_counter
+        iterator = iter(iterable)
+        spent = 0.0
+        try:
+            while True:
+                start = clock()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    spent += clock() - start
+                    return
+                spent += clock() - start
+                yield item
+        finally:
+            self.add_stage(name, spent)
+
+    @staticmethod
+    def quantile(histogram, q):
+        """按分桶线性插值估算分位数"""
+        counts = histogram[:-1]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                low = Metrics.BUCKETS[index - 1] if index > 0 else 0
+                high = Metrics.BUCKETS[index] if index < len(Metrics.BUCKETS) else Metrics.BUCKETS[-1]
+                return round(low + (high - low) * (rank - seen) / count, 3)
+            seen += count
+        return float(Metrics.BUCKETS[-1])
+
+    def report(self):
+        """返回可以序列化为JSON的运行报告"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+            stages = {name: list(value) for name, value in self.stages.items()}
+        report = {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'duration_seconds': round(time.time() - self.started, 3),
+            'stages': {name: {'seconds': round(seconds, 3), 'runs': runs}
+                       for name, (seconds, runs) in sorted(stages.items())},
+            'counters': collections.defaultdict(list),
+            'histograms': collections.defaultdict(list),
+        }
+        for (name, labels), value in sorted(counters.items()):
+            report['counters'][name].append({'labels': dict(labels), 'value': value})
+        for (name, labels), histogram in sorted(histograms.items()):
+            count = sum(histogram[:-1])
+            report['histograms'][name].append({
+                'labels': dict(labels), 'count': count, 'sum': round(histogram[-1], 3),
+                'p50': self.quantile(histogram, 0.5), 'p90': self.quantile(histogram, 0.9),
+                'p99': self.quantile(histogram, 0.99),
+            })
+        return report
+
+    def prometheus(self, prefix='ip_processor'):
+        """Prometheus文本格式"""
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        def labels_text(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ''
+            return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in items) + '}'
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(value)) for key, value in self.histograms.items())
+            stages = sorted((name, list(value)) for name, value in self.stages.items())
+        lines = [f"# TYPE {prefix}_stage_seconds_total counter"]
+        lines += [f'{prefix}_stage_seconds_total{{stage="{name}"}} {seconds:.6f}' for name, (seconds, _) in stages]
+        lines.append(f"# TYPE {prefix}_stage_runs_total counter")
+        lines += [f'{prefix}_stage_runs_total{{stage="{name}"}} {runs}' for name, (_, runs) in stages]
+        declared = set()
+        for (name, labels), value in counters:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {prefix}_{name} counter")
+            lines.append(f"{prefix}_{name}{labels_text(labels)} {value:g}")
+        for (name, labels), histogram in histograms:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {prefix}_{name} histogram")
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ('+Inf',), histogram[:-1]):
+                cumulative += count
+                lines.append(f"{prefix}_{name}_bucket{labels_text(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{prefix}_{name}_sum{labels_text(labels)} {histogram[-1]:.3f}")
+            lines.append(f"{prefix}_{name}_count{labels_text(labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+    def write_reports(self, config):
+        """按配置写出JSON运行报告、Prometheus文本文件和各阶段的cProfile数据"""
+        section = config['REPORT']
+        outputs = [(section.get('REPORT_FILE').strip(),
+                    lambda: json.dumps(self.report(), ensure_ascii=False, indent=2)),
+                   (section.get('PROMETHEUS_FILE').strip(), self.prometheus)]
+        for path, render in outputs:
+            if not path:
+                continue
+            tmp_path = f"{path}.tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(render())
+                # 先写临时文件再替换，Prometheus textfile收集器不会读到不完整的文件
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning(f"写入运行报告 {path} 失败: {e}")
+
+        if self.profile_dir is not None and self.profiles:
+            import pstats
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+            for name, profile in self.profiles.items():
+                profile.dump_stats(self.profile_dir / f"{name}.prof")
+                with open(self.profile_dir / f"{name}.txt", 'w', encoding='utf-8') as f:
+                    pstats.Stats(profile, stream=f).sort_stats('cumulative').print_stats(40)
+            logger.info(f"性能分析数据已写入 {self.profile_dir}/ ({', '.join(sorted(self.profiles))})")
+
+    def serve(self, port, host='127.0.0.1'):
+        """在后台线程中提供 /metrics，供Prometheus抓取（常驻模式下使用），默认只监听本机"""
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
 
-def load_config():
-    """加载配置文件，支持环境变量替换"""
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f"Prometheus指标地址: http://{host}:{port}/metrics")
+        return server
+
+# 整个进程共用的指标
+metrics = Metrics()
+
+def load_config(path='config.ini', create_missing=False):
+    """加载配置文件，支持环境变量替换
+
+    path为None或文件不存在时只使用默认配置；create_missing为True时（命令行运行）
+    在path处创建带注释的默认配置文件，作为库使用时不会写入任何文件。
+    """
     config = configparser.ConfigParser()
     
     # 设置默认配置
@@ -36,14 +280,89 @@ def load_config():
         'CHECK_METHOD': 'ping',
         'CHECK_PORT': '443',
         'CHECK_TIMEOUT': '2',
-        'CHECK_THREADS': '50'
+        'CHECK_THREADS': '50',
+        'CHECK_ENGINE': 'thread',
+        'CHECK_CONCURRENCY': '1000',
+        'CHECK_ATTEMPTS': '1',
+        'MAX_LATENCY': '0',
+        'SORT_BY_LATENCY': 'true',
+        'TLS_SNI': '',
+        'TLS_VERIFY': 'false',
+        'HTTP_HOST': 'speed.cloudflare.com',
+        'HTTP_PATH': '/cdn-cgi/trace',
+        'HTTP_METHOD': 'HEAD',
+        'HTTP_EXPECT_STATUS': '200',
+        'HTTP_COLOS': '',
+        'ICMP_MODE': 'auto',
+        'ICMP_WINDOW': '1024',
+        'ICMP_RATE': '2000',
+        'ADAPTIVE_TIMEOUT': 'true',
+        'TIMEOUT_PERCENTILE': '95',
+        'TIMEOUT_MULTIPLIER': '2',
+        'TIMEOUT_FLOOR': '0.5',
+        'TIMEOUT_MIN_SAMPLES': '20',
+        'DEPRIORITIZE_AFTER': '8',
+        'GOAL_COUNT': '0',
+        'GOAL_MARGIN': '2',
+        'CSV_MAX_LATENCY': '0',
+        'CSV_MIN_SPEED': '0',
+        'CSV_PRESORT': 'true'
+    }
+    config['CACHE'] = {
+        'ENABLE': 'false',
+        'CACHE_FILE': '.probe_cache.sqlite',
+        'POSITIVE_TTL': '86400',
+        'NEGATIVE_TTL': '21600',
+        'MAX_ENTRIES': '1000000'
+    }
+    config['SPEED_TEST'] = {
+        'ENABLE': 'false',
+        'URL': 'https://speed.cloudflare.com/__down?bytes=50000000',
+        'BYTES': '5000000',
+        'TOP_K': '10',
+        'CONCURRENCY': '2',
+        'TIMEOUT': '10',
+        'MIN_SPEED': '0'
     }
     config['OUTPUT'] = {
         'OUTPUT_DIR': 'output'
     }
+    config['PUBLISH'] = {
+        'STATE_FILE': '.publish_state.json',
+        'CONCURRENCY': '4',
+        'MAX_RETRIES': '3',
+        'WEBDAV_ENABLE': 'false',
+        'WEBDAV_URL': '',
+        'WEBDAV_USERNAME': '',
+        'WEBDAV_PASSWORD': '',
+        'KV_ENABLE': 'false',
+        'KV_DOMAIN': '',
+        'KV_TOKEN': '',
+        'KV_MAX_LINES': '10'
+    }
+    config['DAEMON'] = {
+        'PUBLISHED_INTERVAL': '60',
+        'POOL_INTERVAL': '3600',
+        'RELOAD_INTERVAL': '5'
+    }
     config['INPUT'] = {
         'INPUT_DIR': 'ips'
     }
+    config['SCAN'] = {
+        'SAMPLES_PER_BLOCK': '4',
+        'EXPAND_MIN_PASS': '1',
+        'EXPAND_MAX_BLOCKS': '16',
+        'MAX_BLOCKS_PER_RANGE': '4096',
+        'BLOCK_PREFIX_V6': '120',
+        'EXCLUDE_FILES': ''
+    }
+    config['REPORT'] = {
+        'REPORT_FILE': 'run_report.json',
+        'PROMETHEUS_FILE': '',
+        'PROMETHEUS_PORT': '0',
+        'PROMETHEUS_BIND': '127.0.0.1',
+        'PROFILE_DIR': 'profile'
+    }
     config['cloudflare'] = {
         'enable': 'false',
         'api_token': '',
@@ -55,13 +374,22 @@ def load_config():
         'proxied': 'false',
         'max_records_per_line': '5',
         'upload_dir': 'output',
-        'upload_files': 'all'
+        'upload_files': 'all',
+        'api_rate': '4',
+        'api_concurrency': '4',
+        'api_max_retries': '5',
+        'api_base': 'https://api.cloudflare.com/client/v4',
+        'batch_size': '200',
+        'subnet_prefix': '24',
+        'subnet_prefix_v6': '48',
+        'max_per_subnet': '0',
+        'replace_margin': '10'
     }
     
     # 读取配置文件
-    if os.path.exists('config.ini'):
-        config.read('config.ini', encoding='utf-8')
-        logger.info("已加载配置文件: config.ini")
+    if path is not None and os.path.exists(path):
+        config.read(path, encoding='utf-8')
+        logger.info(f"已加载配置文件: {path}")
         
         # 环境变量替换
         for section in config.sections():
@@ -78,14 +406,15 @@ def load_config():
                         logger.warning(f"环境变量未设置: {env_var_name}")
     else:
         logger.info("未找到配置文件，使用默认配置")
-        # 创建带注释的默认配置文件
-        create_config_file_with_comments()
-        config.read('config.ini', encoding='utf-8')
-        logger.info("已创建带注释的默认配置文件: config.ini")
+        if path is not None and create_missing:
+            # 创建带注释的默认配置文件
+            create_config_file_with_comments(path)
+            config.read(path, encoding='utf-8')
+            logger.info(f"已创建带注释的默认配置文件: {path}")
     
     return config
 
-def create_config_file_with_comments():
+def create_config_file_with_comments(path='config.ini'):
     """创建带注释的配置文件"""
     config_content = """# IP处理工具配置文件
 # 请根据您的需求修改以下配置
@@ -94,9 +423,11 @@ def create_config_file_with_comments():
 # 是否启用IP检测功能 (true/false)
 ENABLE_IP_CHECK = true
 
-# IP检测方法 (ping/port)
+# IP检测方法 (ping/port/tls/http)
 # ping: 使用ping命令检测IP是否可达
 # port: 检测指定端口是否开放
+# tls: 完成一次TLS握手（使用TLS_SNI）并记录握手耗时
+# http: 通过该IP发送HTTP请求到HTTP_HOST/HTTP_PATH并检查状态码
 CHECK_METHOD = port
 
 # 如果使用端口检测，指定要检测的端口号
@@ -105,17 +436,202 @@ CHECK_PORT = 443
 # 检测超时时间（秒）
 CHECK_TIMEOUT = 2
 
-# 并发检测线程数
+# 并发检测线程数 (仅 thread 引擎使用)
 CHECK_THREADS = 50
 
+# 检测引擎 (thread/asyncio)
+# thread: 线程池，每个线程一个阻塞connect
+# asyncio: 基于非阻塞connect的事件循环，可同时保持数千个检测
+# 删除此项时使用内置默认值 thread，与没有该项的旧配置文件行为一致
+CHECK_ENGINE = asyncio
+
+# asyncio 引擎同时进行的最大检测数
+CHECK_CONCURRENCY = 1000
+
+# 每个IP的检测次数，多次检测时取延迟中位数（首次失败即判定无效）
+CHECK_ATTEMPTS = 1
+
+# 最大允许延迟（毫秒），超过的IP将被丢弃，0 表示不限制
+MAX_LATENCY = 0
+
+# 输出文件是否按延迟从低到高排序 (true/false)
+SORT_BY_LATENCY = true
+
+# tls/http检测使用的SNI，留空则使用HTTP_HOST
+TLS_SNI =
+
+# 是否校验证书 (true/false)，检测边缘节点时通常关闭
+TLS_VERIFY = false
+
+# http检测请求的Host和路径
+HTTP_HOST = speed.cloudflare.com
+HTTP_PATH = /cdn-cgi/trace
+
+# http检测的请求方法 (HEAD/GET)
+HTTP_METHOD = HEAD
+
+# 视为可用的HTTP状态码，多个用逗号分隔，留空表示接受任意状态码
+HTTP_EXPECT_STATUS = 200
+
+# 只保留指定数据中心的IP（读取cf-ray响应头），如: HKG,TPE，留空表示不限制
+HTTP_COLOS =
+
+# ping检测方式 (auto/native/subprocess)
+# auto/native: 使用进程内ICMP引擎（单个套接字批量发送），不允许创建ICMP套接字时回退到ping命令
+# subprocess: 每个IP调用一次系统ping命令
+ICMP_MODE = auto
+
+# 原生ICMP引擎同时在途的请求数上限
+ICMP_WINDOW = 1024
+
+# 原生ICMP引擎每秒最多发送的请求数
+ICMP_RATE = 2000
+
+# 自适应超时 (true/false)：按已成功检测的延迟分布（全局和每个/24网段）缩短等待时间，
+# 超时取延迟的 TIMEOUT_PERCENTILE 百分位乘以 TIMEOUT_MULTIPLIER，
+# 限制在 TIMEOUT_FLOOR（不低于MAX_LATENCY）和 CHECK_TIMEOUT 之间；成功样本少于 TIMEOUT_MIN_SAMPLES 时使用 CHECK_TIMEOUT
+ADAPTIVE_TIMEOUT = true
+TIMEOUT_PERCENTILE = 95
+TIMEOUT_MULTIPLIER = 2
+TIMEOUT_FLOOR = 0.5
+TIMEOUT_MIN_SAMPLES = 20
+
+# 同一/24（IPv6为/64）网段连续失败达到该次数后，其余IP推迟到最后检测，0 表示不推迟
+DEPRIORITIZE_AFTER = 8
+
+# 目标模式：每个标签（IPv4/IPv6分别计算）检测通过 GOAL_COUNT + GOAL_MARGIN 个IP后停止检测该标签，
+# 候选IP按先验（缓存中近期通过的、CSV延迟/速度、所在网段的缓存记录）从好到差分轮检测；
+# 通常设为与 max_records_per_line 相同，0 表示检测全部候选IP
+GOAL_COUNT = 0
+GOAL_MARGIN = 2
+
+# 根据CSV自带的"网络延迟"/"下载速度"列跳过较慢的行，0 表示不限制
+CSV_MAX_LATENCY = 0
+CSV_MIN_SPEED = 0
+
+# 检测前是否按CSV中的下载速度（降序）和延迟（升序）预排序 (true/false)
+CSV_PRESORT = true
+
+[CACHE]
+# 是否启用检测结果缓存 (true/false)，有效期内的IP不再重复检测
+# 删除此项时使用内置默认值 false，与没有[CACHE]的旧配置文件行为一致
+ENABLE = true
+
+# 缓存文件路径（SQLite）
+CACHE_FILE = .probe_cache.sqlite
+
+# 检测成功结果的有效期（秒）
+POSITIVE_TTL = 86400
+
+# 检测失败结果的有效期（秒），应短于成功结果的有效期和定时运行的间隔，
+# 否则暂时失败的IP在之后的多次运行中都不会被重新检测
+NEGATIVE_TTL = 21600
+
+# 最多缓存的记录数，超出时淘汰最早的记录，0 表示不限制
+MAX_ENTRIES = 1000000
+
+[SPEED_TEST]
+# 是否启用下载测速 (true/false)，只对连通性检测后排名靠前的IP测速
+ENABLE = false
+
+# 测速下载地址，请求会通过被测IP发送，Host取自该地址
+URL = https://speed.cloudflare.com/__down?bytes=50000000
+
+# 每个IP最多下载的字节数
+BYTES = 5000000
+
+# 每个文件只测速排名前K个IP，0 表示全部测速
+TOP_K = 10
+
+# 同时进行的测速数量（全局带宽预算）
+CONCURRENCY = 2
+
+# 单个IP测速超时时间（秒）
+TIMEOUT = 10
+
+# 最低下载速度（kB/s），低于该值的IP被丢弃，0 表示不限制
+MIN_SPEED = 0
+
 [INPUT]
 # 输入目录，存放原始IP文件的目录
 INPUT_DIR = ips
 
+[SCAN]
+# 输入文件中可以写网段（如 104.16.0.0/20、2606:4700::/48），按块抽样检测：
+# 先在每个/24（IPv6为/BLOCK_PREFIX_V6）中检测SAMPLES_PER_BLOCK个地址，
+# 再只展开样本检测结果较好的块，检测块内其余地址
+SAMPLES_PER_BLOCK = 4
+
+# 样本中至少有几个检测通过的块才会展开
+EXPAND_MIN_PASS = 1
+
+# 每个文件最多展开的块数（按样本最低延迟排序），0 表示全部展开
+EXPAND_MAX_BLOCKS = 16
+
+# 单个网段包含的块超过该数量时，随机选取这么多块抽样
+MAX_BLOCKS_PER_RANGE = 4096
+
+# IPv6网段的抽样块大小（112-128）
+BLOCK_PREFIX_V6 = 120
+
+# 排除列表文件，每行一个IP或网段，多个文件用逗号分隔；排除的地址不会被检测
+EXCLUDE_FILES =
+
 [OUTPUT]
 # 输出目录，处理后的文件将保存到此目录
 OUTPUT_DIR = output
 
+[PUBLISH]
+# 状态清单文件：记录每个输出文件内容的哈希、上次发布的DNS记录和各目标已上传的版本，
+# 结果没有变化时不会改写输出文件，也不会重复同步DNS或上传（删除该文件可强制全部重新发布）
+STATE_FILE = .publish_state.json
+
+# 并行上传的文件数和失败重试次数
+CONCURRENCY = 4
+MAX_RETRIES = 3
+
+# 是否上传到WebDAV (true/false)
+WEBDAV_ENABLE = false
+WEBDAV_URL = ${WEBDAV_URL}
+WEBDAV_USERNAME = ${WEBDAV_USERNAME}
+WEBDAV_PASSWORD = ${WEBDAV_PASSWORD}
+
+# 是否上传到Cloudflare KV (true/false)
+# 项目: https://github.com/cmliu/CF-Workers-TEXT2KV
+KV_ENABLE = false
+KV_DOMAIN = ${CFKV_DOMAIN}
+KV_TOKEN = ${CFKV_TOKEN}
+
+# 每个文件上传到KV的最大行数，0表示全部
+KV_MAX_LINES = 10
+
+[DAEMON]
+# 以下配置仅在 --daemon 常驻模式下生效
+# 重新检测已发布DNS记录的间隔（秒），失败的记录会立即被替换
+PUBLISHED_INTERVAL = 60
+
+# 不使用缓存重新检测全部候选IP并重新选择记录的间隔（秒）
+POOL_INTERVAL = 3600
+
+# 检查输入目录文件是否变化的间隔（秒），有变化时立即重新加载并检测
+RELOAD_INTERVAL = 5
+
+[REPORT]
+# 运行报告（JSON）：各阶段耗时、每个文件的检测结果和延迟分布、API请求次数和耗时，留空则不输出
+REPORT_FILE = run_report.json
+
+# Prometheus文本格式的指标文件（可配合node_exporter的textfile收集器），留空则不输出
+PROMETHEUS_FILE =
+
+# 常驻模式下提供 /metrics 的端口，0 表示不启动
+PROMETHEUS_PORT = 0
+
+# /metrics 监听的地址，默认只允许本机访问；需要从其他主机抓取时改为 0.0.0.0 或内网地址
+PROMETHEUS_BIND = 127.0.0.1
+
+# --profile 时各阶段cProfile数据的输出目录
+PROFILE_DIR = profile
+
 [cloudflare]
 # 是否启用Cloudflare DNS上传功能 (true/false)
 enable = false
@@ -137,7 +653,9 @@ domain = ${CF_DOMAIN}
 # 如果留空，则记录名为 标签.域名
 record_name = ip
 
-# DNS记录类型 (通常使用A记录)
+# DNS记录类型：A发布IPv4地址，AAAA发布IPv6地址，可以同时填写 A,AAAA
+# 两种类型分别选择，每种最多max_records_per_line条
+# 注意：启用AAAA后，程序管理的名称下已有的AAAA记录也由程序维护，没有IPv6候选的标签会删除这些记录
 record_type = A
 
 # DNS记录TTL值
@@ -152,6 +670,15 @@ proxied = false
 # 每个标签上传的最大IP数量
 max_records_per_line = 5
 
+# 同一网段最多上传的IP数量，0表示不限制
+# 网段长度由subnet_prefix（IPv4）和subnet_prefix_v6（IPv6）指定，24即同一个/24网段
+subnet_prefix = 24
+subnet_prefix_v6 = 48
+max_per_subnet = 0
+
+# 已发布的IP仍然可用时，新IP的延迟/速度需要好于它这个百分比才会替换，减少DNS频繁变动
+replace_margin = 10
+
 # 要上传的文件所在目录
 upload_dir = output
 
@@ -159,126 +686,1362 @@ upload_dir = output
 # all: 上传所有文件
 # 或指定文件名，如: HK,US,JP (不需要.txt扩展名)
 upload_files = all
+
+# API请求速率上限（每秒请求数）
+# Cloudflare API限制为每5分钟1200次请求，即平均每秒4次
+api_rate = 4
+
+# 同时同步的子域名数量
+api_concurrency = 4
+
+# 遇到429限流或5xx错误时的最大重试次数（指数退避，优先使用Retry-After）
+api_max_retries = 5
+
+# API地址，测试时可以指向本地模拟服务
+api_base = https://api.cloudflare.com/client/v4
+
+# 每次批量提交（dns_records/batch）的最大变更数，0表示逐条提交
+batch_size = 200
 """
     
-    with open('config.ini', 'w', encoding='utf-8') as f:
+    with open(path, 'w', encoding='utf-8') as f:
         f.write(config_content)
 
-def validate_ip(ip_str):
-    """验证IP地址的有效性"""
+# 行首的IPv4地址，或行首（可带方括号）的IPv6地址
+IP_PREFIX_RE = re.compile(r'(\d+\.\d+\.\d+\.\d+)|\[?([0-9A-Fa-f]{0,4}:[0-9A-Fa-f:.]*)')
+IPV4_STRUCT = struct.Struct('!I')
+# IPv6地址的整数表示加上这一位，与IPv4的32位整数范围不重叠
+IPV6_FLAG = 1 << 128
+
+def pack_ipv4(text):
+    """把点分十进制IPv4地址转换为32位整数，无效地址返回None"""
     try:
-        ipaddress.ip_address(ip_str)
-        return True
-    except ValueError:
-        return False
+        return IPV4_STRUCT.unpack(socket.inet_pton(socket.AF_INET, text))[0]
+    except OSError:
+        return None
+
+def pack_ipv6(text):
+    """把IPv6地址转换为带IPV6_FLAG标记的整数，无效地址返回None"""
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET6, text), 'big') | IPV6_FLAG
+    except OSError:
+        return None
+
+def pack_ip(text):
+    """IPv4或IPv6地址（IPv6可带方括号）转换为整数，无效地址返回None"""
+    if ':' in text:
+        return pack_ipv6(text[1:-1] if text.startswith('[') and text.endswith(']') else text)
+    return pack_ipv4(text)
+
+def address_family(ip):
+    """文本形式IP地址的套接字地址族"""
+    return socket.AF_INET6 if ':' in ip else socket.AF_INET
+
+class Candidate:
+    """候选IP记录：IP为整数（IPv4为32位整数，IPv6带IPV6_FLAG标记），端口为整数（0表示未指定），标签为驻留字符串
+
+    提取、去重、检测和Cloudflare上传都使用该记录，只在写出结果时才格式化为文本。
+    """
+    __slots__ = ('ip', 'port', 'tag', 'latency', 'speed')
+
+    def __init__(self, ip, port=0, tag='', latency=None, speed=None):
+        self.ip = ip
+        self.port = port
+        # 同一文件的条目共用同一个标签对象
+        self.tag = sys.intern(tag)
+        # CSV自带的延迟（毫秒）和下载速度（kB/s），没有时为None
+        self.latency = latency
+        self.speed = speed
+
+    @classmethod
+    def parse(cls, item):
+        """解析 "ip:端口#标签" / "ip#标签" / "ip" 格式的文本，无效返回None
+
+        IPv6地址带端口时写作 "[ip]:端口"，不带端口时方括号可以省略。
+        """
+        address, _, tag = item.strip().partition('#')
+        host, sep, port_text = address.partition(':')
+        if ':' not in port_text and host[:1] != '[':
+            ip = pack_ipv4(host.strip())
+        else:
+            # IPv6：冒号多于一个或以方括号开头
+            address = address.strip()
+            if address.startswith('['):
+                host, bracket, rest = address[1:].partition(']')
+                if not bracket or (rest and not rest.startswith(':')):
+                    return None
+                sep, port_text = rest[:1], rest[1:]
+                ip = pack_ipv6(host)
+            else:
+                sep = port_text = ''
+                ip = pack_ipv6(address)
+        if ip is None:
+            return None
+        port = 0
+        if sep:
+            port_text = port_text.strip()
+            if not port_text.isdigit() or not 0 < int(port_text) < 65536:
+                return None
+            port = int(port_text)
+        return cls(ip, port, tag.strip())
+
+    @property
+    def is_v6(self):
+        return self.ip >= IPV6_FLAG
+
+    @property
+    def host(self):
+        if self.ip >= IPV6_FLAG:
+            return socket.inet_ntop(socket.AF_INET6, (self.ip ^ IPV6_FLAG).to_bytes(16, 'big'))
+        return socket.inet_ntoa(IPV4_STRUCT.pack(self.ip))
+
+    @property
+    def key(self):
+        """IP和端口打包成的整数，用于去重"""
+        return (self.ip << 16) | self.port
+
+    def endpoint(self, default_port):
+        """检测用的 (ip, 端口)，未指定端口时使用default_port"""
+        return self.host, self.port or default_port
+
+    def __str__(self):
+        host = self.host
+        if self.port:
+            address = f"[{host}]:{self.port}" if self.ip >= IPV6_FLAG else f"{host}:{self.port}"
+        else:
+            address = host
+        return f"{address}#{self.tag}" if self.tag else address
+
+    def __repr__(self):
+        return f"Candidate({self})"
+
+# 紧跟在行首IP之后的网段前缀长度
+CIDR_SUFFIX_RE = re.compile(r'/(\d{1,3})')
+
+class CidrRange:
+    """输入文件中的一个网段，first/last与Candidate.ip的整数表示相同，检测时按块抽样展开"""
+    __slots__ = ('first', 'last', 'port', 'tag')
+
+    def __init__(self, first, last, port=0, tag=''):
+        self.first = first
+        self.last = last
+        self.port = port
+        self.tag = sys.intern(tag)
+
+    @classmethod
+    def from_prefix(cls, ip, prefix, port=0, tag=''):
+        """由网段中任意一个地址和前缀长度生成，前缀长度无效返回None；单个地址的网段返回Candidate"""
+        width = 128 if ip >= IPV6_FLAG else 32
+        if not 0 <= prefix <= width:
+            return None
+        if prefix == width:
+            return Candidate(ip, port, tag)
+        host_mask = (1 << (width - prefix)) - 1
+        first = ip & ~host_mask
+        return cls(first, first | host_mask, port, tag)
+
+    @classmethod
+    def parse(cls, text, port=0, tag=''):
+        """解析 "地址/前缀长度"，无效返回None"""
+        address, sep, prefix = text.strip().partition('/')
+        ip = pack_ip(address.strip())
+        if not sep or ip is None or not prefix.strip().isdigit():
+            return None
+        return cls.from_prefix(ip, int(prefix), port, tag)
+
+    @property
+    def size(self):
+        return self.last - self.first + 1
+
+    def __str__(self):
+        first = Candidate(self.first).host
+        prefix = (128 if self.first >= IPV6_FLAG else 32) - (self.size.bit_length() - 1)
+        address = f"{first}/{prefix}"
+        return f"{address}#{self.tag}" if self.tag else address
+
+    def __repr__(self):
+        return f"CidrRange({self})"
+
+class ProbeResult:
+    """单个IP的检测结果，可以直接当作布尔值使用"""
+    __slots__ = ('ok', 'rtt', 'error', 'connect_ms', 'tls_ms', 'ttfb_ms', 'status', 'colo', 'speed', 'loss',
+                 'cacheable')
+
+    def __init__(self, ok, rtt=None, error=None, connect_ms=None, tls_ms=None,
+                 ttfb_ms=None, status=None, colo=None, loss=None):
+        self.ok = ok
+        # 用于排序的总延迟（毫秒）：port为连接耗时，tls为连接+握手，http为连接+握手+首字节
+        self.rtt = rtt
+        self.error = error  # 失败原因: timeout/refused/tls/http/status/colo/error
+        # 分阶段耗时（毫秒），仅tls/http检测时记录
+        self.connect_ms = connect_ms
+        self.tls_ms = tls_ms
+        self.ttfb_ms = ttfb_ms
+        self.status = status  # HTTP状态码
+        self.colo = colo  # cf-ray中的数据中心代码，如HKG
+        self.speed = None  # 下载速度测试结果（kB/s），未测速时为None
+        self.loss = loss  # ICMP丢包率（0-1），仅原生ICMP检测时记录
+        self.cacheable = True  # 为False时不写入检测缓存（如在缩短的超时内未响应）
+
+    def __bool__(self):
+        return self.ok
+
+    def __repr__(self):
+        if self.ok:
+            return f"ProbeResult(ok, rtt={self.rtt}, colo={self.colo})"
+        return f"ProbeResult(failed, error={self.error})"
+
+# 连接超时/被拒绝对应的错误码
+TIMEOUT_ERRNOS = {errno.EAGAIN, errno.EWOULDBLOCK, errno.ETIMEDOUT, errno.EINPROGRESS}
+REFUSED_ERRNOS = {errno.ECONNREFUSED, errno.ECONNRESET}
+
+# 支持的检测方法
+CHECK_METHODS = ('ping', 'port', 'tls', 'http')
+
+# Cloudflare的非TLS端口，http检测在这些端口上使用明文HTTP
+CF_HTTP_PORTS = {80, 8080, 8880, 2052, 2082, 2086, 2095}
+
+# 从ping输出中解析延迟，兼容 time=12.3 ms / time<1ms / 时间=12ms
+PING_TIME_RE = re.compile(r'(?:time|时间)\s*[=<]\s*([\d.]+)\s*ms', re.IGNORECASE)
+
+def classify_errno(code):
+    """将connect错误码归类为timeout/refused/error"""
+    if code in TIMEOUT_ERRNOS:
+        return 'timeout'
+    if code in REFUSED_ERRNOS:
+        return 'refused'
+    return 'error'
+
+def median_rtt(results):
+    """合并多次检测结果：有成功样本时返回延迟中位数，否则返回最后一次失败结果"""
+    samples = [r.rtt for r in results if r]
+    if not samples:
+        return results[-1]
+    if len(samples) == 1:
+        return next(r for r in results if r)
+    # 以延迟中位数那次检测为准，保留其分阶段耗时和数据中心信息
+    median = statistics.median_low(samples)
+    return next(r for r in results if r and r.rtt == median)
 
 def check_ip_port(ip, port, timeout):
-    """检测IP端口是否开放"""
+    """检测IP端口是否开放，返回带连接延迟的检测结果"""
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        with socket.socket(address_family(ip), socket.SOCK_STREAM) as s:
             s.settimeout(timeout)
+            start = time.perf_counter()
             result = s.connect_ex((ip, port))
-            return result == 0
+            if result == 0:
+                return ProbeResult(True, (time.perf_counter() - start) * 1000)
+            return ProbeResult(False, error=classify_errno(result))
+    except socket.timeout:
+        return ProbeResult(False, error='timeout')
     except Exception:
-        return False
+        return ProbeResult(False, error='error')
+
+def parse_ping_rtt(output, elapsed):
+    """从ping输出解析延迟（毫秒），解析失败时使用命令耗时"""
+    match = PING_TIME_RE.search(output)
+    if match:
+        return float(match.group(1))
+    return elapsed * 1000
+
+def ping_command(ip, timeout):
+    """生成单次ping命令，各平台超时参数的单位不同"""
+    system = platform.system().lower()
+    if system == 'windows':
+        # Windows: -w 单位为毫秒
+        return ['ping', '-n', '1', '-w', str(int(timeout * 1000)), ip]
+    if system == 'darwin':
+        # macOS: -W 单位为毫秒，IPv6需要使用ping6
+        return ['ping6' if ':' in ip else 'ping', '-c', '1', '-W', str(int(timeout * 1000)), ip]
+    # Linux: -W 单位为秒，-w 是整个命令的截止时间（秒），不能传毫秒
+    return ['ping', '-c', '1', '-W', str(max(1, math.ceil(timeout))), ip]
 
 def check_ip_ping(ip, timeout):
-    """检测IP是否可ping通"""
-    param = '-n' if platform.system().lower() == 'windows' else '-c'
-    command = ['ping', param, '1', '-w', str(int(timeout * 1000)), ip]
+    """检测IP是否可ping通，返回带延迟的检测结果"""
+    command = ping_command(ip, timeout)
     
     try:
+        start = time.perf_counter()
         with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
-            _, _ = process.communicate()
-            return process.returncode == 0
+            stdout, _ = process.communicate()
+            if process.returncode == 0:
+                output = stdout.decode('utf-8', errors='ignore')
+                return ProbeResult(True, parse_ping_rtt(output, time.perf_counter() - start))
+            return ProbeResult(False, error='timeout')
     except Exception:
-        return False
+        return ProbeResult(False, error='error')
 
-def check_ip(ip, port, config):
-    """根据配置检测IP"""
-    enable_check = config.getboolean('IP_CHECK', 'ENABLE_IP_CHECK')
-    if not enable_check:
-        return True
-    
-    check_method = config.get('IP_CHECK', 'CHECK_METHOD')
-    timeout = config.getfloat('IP_CHECK', 'CHECK_TIMEOUT')
-    
-    if check_method == 'port':
-        check_port = config.getint('IP_CHECK', 'CHECK_PORT')
-        return check_ip_port(ip, port or check_port, timeout)
-    elif check_method == 'ping':
-        return check_ip_ping(ip, timeout)
-    else:
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+ICMPV6_ECHO_REQUEST = 128
+ICMPV6_ECHO_REPLY = 129
+
+def icmp_checksum(data):
+    """计算ICMP校验和"""
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+class IcmpPinger:
+    """进程内ICMP回显检测：每个地址族一个套接字批量发送请求，按标识符和序列号匹配回复"""
+
+    PAYLOAD = b'ip-processor-ping'
+
+    def __init__(self, sockets):
+        # 地址族 -> (套接字, 是否为原始套接字)
+        self.sockets = sockets
+        self.families = {sock: family for family, (sock, _) in sockets.items()}
+        self.ident = os.getpid() & 0xFFFF
+        for sock, _ in sockets.values():
+            sock.setblocking(False)
+            try:
+                # 加大接收缓冲区，避免大量回复同时到达时被内核丢弃
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            except OSError:
+                pass
+
+    @classmethod
+    def open(cls):
+        """每个地址族优先使用无需特权的ICMP数据报套接字，其次使用原始套接字，都不允许时返回None"""
+        sockets = {}
+        for family, proto in ((socket.AF_INET, socket.IPPROTO_ICMP), (socket.AF_INET6, socket.IPPROTO_ICMPV6)):
+            for sock_type, raw in ((socket.SOCK_DGRAM, False), (socket.SOCK_RAW, True)):
+                try:
+                    sockets[family] = (socket.socket(family, sock_type, proto), raw)
+                    break
+                except OSError:
+                    continue
+        return cls(sockets) if sockets else None
+
+    def close(self):
+        for sock, _ in self.sockets.values():
+            sock.close()
+
+    def build_packet(self, seq, family=socket.AF_INET):
+        """构造回显请求，数据报套接字的标识符会被内核改写为本地端口；ICMPv6校验和由内核计算"""
+        if family == socket.AF_INET6:
+            return struct.pack('!BBHHH', ICMPV6_ECHO_REQUEST, 0, 0, self.ident, seq) + self.PAYLOAD
+        header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, self.ident, seq)
+        checksum = icmp_checksum(header + self.PAYLOAD)
+        return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum, self.ident, seq) + self.PAYLOAD
+
+    def parse_reply(self, packet, family=socket.AF_INET):
+        """解析回显回复，返回序列号，不是本进程的回复时返回None"""
+        raw = self.sockets[family][1]
+        if raw and family == socket.AF_INET:
+            # IPv4原始套接字收到的数据包含IP头，IPv6不包含
+            packet = packet[(packet[0] & 0x0F) * 4:]
+        if len(packet) < 8:
+            return None
+        icmp_type, _, _, ident, seq = struct.unpack('!BBHHH', packet[:8])
+        if icmp_type != (ICMPV6_ECHO_REPLY if family == socket.AF_INET6 else ICMP_ECHO_REPLY):
+            return None
+        # 原始套接字会收到本机所有ICMP回复，需要校验标识符
+        if raw and ident != self.ident:
+            return None
+        return seq
+
+    def ping_stream(self, jobs, timeout, count=1, window=1024, rate=2000, on_result=None, timeout_for=None):
+        """对jobs中的每个 (IP, token) 发送count次回显请求，完成时调用 on_result(token, ProbeResult)
+
+        jobs按需读取，同时在途的请求不超过window个，发送速率不超过每秒rate个，
+        占用的描述符和在途状态与主机数量无关。timeout_for(IP)用于按主机设置超时。
+        """
+        jobs = iter(jobs)
+        count = max(1, count)
+        window = max(1, min(window, 60000))  # 序列号只有16位
+        interval = 1.0 / rate if rate > 0 else 0.0
+
+        active = {}  # 作业编号 -> [IP, token, 待发送次数, 未完成次数, 延迟样本, 超时]
+        sending = collections.deque()  # 还有请求待发送的作业编号
+        in_flight = {}  # 序列号 -> (作业编号, 发送时间)
+        deadlines = []  # (截止时间, 序列号, 发送时间) 的最小堆，各主机的超时可能不同
+        job_id = 0
+        exhausted = False
+        seq = 0
+        next_send = time.perf_counter()
+
+        def finish_attempt(job, rtt=None):
+            state = active[job]
+            if rtt is not None:
+                state[4].append(rtt)
+            state[3] -= 1
+            if state[3] == 0:
+                del active[job]
+                samples = state[4]
+                loss = 1 - len(samples) / count
+                if samples:
+                    result = ProbeResult(True, statistics.median(samples), loss=loss)
+                else:
+                    result = ProbeResult(False, error='timeout', loss=loss)
+                if on_result is not None:
+                    on_result(state[1], result)
+
+        while True:
+            now = time.perf_counter()
+
+            # 发送：同一主机的多次请求连续发送，需要时才读取下一个作业
+            while len(in_flight) < window and now >= next_send:
+                if not sending:
+                    job = None if exhausted else next(jobs, None)
+                    if job is None:
+                        exhausted = True
+                        break
+                    job_id += 1
+                    job_timeout = timeout_for(job[0]) if timeout_for is not None else timeout
+                    active[job_id] = [job[0], job[1], count, count, [], job_timeout]
+                    sending.append(job_id)
+                current = sending[0]
+                state = active[current]
+                seq = (seq + 1) & 0xFFFF
+                while seq in in_flight:
+                    seq = (seq + 1) & 0xFFFF
+                family = address_family(state[0])
+                try:
+                    if family not in self.sockets:
+                        # 当前环境不允许该地址族的ICMP套接字，记为丢包
+                        raise OSError(errno.EAFNOSUPPORT, "ICMP socket unavailable")
+                    self.sockets[family][0].sendto(self.build_packet(seq, family), (state[0], 0))
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError as e:
+                    if e.errno == errno.ENOBUFS:
+                        break
+                    # 网络不可达等错误直接记为丢包
+                    state[2] -= 1
+                    if state[2] == 0:
+                        sending.popleft()
+                    finish_attempt(current)
+                    continue
+                state[2] -= 1
+                if state[2] == 0:
+                    sending.popleft()
+                in_flight[seq] = (current, now)
+                heapq.heappush(deadlines, (now + state[5], seq, now))
+                # 落后太多时不补发，避免突发流量
+                next_send = max(next_send + interval, now - 0.05)
+
+            if exhausted and not sending and not in_flight:
+                break
+
+            # 等待回复，直到最早的请求超时或可以继续发送
+            wait = deadlines[0][0] - now if deadlines else timeout
+            if len(in_flight) < window and not (exhausted and not sending):
+                wait = min(wait, next_send - now)
+            readable, _, _ = select.select(list(self.families), [], [], max(0.0, wait))
+
+            for sock in readable:
+                family = self.families[sock]
+                while True:
+                    try:
+                        packet, addr = sock.recvfrom(2048)
+                    except OSError:
+                        break
+                    reply_seq = self.parse_reply(packet, family)
+                    entry = in_flight.get(reply_seq)
+                    if entry is None or active[entry[0]][0] != addr[0]:
+                        continue
+                    del in_flight[reply_seq]
+                    finish_attempt(entry[0], (time.perf_counter() - entry[1]) * 1000)
+
+            # 超时的请求记为丢包
+            now = time.perf_counter()
+            while deadlines and deadlines[0][0] <= now:
+                _, expired_seq, sent_at = heapq.heappop(deadlines)
+                entry = in_flight.get(expired_seq)
+                if entry is not None and entry[1] == sent_at:
+                    del in_flight[expired_seq]
+                    finish_attempt(entry[0])
+
+def open_icmp_pinger(settings):
+    """按配置打开原生ICMP引擎，不使用或ICMP套接字不可用时返回None以回退到ping命令"""
+    if settings.icmp_mode == 'subprocess':
+        return None
+
+    pinger = IcmpPinger.open()
+    if pinger is None:
+        logger.warning("当前环境不允许创建ICMP套接字，回退到ping命令检测")
+        return None
+    kinds = [f"{'IPv6' if family == socket.AF_INET6 else 'IPv4'} {'原始' if raw else '数据报'}套接字"
+             for family, (_, raw) in pinger.sockets.items()]
+    logger.info(f"使用原生ICMP引擎检测 ({', '.join(kinds)})")
+    return pinger
+
+class HttpProbeOptions:
+    """tls/http检测参数，每次批量检测只解析一次配置"""
+
+    def __init__(self, config):
+        section = config['IP_CHECK']
+        self.host = section.get('HTTP_HOST').strip()
+        self.sni = section.get('TLS_SNI').strip() or self.host
+        self.path = section.get('HTTP_PATH').strip() or '/'
+        self.method = section.get('HTTP_METHOD').strip().upper() or 'HEAD'
+        self.expect_status = {int(code) for code in section.get('HTTP_EXPECT_STATUS').split(',') if code.strip()}
+        self.colos = {colo.strip().upper() for colo in section.get('HTTP_COLOS').split(',') if colo.strip()}
+
+        self.ssl_context = ssl.create_default_context()
+        if not section.getboolean('TLS_VERIFY'):
+            # 检测的是边缘节点而非证书，默认不校验证书以免误判
+            self.ssl_context.check_hostname = False
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+
+        self.request = (
+            f"{self.method} {self.path} HTTP/1.1\r\n"
+            f"Host: {self.host}\r\n"
+            "User-Agent: ip-processor\r\n"
+            "Accept: */*\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode('ascii')
+
+    def fingerprint(self):
+        """影响检测结果的参数摘要，用作缓存键的一部分"""
+        parts = [self.sni, self.host, self.path, self.method,
+                 ','.join(map(str, sorted(self.expect_status))), ','.join(sorted(self.colos)),
+                 str(self.ssl_context.verify_mode)]
+        return f"{zlib.crc32('|'.join(parts).encode('utf-8')):08x}"
+
+    def use_tls(self, port, check_method):
+        """tls检测总是握手；http检测在Cloudflare明文端口上使用HTTP"""
+        return check_method == 'tls' or port not in CF_HTTP_PORTS
+
+def parse_http_head(head):
+    """解析HTTP响应头，返回(状态码, cf-ray中的数据中心代码)"""
+    lines = head.decode('latin-1').split('\r\n')
+    status_parts = lines[0].split()
+    if len(status_parts) < 2 or not status_parts[1].isdigit():
+        return None, None
+
+    colo = None
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        if name.strip().lower() == 'cf-ray':
+            # cf-ray格式: 8a1b2c3d4e5f6789-HKG
+            colo = value.strip().rsplit('-', 1)[-1].upper() or None
+            break
+    return int(status_parts[1]), colo
+
+def http_result(head, connect_ms, tls_ms, ttfb_ms, options):
+    """根据响应头和配置的状态码/数据中心要求生成检测结果"""
+    status, colo = parse_http_head(head)
+    phases = dict(connect_ms=connect_ms, tls_ms=tls_ms, ttfb_ms=ttfb_ms, status=status, colo=colo)
+    if status is None:
+        return ProbeResult(False, error='http', **phases)
+    if options.expect_status and status not in options.expect_status:
+        return ProbeResult(False, error='status', **phases)
+    if options.colos and colo not in options.colos:
+        return ProbeResult(False, error='colo', **phases)
+    return ProbeResult(True, connect_ms + (tls_ms or 0) + ttfb_ms, **phases)
+
+def check_ip_tls(ip, port, timeout, options, check_method='tls'):
+    """TLS握手/HTTP请求检测，记录连接、握手、首字节各阶段耗时"""
+    deadline = time.perf_counter() + timeout
+
+    def remaining():
+        return max(0.001, deadline - time.perf_counter())
+
+    sock = None
+    connect_ms = tls_ms = None
+    try:
+        sock = socket.socket(address_family(ip), socket.SOCK_STREAM)
+        sock.settimeout(remaining())
+        start = time.perf_counter()
+        sock.connect((ip, port))
+        connect_ms = (time.perf_counter() - start) * 1000
+
+        if options.use_tls(port, check_method):
+            sock.settimeout(remaining())
+            start = time.perf_counter()
+            sock = options.ssl_context.wrap_socket(sock, server_hostname=options.sni or None)
+            tls_ms = (time.perf_counter() - start) * 1000
+            if check_method == 'tls':
+                return ProbeResult(True, connect_ms + tls_ms, connect_ms=connect_ms, tls_ms=tls_ms)
+
+        sock.settimeout(remaining())
+        start = time.perf_counter()
+        sock.sendall(options.request)
+        head = sock.recv(4096)
+        if not head:
+            return ProbeResult(False, error='http', connect_ms=connect_ms, tls_ms=tls_ms)
+        ttfb_ms = (time.perf_counter() - start) * 1000
+        while b'\r\n\r\n' not in head and len(head) < 16384:
+            sock.settimeout(remaining())
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            head += chunk
+        return http_result(head, connect_ms, tls_ms, ttfb_ms, options)
+    except socket.timeout:
+        return ProbeResult(False, error='timeout', connect_ms=connect_ms, tls_ms=tls_ms)
+    except ssl.SSLError:
+        return ProbeResult(False, error='tls', connect_ms=connect_ms)
+    except OSError as e:
+        error = classify_errno(e.errno) if connect_ms is None else 'http'
+        return ProbeResult(False, error=error, connect_ms=connect_ms, tls_ms=tls_ms)
+    finally:
+        if sock is not None:
+            sock.close()
+
+def probe_ip(ip, port, check_method, timeout, attempts=1, options=None):
+    """按检测方法检测IP，多次尝试时取延迟中位数（port为已确定的检测端口）"""
+    results = []
+    for _ in range(max(1, attempts)):
+        if check_method == 'port':
+            result = check_ip_port(ip, port, timeout)
+        elif check_method in ('tls', 'http'):
+            result = check_ip_tls(ip, port, timeout, options, check_method)
+        else:
+            result = check_ip_ping(ip, timeout)
+        results.append(result)
+        if not result:
+            break
+    return median_rtt(results)
+
+def get_check_method(config):
+    """读取检测方法，未知方法回退到ping"""
+    check_method = config.get('IP_CHECK', 'CHECK_METHOD').strip().lower()
+    if check_method not in CHECK_METHODS:
         logger.warning(f"未知的检测方法: {check_method}, 默认使用ping检测")
-        return check_ip_ping(ip, timeout)
+        return 'ping'
+    return check_method
+
+def check_ip(ip, port, settings):
+    """检测单个IP，port为0或None时使用CHECK_PORT
+
+    settings为CheckSettings；传入configparser配置时由check_settings_for解析，
+    同一配置对象只解析一次。
+    """
+    if not isinstance(settings, CheckSettings):
+        settings = check_settings_for(settings)
+    if not settings.enabled:
+        return ProbeResult(True)
+    return probe_ip(ip, port or settings.check_port, settings.method, settings.timeout,
+                    settings.attempts, settings.options)
+
+async def async_connect(sock, address, timeout):
+    """在非阻塞套接字上发起connect，返回错误码（0表示成功，超时返回ETIMEDOUT）
+
+    直接注册可写回调和超时定时器，不为每次连接额外创建任务，也不重复解析地址。
+    Windows的Proactor事件循环不支持add_writer，退回loop.sock_connect。
+    """
+    loop = asyncio.get_running_loop()
+    if sys.platform == 'win32':
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, address), timeout)
+            return 0
+        except asyncio.TimeoutError:
+            return errno.ETIMEDOUT
+        except OSError as e:
+            return e.errno or errno.ECONNREFUSED
+
+    code = sock.connect_ex(address)
+    if code not in (errno.EINPROGRESS, errno.EAGAIN, errno.EWOULDBLOCK):
+        return code
+
+    fd = sock.fileno()
+    future = loop.create_future()
+
+    def on_writable():
+        loop.remove_writer(fd)
+        timer.cancel()
+        if not future.done():
+            future.set_result(sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR))
+
+    def on_timeout():
+        loop.remove_writer(fd)
+        if not future.done():
+            future.set_result(errno.ETIMEDOUT)
+
+    loop.add_writer(fd, on_writable)
+    timer = loop.call_later(timeout, on_timeout)
+    try:
+        return await future
+    finally:
+        # 任务被取消时也要清理回调，避免套接字关闭后仍被监听
+        if not future.done():
+            loop.remove_writer(fd)
+            timer.cancel()
+
+async def async_check_ip_port(ip, port, timeout):
+    """异步检测IP端口是否开放（非阻塞connect），返回带连接延迟的检测结果"""
+    sock = None
+    try:
+        sock = socket.socket(address_family(ip), socket.SOCK_STREAM)
+        sock.setblocking(False)
+        start = time.perf_counter()
+        code = await async_connect(sock, (ip, port), timeout)
+        if code == 0:
+            return ProbeResult(True, (time.perf_counter() - start) * 1000)
+        return ProbeResult(False, error=classify_errno(code))
+    except OSError as e:
+        return ProbeResult(False, error=classify_errno(e.errno))
+    finally:
+        if sock is not None:
+            sock.close()
+
+async def async_check_ip_ping(ip, timeout):
+    """异步检测IP是否可ping通，返回带延迟的检测结果"""
+    command = ping_command(ip, timeout)
+
+    try:
+        start = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+        stdout, _ = await process.communicate()
+        if process.returncode == 0:
+            output = stdout.decode('utf-8', errors='ignore')
+            return ProbeResult(True, parse_ping_rtt(output, time.perf_counter() - start))
+        return ProbeResult(False, error='timeout')
+    except Exception:
+        return ProbeResult(False, error='error')
+
+async def async_check_ip_tls(ip, port, timeout, options, check_method='tls'):
+    """异步TLS握手/HTTP请求检测，记录连接、握手、首字节各阶段耗时"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    def remaining():
+        return max(0.001, deadline - loop.time())
+
+    sock = None
+    writer = None
+    connect_ms = tls_ms = None
+    try:
+        sock = socket.socket(address_family(ip), socket.SOCK_STREAM)
+        sock.setblocking(False)
+        start = time.perf_counter()
+        code = await async_connect(sock, (ip, port), remaining())
+        if code != 0:
+            return ProbeResult(False, error=classify_errno(code))
+        connect_ms = (time.perf_counter() - start) * 1000
+
+        if options.use_tls(port, check_method):
+            start = time.perf_counter()
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(sock=sock, ssl=options.ssl_context,
+                                        server_hostname=options.sni or None),
+                remaining())
+            tls_ms = (time.perf_counter() - start) * 1000
+            if check_method == 'tls':
+                return ProbeResult(True, connect_ms + tls_ms, connect_ms=connect_ms, tls_ms=tls_ms)
+        else:
+            reader, writer = await asyncio.open_connection(sock=sock)
+
+        start = time.perf_counter()
+        writer.write(options.request)
+        first = await asyncio.wait_for(reader.read(1), remaining())
+        if not first:
+            return ProbeResult(False, error='http', connect_ms=connect_ms, tls_ms=tls_ms)
+        ttfb_ms = (time.perf_counter() - start) * 1000
+        try:
+            head = first + await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), remaining())
+        except asyncio.IncompleteReadError as e:
+            head = first + e.partial
+        except asyncio.LimitOverrunError:
+            head = first + await reader.read(16384)
+        return http_result(head, connect_ms, tls_ms, ttfb_ms, options)
+    except asyncio.TimeoutError:
+        return ProbeResult(False, error='timeout', connect_ms=connect_ms, tls_ms=tls_ms)
+    except ssl.SSLError:
+        return ProbeResult(False, error='tls', connect_ms=connect_ms)
+    except OSError as e:
+        error = classify_errno(e.errno) if connect_ms is None else 'http'
+        return ProbeResult(False, error=error, connect_ms=connect_ms, tls_ms=tls_ms)
+    finally:
+        if writer is not None:
+            # 直接中断连接，不等待TLS close_notify
+            writer.transport.abort()
+        if sock is not None:
+            sock.close()
+
+async def async_check_ip(ip, port, check_method, timeout, attempts=1, options=None):
+    """根据检测方法异步检测IP，多次尝试时取延迟中位数（port为已确定的检测端口）"""
+    results = []
+    for _ in range(max(1, attempts)):
+        if check_method == 'port':
+            result = await async_check_ip_port(ip, port, timeout)
+        elif check_method in ('tls', 'http'):
+            result = await async_check_ip_tls(ip, port, timeout, options, check_method)
+        else:
+            result = await async_check_ip_ping(ip, timeout)
+        results.append(result)
+        if not result:
+            break
+    return median_rtt(results)
+
+def raise_nofile_limit(wanted):
+    """尽量提高文件描述符上限，返回可用于并发检测的数量"""
+    try:
+        import resource
+    except ImportError:
+        # Windows没有RLIMIT_NOFILE，直接使用配置值
+        return wanted
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    # 预留一部分描述符给日志、输入输出文件等
+    reserve = 64
+    if soft < wanted + reserve:
+        new_soft = wanted + reserve if hard == resource.RLIM_INFINITY else min(wanted + reserve, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+            soft = new_soft
+        except (ValueError, OSError) as e:
+            logger.warning(f"无法提高文件描述符上限: {e}")
+    return max(1, min(wanted, soft - reserve))
+
+class CheckSettings:
+    """批量检测参数，每次运行只从配置解析一次
+
+    自适应超时的统计保存在timeouts中，同一次运行的各文件、各轮检测共用一个CheckSettings。
+    """
+
+    def __init__(self, config):
+        self.enabled = config.getboolean('IP_CHECK', 'ENABLE_IP_CHECK')
+        self.method = get_check_method(config)
+        self.engine = config.get('IP_CHECK', 'CHECK_ENGINE').strip().lower()
+        if self.engine not in ('thread', 'asyncio'):
+            logger.warning(f"未知的检测引擎: {self.engine}, 默认使用thread引擎")
+            self.engine = 'thread'
+        self.check_port = config.getint('IP_CHECK', 'CHECK_PORT')
+        self.timeout = config.getfloat('IP_CHECK', 'CHECK_TIMEOUT')
+        self.attempts = config.getint('IP_CHECK', 'CHECK_ATTEMPTS')
+        self.threads = config.getint('IP_CHECK', 'CHECK_THREADS')
+        self.concurrency = config.getint('IP_CHECK', 'CHECK_CONCURRENCY')
+        self.icmp_mode = config.get('IP_CHECK', 'ICMP_MODE').strip().lower()
+        self.icmp_window = config.getint('IP_CHECK', 'ICMP_WINDOW')
+        self.icmp_rate = config.getfloat('IP_CHECK', 'ICMP_RATE')
+        self.options = HttpProbeOptions(config) if self.method in ('tls', 'http') else None
+        # tls/http的检测结果与SNI、Host、状态码等参数有关，参数变化后不复用旧缓存
+        self.cache_variant = self.options.fingerprint() if self.options is not None else ''
+        self.timeouts = AdaptiveTimeout(config, self.timeout)
+
+# check_ip传入configparser配置时复用的解析结果 (配置对象, CheckSettings)
+_last_check_settings = (None, None)
+
+def check_settings_for(config):
+    """返回config对应的CheckSettings，同一配置对象只解析一次；之后修改配置需自行创建CheckSettings"""
+    global _last_check_settings
+    cached_config, settings = _last_check_settings
+    if cached_config is not config:
+        settings = CheckSettings(config)
+        _last_check_settings = (config, settings)
+    return settings
+
+def percentile(samples, pct):
+    """最近秩法百分位数，samples不能为空"""
+    ordered = sorted(samples)
+    index = math.ceil(pct / 100 * len(ordered)) - 1
+    return ordered[min(len(ordered) - 1, max(0, index))]
+
+def subnet_key(ip):
+    """IP所在的/24（IPv6为/64）网段，用于按网段统计检测结果"""
+    if ':' in ip:
+        try:
+            return socket.inet_pton(socket.AF_INET6, ip)[:8]
+        except OSError:
+            return ip
+    return ip.rpartition('.')[0]
+
+class AdaptiveTimeout:
+    """按成功检测的延迟分布调整每个检测的超时，并推迟连续失败网段中的检测
+
+    大部分候选IP不可达，总耗时主要花在等待超时上。超时取全局和所在网段延迟的
+    高百分位乘以倍数，二者取较大值，限制在 [TIMEOUT_FLOOR, CHECK_TIMEOUT] 之间；
+    较慢网段有了自己的成功样本后超时随之放宽。成功样本不足时仍使用CHECK_TIMEOUT。
+    在缩短的超时内未响应的主机可能只是较慢，这类失败不写入检测缓存，下次运行重新检测。
+    所有回调都在检测引擎的调度线程中执行，不需要加锁。
+    """
+
+    GLOBAL_WINDOW = 1000  # 全局保留最近的成功延迟样本数
+    SUBNET_WINDOW = 16  # 每个网段保留的样本数
+    REFRESH_EVERY = 32  # 每新增多少个样本重新计算全局超时
+    DEFER_LIMIT = 50000  # 最多推迟的检测数，超出后按推迟顺序放行，内存占用不随输入增长
+
+    def __init__(self, config, ceiling):
+        section = config['IP_CHECK']
+        self.enabled = section.getboolean('ADAPTIVE_TIMEOUT')
+        self.ceiling = ceiling
+        # 低于MAX_LATENCY的主机会被保留，超时不能比它更短
+        floor = max(section.getfloat('TIMEOUT_FLOOR'), section.getfloat('MAX_LATENCY') / 1000)
+        self.floor = min(ceiling, max(0.0, floor))
+        self.pct = min(100.0, max(1.0, section.getfloat('TIMEOUT_PERCENTILE')))
+        self.multiplier = max(1.0, section.getfloat('TIMEOUT_MULTIPLIER'))
+        self.min_samples = max(1, section.getint('TIMEOUT_MIN_SAMPLES'))
+        self.deprioritize_after = max(0, section.getint('DEPRIORITIZE_AFTER'))
+        self.rtts = collections.deque(maxlen=self.GLOBAL_WINDOW)
+        self.subnet_rtts = {}  # 网段 -> 最近的成功延迟
+        self.failures = {}  # 网段 -> 连续失败次数，成功后清除
+        self.global_timeout = ceiling
+        self.fresh = 0
+        self.deferred = 0
+        self.shortened = collections.Counter()  # IP -> 使用缩短的超时、尚未返回结果的检测数
+        self.uncached = 0
+
+    def clamp(self, rtts):
+        return min(self.ceiling, max(self.floor, percentile(rtts, self.pct) * self.multiplier / 1000))
+
+    def timeout_for(self, ip):
+        """返回检测该IP使用的超时（秒）"""
+        if not self.enabled or len(self.rtts) < self.min_samples:
+            return self.ceiling
+        rtts = self.subnet_rtts.get(subnet_key(ip))
+        timeout = self.global_timeout if rtts is None else max(self.global_timeout, self.clamp(rtts))
+        if timeout < self.ceiling:
+            self.shortened[ip] += 1
+        return timeout
+
+    def observe(self, ip, result):
+        """记录一次检测结果"""
+        if ip in self.shortened:
+            self.shortened[ip] -= 1
+            if not self.shortened[ip]:
+                del self.shortened[ip]
+            if not result and result.error == 'timeout':
+                result.cacheable = False
+                self.uncached += 1
+        key = subnet_key(ip)
+        if not result:
+            if self.deprioritize_after:
+                self.failures[key] = self.failures.get(key, 0) + 1
+            return
+        self.failures.pop(key, None)
+        if result.rtt is None:
+            return
+        self.rtts.append(result.rtt)
+        rtts = self.subnet_rtts.get(key)
+        if rtts is None:
+            rtts = self.subnet_rtts[key] = collections.deque(maxlen=self.SUBNET_WINDOW)
+        rtts.append(result.rtt)
+        self.fresh += 1
+        if self.fresh >= self.REFRESH_EVERY or len(self.rtts) == self.min_samples:
+            self.fresh = 0
+            self.global_timeout = self.clamp(self.rtts)
+
+    def schedule(self, jobs):
+        """按顺序读取 (ip, 端口, token)，连续失败的网段中的检测推迟到其余检测之后"""
+        deferred = collections.deque()
+        for job in jobs:
+            if self.failures.get(subnet_key(job[0]), 0) >= self.deprioritize_after:
+                deferred.append(job)
+                self.deferred += 1
+                if len(deferred) > self.DEFER_LIMIT:
+                    yield deferred.popleft()
+                continue
+            yield job
+        while deferred:
+            yield deferred.popleft()
+
+    def wrap(self, jobs, on_result):
+        """包装jobs和结果回调，使每个检测结果都能反馈到超时统计"""
+        if not self.enabled:
+            return jobs, on_result
+        if self.deprioritize_after:
+            jobs = self.schedule(jobs)
+
+        def observed(token, result):
+            self.observe(token[0], result)
+            on_result(token[1], result)
+
+        return ((ip, port, (ip, token)) for ip, port, token in jobs), observed
+
+    def log_summary(self):
+        if not self.enabled or len(self.rtts) < self.min_samples:
+            return
+        logger.info(f"自适应超时: 延迟P{self.pct:g} {percentile(self.rtts, self.pct):.1f}ms, "
+                    f"全局超时 {self.global_timeout:.2f}秒 (上限 {self.ceiling:g}秒)")
+        if self.deferred:
+            metrics.inc('probe_deferred_total', self.deferred)
+            logger.info(f"自适应超时: {self.deferred} 个检测因所在网段连续失败被推迟")
+        if self.uncached:
+            logger.info(f"自适应超时: {self.uncached} 个在缩短的超时内未响应，不写入缓存")
+        # 延迟统计在各次检测间保留，计数只汇报本次检测的
+        self.deferred = self.uncached = 0
+
+async def stream_async_checks(jobs, settings, concurrency, on_result):
+    """asyncio检测引擎：按需读取jobs，最多同时保持concurrency个检测"""
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = set()
+
+    async def probe(ip, port, token):
+        try:
+            result = await async_check_ip(ip, port, settings.method, settings.timeouts.timeout_for(ip),
+                                          settings.attempts, settings.options)
+        finally:
+            semaphore.release()
+        on_result(token, result)
+
+    # 先获取信号量再读取下一个条目，保证同时存在的任务数不超过并发上限
+    for ip, port, token in jobs:
+        await semaphore.acquire()
+        task = asyncio.create_task(probe(ip, port, token))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if tasks:
+        await asyncio.gather(*tasks)
+
+def parse_ip_port(item, default_port):
+    """从 "ip:端口#标签" / "[IPv6]:端口#标签" 或 "ip#标签" 格式的条目中解析IP和端口"""
+    candidate = Candidate.parse(item)
+    if candidate is None:
+        # 无法解析的条目原样交给检测，结果记为失败
+        return item.split('#')[0].strip(), default_port
+    return candidate.endpoint(default_port)
+
+def stream_thread_checks(jobs, settings, on_result):
+    """线程池检测引擎：按需读取jobs，提交但未完成的检测不超过线程数的两倍"""
+    window = settings.threads * 2
+    jobs = iter(jobs)
+    pending = {}
+    exhausted = False
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=settings.threads) as executor:
+        while True:
+            while not exhausted and len(pending) < window:
+                job = next(jobs, None)
+                if job is None:
+                    exhausted = True
+                    break
+                ip, port, token = job
+                future = executor.submit(probe_ip, ip, port, settings.method, settings.timeouts.timeout_for(ip),
+                                         settings.attempts, settings.options)
+                pending[future] = token
+            if not pending:
+                break
+
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                on_result(pending.pop(future), future.result())
+
+class ProbeCache:
+    """检测结果的SQLite缓存，键为 ip:端口:检测方法，成功/失败结果分别设置有效期"""
+
+    def __init__(self, path, positive_ttl, negative_ttl, max_entries):
+        self.path = path
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS probes ("
+            "key TEXT PRIMARY KEY, ok INTEGER NOT NULL, rtt REAL, error TEXT, checked_at REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS probes_checked_at ON probes (checked_at)")
+        self.conn.commit()
+
+    @classmethod
+    def from_config(cls, config):
+        """根据配置创建缓存，未启用或无法打开时返回None"""
+        if not config.getboolean('CACHE', 'ENABLE'):
+            return None
+        path = config.get('CACHE', 'CACHE_FILE')
+        try:
+            return cls(path,
+                       config.getfloat('CACHE', 'POSITIVE_TTL'),
+                       config.getfloat('CACHE', 'NEGATIVE_TTL'),
+                       config.getint('CACHE', 'MAX_ENTRIES'))
+        except sqlite3.Error as e:
+            logger.warning(f"无法打开检测缓存 {path}: {e}")
+            return None
+
+    @staticmethod
+    def make_key(ip, port, check_method, variant=''):
+        """ping检测与端口无关，端口记为0；variant为检测参数摘要"""
+        key = f"{ip}:{0 if check_method == 'ping' else port}:{check_method}"
+        return f"{key}:{variant}" if variant else key
+
+    def lookup(self, keys):
+        """批量查询未过期的缓存结果，返回 {键: ProbeResult}"""
+        now = time.time()
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        # SQLite对单条语句的参数个数有限制，分批查询
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT key, ok, rtt, error, checked_at FROM probes WHERE key IN ({placeholders})", chunk)
+            for key, ok, rtt, error, checked_at in rows:
+                ttl = self.positive_ttl if ok else self.negative_ttl
+                if now - checked_at <= ttl:
+                    found[key] = ProbeResult(bool(ok), rtt, error)
+        return found
+
+    def store(self, items):
+        """写入 [(键, ProbeResult)]"""
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO probes (key, ok, rtt, error, checked_at) VALUES (?, ?, ?, ?, ?)",
+                ((key, int(result.ok), result.rtt, result.error, now) for key, result in items))
+
+    def evict(self):
+        """超出容量时淘汰最早的记录"""
+        if self.max_entries <= 0:
+            return
+        with self.conn:
+            count = self.conn.execute("SELECT COUNT(*) FROM probes").fetchone()[0]
+            if count > self.max_entries:
+                self.conn.execute(
+                    "DELETE FROM probes WHERE key IN (SELECT key FROM probes ORDER BY checked_at LIMIT ?)",
+                    (count - self.max_entries,))
+                logger.info(f"检测缓存淘汰 {count - self.max_entries} 条最旧记录")
+
+    def filter_jobs(self, jobs, check_method, on_hit, variant='', batch_size=512):
+        """流式过滤检测任务：分批查询缓存，命中的直接回调 on_hit(token, 结果)，
+        未命中的以 (ip, 端口, (缓存键, token)) 的形式继续交给检测引擎"""
+        jobs = iter(jobs)
+        while True:
+            batch = list(itertools.islice(jobs, batch_size))
+            if not batch:
+                return
+            keys = [self.make_key(ip, port, check_method, variant) for ip, port, _ in batch]
+            found = self.lookup(keys)
+            for (ip, port, token), key in zip(batch, keys):
+                if key in found:
+                    self.hits += 1
+                    on_hit(token, found[key])
+                else:
+                    self.misses += 1
+                    yield ip, port, (key, token)
+
+    def recorder(self, on_result, batch_size=512):
+        """包装检测结果回调：结果先回调，再按批写入缓存"""
+        buffer = []
+
+        def record(keyed_token, result):
+            key, token = keyed_token
+            if result.cacheable:
+                buffer.append((key, result))
+            if len(buffer) >= batch_size:
+                self.store(buffer)
+                buffer.clear()
+            on_result(token, result)
+
+        def flush():
+            if buffer:
+                self.store(buffer)
+                buffer.clear()
+
+        return record, flush
+
+    def close(self):
+        self.conn.close()
+
+class ProbeIndex:
+    """整次运行共享的检测索引：每个端点只检测一次，结果分发给所有引用它的文件和标签"""
+
+    def __init__(self, config):
+        # ping检测与端口无关，只按IP去重
+        self.ip_only = get_check_method(config) == 'ping'
+        self.check_port = config.getint('IP_CHECK', 'CHECK_PORT')
+        self.passed = {}  # 去重键 -> 检测通过的ProbeResult
+        self.failed = {}  # 去重键 -> 失败原因，失败结果不必保留完整对象
+        self.pending = {}  # 去重键 -> 等待检测结果的token列表
+        self.references = 0
+        self.probed = 0
+
+    def key_for(self, candidate):
+        if self.ip_only:
+            return candidate.ip
+        return (candidate.ip << 16) | (candidate.port or self.check_port)
+
+    def lookup(self, key):
+        result = self.passed.get(key)
+        if result is None and key in self.failed:
+            result = ProbeResult(False, error=self.failed[key])
+        return result
+
+    def route(self, candidates, on_result):
+        """candidates为 (Candidate, token)，已有结果的直接回调 on_result(token, 结果)，
+        正在检测的加入等待列表，其余以 (ip, 端口, 去重键) 的形式交给检测引擎"""
+        for candidate, token in candidates:
+            self.references += 1
+            key = self.key_for(candidate)
+            result = self.lookup(key)
+            if result is not None:
+                on_result(token, result)
+            elif key in self.pending:
+                self.pending[key].append(token)
+            else:
+                self.pending[key] = [token]
+                self.probed += 1
+                ip, port = candidate.endpoint(self.check_port)
+                yield ip, port, key
+
+    def resolve(self, key, result):
+        """记录检测结果，返回所有等待该结果的token"""
+        if result:
+            self.passed[key] = result
+        else:
+            self.failed[key] = sys.intern(result.error or 'error')
+        return self.pending.pop(key)
+
+    def probe(self, candidates, config, on_result, desc="检测IP可用性", use_cache=True, settings=None):
+        """检测 (Candidate, token)，每个token的结果通过 on_result(token, ProbeResult) 返回"""
+        def fan_out(key, result):
+            for token in self.resolve(key, result):
+                on_result(token, result)
+
+        probe_stream(self.route(candidates, on_result), config, fan_out, desc=desc, use_cache=use_cache,
+                     settings=settings)
+
+    def log_summary(self):
+        saved = self.references - self.probed
+        metrics.inc('probe_endpoints_total', self.probed)
+        if saved:
+            logger.info(f"检测去重: 共 {self.references} 个引用, 实际检测 {self.probed} 个端点, 节省 {saved} 次检测")
+
+def probe_stream(jobs, config, on_result, total=None, desc="检测IP可用性", use_cache=True, settings=None):
+    """流式检测：jobs为 (ip, 端口, token) 的可迭代对象，每个结果通过 on_result(token, ProbeResult) 返回
+
+    检测引擎按需从jobs读取条目，读入第一批后立即开始检测；同时在途的检测数量
+    受引擎窗口限制，内存占用不随输入规模增长。use_cache为False时不读取缓存，
+    但检测结果仍会写入缓存。settings为已解析的CheckSettings，为None时从config解析。
+    """
+    from tqdm import tqdm
+    if settings is None:
+        settings = CheckSettings(config)
+    logger.info(f"开始检测IP可用性 (方法: {settings.method}, 引擎: {settings.engine})")
+
+    with tqdm(total=total, desc=desc, unit='IP') as pbar:
+        def emit(token, result):
+            pbar.update(1)
+            on_result(token, result)
+
+        # 只检测缓存未命中或已过期的IP
+        cache = ProbeCache.from_config(config)
+        flush = None
+        probe_callback = emit
+        if cache is not None:
+            if use_cache:
+                jobs = cache.filter_jobs(jobs, settings.method, emit, settings.cache_variant)
+            else:
+                jobs = ((ip, port, (cache.make_key(ip, port, settings.method, settings.cache_variant), token))
+                        for ip, port, token in jobs)
+            probe_callback, flush = cache.recorder(emit)
+        # 缓存命中的IP不经过检测引擎，只有实际检测的结果参与超时统计
+        jobs, probe_callback = settings.timeouts.wrap(jobs, probe_callback)
+
+        try:
+            pinger = open_icmp_pinger(settings) if settings.method == 'ping' else None
+            if pinger is not None:
+                try:
+                    pinger.ping_stream(((ip, token) for ip, _, token in jobs), settings.timeout,
+                                       settings.attempts, settings.icmp_window, settings.icmp_rate,
+                                       probe_callback, settings.timeouts.timeout_for)
+                finally:
+                    pinger.close()
+            elif settings.engine == 'asyncio':
+                concurrency = raise_nofile_limit(settings.concurrency)
+                logger.info(f"asyncio引擎并发数: {concurrency}")
+                asyncio.run(stream_async_checks(jobs, settings, concurrency, probe_callback))
+            else:
+                stream_thread_checks(jobs, settings, probe_callback)
+        finally:
+            if cache is not None:
+                try:
+                    flush()
+                    cache.evict()
+                except sqlite3.Error as e:
+                    logger.warning(f"写入检测缓存失败: {e}")
+                finally:
+                    cache.close()
+
+    if cache is not None and use_cache:
+        logger.info(f"检测缓存命中 {cache.hits} 个, 实际检测 {cache.misses} 个")
+        metrics.inc('probe_cache_hits_total', cache.hits)
+        metrics.inc('probe_cache_misses_total', cache.misses)
+    settings.timeouts.log_summary()
 
 def check_ips(ip_list, config):
-    """批量检测IP可用性"""
+    """批量检测IP可用性，按输入顺序返回ProbeResult列表（可当作布尔值使用）"""
     enable_check = config.getboolean('IP_CHECK', 'ENABLE_IP_CHECK')
     if not enable_check:
         logger.info("IP检测已禁用，跳过检测")
-        return [True] * len(ip_list)
-    
-    check_method = config.get('IP_CHECK', 'CHECK_METHOD')
-    threads = config.getint('IP_CHECK', 'CHECK_THREADS')
-    
-    logger.info(f"开始检测 {len(ip_list)} 个IP的可用性 (方法: {check_method})")
-    
-    valid_results = []
-    lock = threading.Lock()
-    
-    def check_and_record(ip_info):
-        ip = ip_info['ip']
-        port = ip_info.get('port')
-        result = check_ip(ip, port, config)
-        with lock:
-            valid_results.append((ip_info, result))
-    
-    # 准备IP信息列表
-    ip_infos = []
-    for item in ip_list:
-        if ':' in item:
-            # 处理IP:端口格式
-            ip_part, rest = item.split(':', 1)
-            ip = ip_part
-            port = int(rest.split('#')[0]) if '#' in rest else config.getint('IP_CHECK', 'CHECK_PORT')
-        else:
-            # 处理纯IP格式
-            ip = item.split('#')[0]
-            port = config.getint('IP_CHECK', 'CHECK_PORT')
-        
-        ip_infos.append({'ip': ip, 'port': port, 'original': item})
-    
-    # 多线程检测
-    with tqdm(total=len(ip_infos), desc="检测IP可用性") as pbar:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
-            futures = {executor.submit(check_and_record, ip_info): ip_info for ip_info in ip_infos}
-            
-            for future in concurrent.futures.as_completed(futures):
-                pbar.update(1)
-    
-    # 按原始顺序返回结果
-    result_map = {info['original']: result for info, result in valid_results}
-    return [result_map.get(item, False) for item in ip_list]
+        return [ProbeResult(True)] * len(ip_list)
 
-def extract_ips_from_txt(file_path, filename_without_ext):
-    """从txt文件中提取IP地址"""
-    results = []
+    check_port = config.getint('IP_CHECK', 'CHECK_PORT')
+    results = [None] * len(ip_list)
+
+    def jobs():
+        for index, item in enumerate(ip_list):
+            ip, port = parse_ip_port(item, check_port)
+            yield ip, port, index
+
+    def on_result(index, result):
+        results[index] = result
+
+    probe_stream(jobs(), config, on_result, total=len(ip_list))
+    return results
+
+def log_phase_summary(probes):
+    """输出tls/http检测各阶段耗时的中位数"""
+    phases = [('连接', 'connect_ms'), ('TLS握手', 'tls_ms'), ('首字节', 'ttfb_ms')]
+    parts = []
+    for label, attr in phases:
+        values = [getattr(p, attr) for p in probes if p and getattr(p, attr) is not None]
+        if values:
+            parts.append(f"{label} {statistics.median(values):.1f}ms")
+    colos = {}
+    for p in probes:
+        if p and p.colo:
+            colos[p.colo] = colos.get(p.colo, 0) + 1
+    if parts:
+        logger.info(f"阶段耗时中位数: {', '.join(parts)}")
+    if colos:
+        logger.info(f"数据中心分布: {', '.join(f'{c}={n}' for c, n in sorted(colos.items()))}")
+
+def rank_by_latency(probed, config):
+    """按延迟筛选并排序 [(条目, ProbeResult)]，未测得延迟的条目保持原顺序排在最后"""
+    max_latency = config.getfloat('IP_CHECK', 'MAX_LATENCY')
+    if max_latency > 0:
+        kept = [(item, probe) for item, probe in probed if probe.rtt is None or probe.rtt <= max_latency]
+        if len(kept) < len(probed):
+            logger.info(f"延迟超过 {max_latency:g}ms 被丢弃: {len(probed) - len(kept)} 个IP")
+        probed = kept
+
+    if config.getboolean('IP_CHECK', 'SORT_BY_LATENCY'):
+        # sorted是稳定排序，延迟相同的IP保持输入顺序
+        probed = sorted(probed, key=lambda pair: (pair[1].rtt is None, pair[1].rtt or 0))
+    return probed
+
+def iter_ips_from_txt(file_path, filename_without_ext):
+    """逐行读取txt文件，产出Candidate，网段产出CidrRange，txt文件没有延迟/速度先验"""
+    # 使用不带扩展名的文件名作为标签（保持原样，不翻译）
+    tag = sys.intern(filename_without_ext)
+    match_ip = IP_PREFIX_RE.match
     try:
         with open(file_path, 'r', encoding='utf-8') as f:
             for line in f:
                 line = line.strip()
                 if line:
                     # 匹配IP地址格式
-                    ip_match = re.match(r'(\d+\.\d+\.\d+\.\d+)', line)
+                    ip_match = match_ip(line)
                     if ip_match:
-                        ip = ip_match.group(1)
-                        if validate_ip(ip):
-                            # 使用不带扩展名的文件名作为标签（保持原样，不翻译）
-                            results.append(f"{ip}#{filename_without_ext}")
+                        ipv4, ipv6 = ip_match.groups()
+                        ip = pack_ipv4(ipv4) if ipv4 else pack_ipv6(ipv6)
+                        if ip is None:
+                            continue
+                        cidr_match = CIDR_SUFFIX_RE.match(line, ip_match.end())
+                        if cidr_match:
+                            block = CidrRange.from_prefix(ip, int(cidr_match.group(1)), 0, tag)
+                            if block is not None:
+                                yield block
+                        else:
+                            yield Candidate(ip, 0, tag)
     except Exception as e:
         logger.error(f"读取txt文件 {file_path} 时出错: {e}")
-    return results
+
+def extract_ips_from_txt(file_path, filename_without_ext):
+    """从txt文件中提取IP地址"""
+    return [str(candidate) for candidate in iter_ips_from_txt(file_path, filename_without_ext)]
 
 def find_region_column_index(headers):
     """动态查找国家地区代码列的索引"""
@@ -308,68 +2071,466 @@ def find_region_column_index(headers):
     logger.warning(f"未找到地区代码列，使用默认索引4。表头: {headers}")
     return 4 if len(headers) > 4 else None
 
-def extract_ips_from_csv(file_path, filename_without_ext):
-    """从csv文件中提取IP地址、端口和国家地区代码"""
-    results = []
+# CSV中延迟和下载速度列的可能列名（按优先级排序）
+LATENCY_COLUMN_NAMES = ["网络延迟", "延迟", "平均延迟", "Latency", "Delay"]
+SPEED_COLUMN_NAMES = ["下载速度", "速度", "Download Speed", "Speed"]
+
+# 解析 "88 ms" / "28150 kB/s" 这类带单位的数值
+METRIC_VALUE_RE = re.compile(r'([\d.]+)\s*([a-zA-Z/]*)')
+SPEED_UNITS = {'b/s': 1 / 1024, 'kb/s': 1, 'mb/s': 1024, 'gb/s': 1024 * 1024}
+
+def find_metric_column_index(headers, possible_names):
+    """按列名查找延迟/下载速度等指标列的索引，找不到返回None"""
+    for name in possible_names:
+        for i, header in enumerate(headers):
+            if name.lower() in header.strip().lower():
+                return i
+    return None
+
+def parse_latency_ms(value):
+    """解析延迟列，如 "88 ms" -> 88.0，无法解析返回None"""
+    # 常见的 "数值 单位" 格式直接拆分，其他格式再用正则解析
+    number, _, unit = value.strip().partition(' ')
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            # 尝试不同的分隔符
-            sample = f.read(1024)
+        latency = float(number)
+    except ValueError:
+        match = METRIC_VALUE_RE.search(value)
+        if not match:
+            return None
+        try:
+            latency = float(match.group(1))
+        except ValueError:
+            return None
+        unit = match.group(2)
+    return latency * 1000 if unit.strip().lower() == 's' else latency
+
+def parse_speed_kbps(value):
+    """解析下载速度列，统一换算为kB/s，如 "28150 kB/s" -> 28150.0，无法解析返回None"""
+    number, _, unit = value.strip().partition(' ')
+    try:
+        speed = float(number)
+    except ValueError:
+        match = METRIC_VALUE_RE.search(value)
+        if not match:
+            return None
+        try:
+            speed = float(match.group(1))
+        except ValueError:
+            return None
+        unit = match.group(2)
+    return speed * SPEED_UNITS.get(unit.strip().lower(), 1)
+
+class CsvLayout:
+    """CSV文件的格式：分隔符、是否有表头以及地区/延迟/速度列的位置"""
+    __slots__ = ('dialect', 'has_header', 'region_index', 'latency_index', 'speed_index')
+
+    def __init__(self, dialect, has_header, region_index, latency_index=None, speed_index=None):
+        self.dialect = dialect
+        self.has_header = has_header
+        self.region_index = region_index
+        self.latency_index = latency_index
+        self.speed_index = speed_index
+
+# 表头行 -> CsvLayout，同一种表头的文件只检测一次格式
+CSV_LAYOUTS = {}
+
+def is_address_field(text):
+    """字段是否为IP地址或网段"""
+    text = text.strip()
+    if '/' in text:
+        return CidrRange.parse(text) is not None
+    return pack_ip(text) is not None
+
+def detect_csv_layout(first_line, sample):
+    """根据第一行和开头的样本检测CSV格式，有表头的格式按表头缓存"""
+    layout = CSV_LAYOUTS.get(first_line)
+    if layout is not None:
+        return layout
+
+    # 检测分隔符
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;\t|')
+    except csv.Error:
+        # 如果检测失败，使用默认的逗号分隔符
+        dialect = csv.excel
+    headers = next(csv.reader([first_line], dialect), [])
+    # 第一列不是IP地址或网段时视为表头
+    if headers and not is_address_field(headers[0]):
+        # 动态查找国家地区代码列的索引
+        region_index = find_region_column_index(headers)
+        logger.info(f"检测到表头: {headers}, 地区代码列索引: {region_index}")
+        layout = CsvLayout(dialect, True, region_index,
+                           find_metric_column_index(headers, LATENCY_COLUMN_NAMES),
+                           find_metric_column_index(headers, SPEED_COLUMN_NAMES))
+        CSV_LAYOUTS[first_line] = layout
+        return layout
+    # 没有表头时默认使用第5列作为地区代码
+    return CsvLayout(dialect, False, 4)
+
+def iter_ips_from_csv(file_path, filename_without_ext):
+    """逐行读取csv文件，产出带延迟/速度先验的Candidate，缺失的先验值为None；IP列为网段时产出CidrRange
+
+    不含引号的行直接按分隔符拆分，含引号的行才交给csv模块解析；无效的行只计数，
+    读完后汇总输出一条日志。
+    """
+    invalid = 0
+    first_invalid = None
+    # 延迟/速度列的取值重复度很高，解析结果按原文缓存
+    latencies = {}
+    speeds = {}
+    inet_pton = socket.inet_pton
+    unpack_ipv4 = IPV4_STRUCT.unpack
+    try:
+        with open(file_path, 'r', encoding='utf-8', newline='', buffering=1 << 20) as f:
+            sample = f.read(4096)
             f.seek(0)
+            first_line = sample.split('\n', 1)[0].rstrip('\r')
+            layout = detect_csv_layout(first_line, sample)
             
-            # 检测分隔符
-            try:
-                dialect = csv.Sniffer().sniff(sample)
-                has_header = csv.Sniffer().has_header(sample)
-            except:
-                # 如果检测失败，使用默认的逗号分隔符
-                dialect = csv.excel
-                has_header = False
-            
-            reader = csv.reader(f, dialect)
-            
-            # 如果有表头，跳过第一行
-            if has_header:
-                headers = next(reader)
-                # 动态查找国家地区代码列的索引
-                region_index = find_region_column_index(headers)
-                logger.info(f"检测到表头: {headers}, 地区代码列索引: {region_index}")
-            else:
-                headers = []
-                region_index = 4  # 默认使用第5列作为地区代码
+            dialect = layout.dialect
+            delimiter = dialect.delimiter
+            quotechar = dialect.quotechar or '"'
+            if layout.has_header:
+                next(f, None)
+            region_index = layout.region_index
+            latency_index = layout.latency_index
+            speed_index = layout.speed_index
+            default_region = sys.intern(filename_without_ext)
             
-            for row_num, row in enumerate(reader, 1 if has_header else 0):
-                if len(row) < 2:  # 确保有IP和端口列
+            for row_num, line in enumerate(f, 1 if layout.has_header else 0):
+                if quotechar in line:
+                    row = next(csv.reader([line], dialect), [])
+                else:
+                    row = line.rstrip('\r\n').split(delimiter)
+                columns = len(row)
+                if columns < 2:  # 确保有IP和端口列
                     continue
                 
-                ip_str = str(row[0]).strip()
-                port_str = str(row[1]).strip()
+                ip_str = row[0].strip()
                 
-                # 获取国家地区代码
-                region_code = filename_without_ext  # 默认使用文件名
-                if region_index is not None and len(row) > region_index:
-                    region_code = str(row[region_index]).strip()
-                    # 如果地区代码为空，使用文件名
-                    if not region_code:
-                        region_code = filename_without_ext
+                # 获取国家地区代码，为空时使用文件名
+                region_code = default_region
+                if region_index is not None and columns > region_index:
+                    region_code = row[region_index].strip() or default_region
                 
-                if ip_str and validate_ip(ip_str):
-                    if port_str and port_str.split()[0].isdigit():  # 只取端口数字部分
-                        port = port_str.split()[0]
-                        results.append(f"{ip_str}:{port}#{region_code}")
-                    else:
-                        results.append(f"{ip_str}#{region_code}")
+                # 只取端口数字部分
+                port = 0
+                port_str = row[1].strip()
+                if not port_str.isdigit():
+                    port_str = port_str.split(None, 1)[0] if port_str else ''
+                if port_str.isdigit():
+                    port = int(port_str)
+                    if port > 65535:
+                        port = 0
+
+                if '/' in ip_str:
+                    block = CidrRange.parse(ip_str, port, region_code)
+                    if block is not None:
+                        yield block
+                        continue
+                    ip = None
+                elif ':' in ip_str:
+                    ip = pack_ipv6(ip_str[1:-1] if ip_str.startswith('[') else ip_str)
                 else:
-                    logger.warning(f"第{row_num}行IP地址无效: {ip_str}")
+                    try:
+                        ip = unpack_ipv4(inet_pton(socket.AF_INET, ip_str))[0]
+                    except OSError:
+                        ip = None
+                if ip is None:
+                    invalid += 1
+                    if first_invalid is None:
+                        first_invalid = (row_num, ip_str)
+                    continue
+
+                latency = speed = None
+                if latency_index is not None and columns > latency_index:
+                    value = row[latency_index]
+                    latency = latencies.get(value, latencies)
+                    if latency is latencies:
+                        latency = latencies[value] = parse_latency_ms(value)
+                if speed_index is not None and columns > speed_index:
+                    value = row[speed_index]
+                    speed = speeds.get(value, speeds)
+                    if speed is speeds:
+                        speed = speeds[value] = parse_speed_kbps(value)
+                yield Candidate(ip, port, region_code, latency, speed)
                     
     except Exception as e:
         logger.error(f"读取csv文件 {file_path} 时出错: {e}")
-    return results
+    if invalid:
+        row_num, ip_str = first_invalid
+        logger.warning(f"{file_path}: 跳过 {invalid} 行无效的IP地址 (第{row_num}行: {ip_str})")
+
+def extract_ips_from_csv(file_path, filename_without_ext):
+    """从csv文件中提取IP地址、端口和国家地区代码"""
+    return [str(candidate) for candidate in iter_ips_from_csv(file_path, filename_without_ext)]
+
+def csv_prior_filter(config):
+    """返回判断Candidate先验是否达标的函数，CSV自带延迟/速度明显较慢的条目不参与检测"""
+    max_latency = config.getfloat('IP_CHECK', 'CSV_MAX_LATENCY')
+    min_speed = config.getfloat('IP_CHECK', 'CSV_MIN_SPEED')
+
+    def keep(candidate):
+        latency, speed = candidate.latency, candidate.speed
+        if max_latency > 0 and latency is not None and latency > max_latency:
+            return False
+        return not (min_speed > 0 and speed is not None and speed < min_speed)
+
+    return keep
+
+def prior_sort_key(candidate):
+    """按CSV下载速度降序、延迟升序排序的键，没有先验的条目排在最后"""
+    latency = candidate.latency
+    return (-(candidate.speed or 0), latency if latency is not None else float('inf'))
+
+def order_by_prior(candidates, config, settings=None):
+    """目标模式的检测顺序：缓存中近期通过的（按缓存延迟）→ CSV先验较好的 →
+    所在网段缓存记录较好的 → 缓存中近期失败的，先验相同时保持输入顺序"""
+    cached = {}
+    reputation = collections.Counter()
+
+    def subnet(candidate):
+        return candidate.ip >> (64 if candidate.is_v6 else 8)
+
+    cache = ProbeCache.from_config(config)
+    if cache is not None:
+        if settings is None:
+            settings = CheckSettings(config)
+        keys = [ProbeCache.make_key(candidate.host, candidate.port or settings.check_port,
+                                    settings.method, settings.cache_variant) for candidate in candidates]
+        try:
+            found = cache.lookup(keys)
+        except sqlite3.Error as e:
+            logger.warning(f"读取检测缓存失败: {e}")
+            found = {}
+        finally:
+            cache.close()
+        for candidate, key in zip(candidates, keys):
+            result = found.get(key)
+            if result is not None:
+                cached[candidate.key] = result
+                reputation[subnet(candidate)] += 1 if result else -1
+
+    def sort_key(candidate):
+        result = cached.get(candidate.key)
+        if result:
+            return (0, result.rtt or 0, 0, 0)
+        speed, latency = prior_sort_key(candidate)
+        return (1 if result is None else 2, speed, latency, -reputation[subnet(candidate)])
+
+    candidates.sort(key=sort_key)
+    return candidates
+
+class SpeedTestOptions:
+    """下载测速参数"""
+
+    def __init__(self, config):
+        section = config['SPEED_TEST']
+        url = urlsplit(section.get('URL').strip())
+        self.host = url.hostname or ''
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+        self.bytes = section.getint('BYTES')
+        self.top_k = section.getint('TOP_K')
+        self.concurrency = max(1, section.getint('CONCURRENCY'))
+        self.timeout = section.getfloat('TIMEOUT')
+        self.min_speed = section.getfloat('MIN_SPEED')
+
+        self.ssl_context = ssl.create_default_context()
+        self.ssl_context.check_hostname = False
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+        self.request = (
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: {self.host}\r\n"
+            "User-Agent: ip-processor\r\n"
+            "Accept: */*\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode('ascii')
+
+def check_ip_speed(ip, port, options):
+    """通过指定IP从测速地址下载options.bytes字节，返回下载速度（kB/s），失败返回None"""
+    deadline = time.perf_counter() + options.timeout
+    sock = None
+    try:
+        sock = socket.create_connection((ip, port), timeout=options.timeout)
+        if port not in CF_HTTP_PORTS:
+            sock = options.ssl_context.wrap_socket(sock, server_hostname=options.host)
+        sock.sendall(options.request)
+
+        buffer = b''
+        while b'\r\n\r\n' not in buffer:
+            sock.settimeout(max(0.001, deadline - time.perf_counter()))
+            chunk = sock.recv(16384)
+            if not chunk:
+                return None
+            buffer += chunk
+        head, _, body = buffer.partition(b'\r\n\r\n')
+        status, _ = parse_http_head(head)
+        if status != 200:
+            return None
+
+        # 从收到响应头开始计时，只统计响应体的下载速度
+        received = len(body)
+        start = time.perf_counter()
+        while received < options.bytes:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                chunk = sock.recv(65536)
+            except socket.timeout:
+                break
+            if not chunk:
+                break
+            received += len(chunk)
+        elapsed = time.perf_counter() - start
+        if received == 0 or elapsed <= 0:
+            return None
+        return received / 1024 / elapsed
+    except (OSError, ssl.SSLError):
+        return None
+    finally:
+        if sock is not None:
+            sock.close()
+
+def rank_by_speed(probed, config):
+    """对 [(Candidate, ProbeResult)] 中排名前TOP_K的条目测速，测速通过的按速度降序排在最前"""
+    options = SpeedTestOptions(config)
+    candidates = probed[:options.top_k] if options.top_k > 0 else probed
+    if not candidates:
+        return probed
+    rest = probed[len(candidates):]
+
+    from tqdm import tqdm
+    logger.info(f"开始下载测速: {len(candidates)} 个IP (并发: {options.concurrency})")
+    check_port = config.getint('IP_CHECK', 'CHECK_PORT')
+
+    def test(pair):
+        ip, port = pair[0].endpoint(check_port)
+        return check_ip_speed(ip, port, options)
+
+    # 测速并发数即全局带宽预算，避免多个下载互相挤占带宽
+    with metrics.stage('speed_test'), \
+            concurrent.futures.ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+        speeds = list(tqdm(executor.map(test, candidates), total=len(candidates), desc="下载测速"))
+
+    tested = []
+    for (candidate, probe), speed in zip(candidates, speeds):
+        if speed is None or speed < options.min_speed:
+            continue
+        probe.speed = speed
+        tested.append((candidate, probe))
+    tested.sort(key=lambda pair: -pair[1].speed)
+    logger.info(f"下载测速完成: {len(tested)}/{len(candidates)} 个IP达标")
+    if tested:
+        logger.info(f"最快速度: {tested[0][1].speed:.0f} kB/s")
+    return tested + rest
+
+class TokenBucket:
+    """线程安全的令牌桶限速器，rate为每秒令牌数"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = max(1.0, burst or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.acquired = 0
+
+    def acquire(self):
+        """取得一个令牌，令牌不足时等待"""
+        while True:
+            with self.lock:
+                if self.rate <= 0:
+                    self.acquired += 1
+                    return
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.acquired += 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            metrics.inc('rate_limit_wait_seconds_total', wait)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """服务端要求限流时，让所有使用者至少等待seconds秒"""
+        with self.lock:
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+def retry_after_seconds(response):
+    """解析Retry-After响应头（秒数或HTTP日期），没有或无法解析返回None"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# Cloudflare API单次请求超时（秒）
+CF_API_TIMEOUT = 30
+
+def send_with_retries(session, method, url, max_retries, limiter=None, label="HTTP", **kwargs):
+    """发送请求，429/5xx和网络错误按指数退避重试，优先使用Retry-After
+
+    limiter为TokenBucket时每次请求先取得令牌，收到429时所有使用者一起暂停。
+    重试用尽后返回最后一次响应，网络错误则抛出异常。
+    """
+    import requests
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        start = time.perf_counter()
+        try:
+            response = session.request(method, url, timeout=CF_API_TIMEOUT, **kwargs)
+        except requests.RequestException as e:
+            metrics.inc('http_requests_total', target=label, method=method, status='error')
+            if attempt >= max_retries:
+                raise
+            delay = min(60, 2 ** attempt)
+            logger.warning(f"{label}请求失败: {e}, {delay}秒后重试")
+        else:
+            metrics.inc('http_requests_total', target=label, method=method, status=str(response.status_code))
+            metrics.observe('http_request_ms', (time.perf_counter() - start) * 1000, target=label)
+            if (response.status_code != 429 and response.status_code < 500) or attempt >= max_retries:
+                return response
+            delay = retry_after_seconds(response)
+            if delay is None:
+                delay = min(60, 2 ** attempt)
+            if response.status_code == 429 and limiter is not None:
+                # 限流是账号级别的，所有线程一起暂停
+                limiter.pause(delay)
+            logger.warning(f"{label}返回 {response.status_code}, {delay:g}秒后重试")
+        time.sleep(delay)
+
+def group_by_tag(ranked):
+    """把排好序的 [(Candidate, ProbeResult)] 按标签分组，组内保持原顺序，没有标签的条目不上传"""
+    tag_groups = {}
+    for candidate, probe in ranked:
+        if candidate.tag:
+            tag_groups.setdefault(candidate.tag, []).append((candidate, probe))
+    return tag_groups
 
 class CloudflareManager:
     """Cloudflare DNS记录管理器"""
     
-    def __init__(self, config):
+    def __init__(self, config, dry_run=False, state=None):
+        self.dry_run = dry_run
+        # 状态清单中上次成功发布的DNS记录 {完整域名: [IP]}，与本次选择一致的子域名不再获取快照
+        self.known = state.section('dns') if state is not None else None
+        # 最近一次同步的候选排名和已选中的记录 {子域名: [(Candidate, ProbeResult)]}，常驻模式用来替换失效记录
+        self.candidates = {}
+        self.published = {}
         self.enable = config.getboolean('cloudflare', 'enable')
         if not self.enable:
             logger.info("Cloudflare功能未启用")
@@ -396,10 +2557,22 @@ class CloudflareManager:
             return
         
         self.record_name = config.get('cloudflare', 'record_name')
-        self.record_type = config.get('cloudflare', 'record_type')
+        self.record_types = set()
+        for record_type in config.get('cloudflare', 'record_type').split(','):
+            record_type = record_type.strip().upper()
+            if record_type in ('A', 'AAAA'):
+                self.record_types.add(record_type)
+            elif record_type:
+                logger.warning(f"不支持的DNS记录类型: {record_type}, 只支持A和AAAA")
+        if not self.record_types:
+            self.record_types.add('A')
         self.ttl = config.getint('cloudflare', 'ttl')
         self.proxied = config.getboolean('cloudflare', 'proxied')
         self.max_records = config.getint('cloudflare', 'max_records_per_line')
+        self.subnet_prefix = min(32, max(0, config.getint('cloudflare', 'subnet_prefix')))
+        self.subnet_prefix_v6 = min(128, max(0, config.getint('cloudflare', 'subnet_prefix_v6')))
+        self.max_per_subnet = config.getint('cloudflare', 'max_per_subnet')
+        self.replace_margin = config.getfloat('cloudflare', 'replace_margin') / 100
         self.upload_dir = config.get('cloudflare', 'upload_dir')
         self.upload_files = config.get('cloudflare', 'upload_files')
         
@@ -407,48 +2580,35 @@ class CloudflareManager:
             'Authorization': f'Bearer {self.api_token}',
             'Content-Type': 'application/json'
         }
+        self.api_base = config.get('cloudflare', 'api_base').strip().rstrip('/')
+        self.batch_size = config.getint('cloudflare', 'batch_size')
+        self.concurrency = max(1, config.getint('cloudflare', 'api_concurrency'))
+        self.max_retries = max(0, config.getint('cloudflare', 'api_max_retries'))
+        self.limiter = TokenBucket(config.getfloat('cloudflare', 'api_rate'))
+        
+        # 复用连接的会话，连接池大小与并发数一致
+        import requests
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         
         logger.info("Cloudflare管理器初始化完成")
         logger.info(f"域名: {self.domain}")
         logger.info(f"Zone ID: {self.zone_id[:10]}...")
     
-    def get_existing_records(self, subdomain):
-        """获取现有的DNS记录"""
-        if not self.enable:
-            return []
-            
-        full_name = f'{subdomain}.{self.domain}'
-        url = f'https://api.cloudflare.com/client/v4/zones/{self.zone_id}/dns_records'
-        params = {
-            'type': self.record_type,
-            'name': full_name
-        }
-        
-        try:
-            logger.debug(f"获取DNS记录: {full_name}")
-            response = requests.get(url, headers=self.headers, params=params)
-            if response.status_code == 200:
-                result = response.json()
-                if result['success']:
-                    logger.debug(f"成功获取 {len(result['result'])} 条记录")
-                    return result['result']
-                else:
-                    errors = result.get('errors', [])
-                    error_messages = [f"{e.get('code', '未知错误')}: {e.get('message', '无详细信息')}" for e in errors]
-                    logger.error(f"获取DNS记录失败: {', '.join(error_messages)}")
-            else:
-                logger.error(f"HTTP错误: {response.status_code}")
-                logger.error(f"响应内容: {response.text}")
-        except Exception as e:
-            logger.error(f"获取DNS记录时出错: {e}")
-            
-        return []
-    
-    def create_dns_record(self, subdomain, ip_address):
-        """创建DNS记录"""
-        if not self.enable:
-            return False
-            
+    def request(self, method, url, **kwargs):
+        """发送API请求：先经过限速器，429/5xx和网络错误按指数退避重试"""
+        return send_with_retries(self.session, method, url, self.max_retries, self.limiter,
+                                 "Cloudflare API", **kwargs)
+
+    @staticmethod
+    def record_type_for(ip_address):
+        return 'AAAA' if ':' in ip_address else 'A'
+
+    def record_data(self, subdomain, ip_address):
+        """生成DNS记录的请求数据"""
         # Cloudflare要求TTL为1（自动）或在60-86400之间
         ttl_value = self.ttl
         if self.proxied:
@@ -458,20 +2618,27 @@ class CloudflareManager:
             # 确保TTL在有效范围内
             ttl_value = 1
         
-        full_name = f'{subdomain}.{self.domain}'
-        record_data = {
-            'type': self.record_type,
-            'name': full_name,
+        return {
+            'type': self.record_type_for(ip_address),
+            'name': f'{subdomain}.{self.domain}',
             'content': ip_address,
             'ttl': ttl_value,
             'proxied': self.proxied
         }
+    
+    def create_dns_record(self, subdomain, ip_address):
+        """创建DNS记录"""
+        if not self.enable:
+            return False
+            
+        full_name = f'{subdomain}.{self.domain}'
+        record_data = self.record_data(subdomain, ip_address)
         
-        url = f'https://api.cloudflare.com/client/v4/zones/{self.zone_id}/dns_records'
+        url = f'{self.api_base}/zones/{self.zone_id}/dns_records'
         
         try:
             logger.debug(f"创建DNS记录: {full_name} -> {ip_address}")
-            response = requests.post(url, headers=self.headers, json=record_data)
+            response = self.request('POST', url, json=record_data)
             if response.status_code == 200:
                 result = response.json()
                 if result['success']:
@@ -491,37 +2658,22 @@ class CloudflareManager:
         except Exception as e:
             logger.error(f"创建DNS记录时出错: {e}")
             logger.error(f"请求数据: {json.dumps(record_data)}")
-            
-        return False
-    
-    def update_dns_record(self, record_id, subdomain, ip_address):
-        """更新DNS记录"""
-        if not self.enable:
-            return False
-            
-        # Cloudflare要求TTL为1（自动）或在60-86400之间
-        ttl_value = self.ttl
-        if self.proxied:
-            # 如果启用了代理，TTL必须为1
-            ttl_value = 1
-        elif ttl_value < 60 or ttl_value > 86400:
-            # 确保TTL在有效范围内
-            ttl_value = 1
-        
+            
+        return False
+    
+    def update_dns_record(self, record_id, subdomain, ip_address):
+        """更新DNS记录"""
+        if not self.enable:
+            return False
+            
         full_name = f'{subdomain}.{self.domain}'
-        record_data = {
-            'type': self.record_type,
-            'name': full_name,
-            'content': ip_address,
-            'ttl': ttl_value,
-            'proxied': self.proxied
-        }
+        record_data = self.record_data(subdomain, ip_address)
         
-        url = f'https://api.cloudflare.com/client/v4/zones/{self.zone_id}/dns_records/{record_id}'
+        url = f'{self.api_base}/zones/{self.zone_id}/dns_records/{record_id}'
         
         try:
             logger.debug(f"更新DNS记录: {full_name} -> {ip_address}")
-            response = requests.put(url, headers=self.headers, json=record_data)
+            response = self.request('PUT', url, json=record_data)
             if response.status_code == 200:
                 result = response.json()
                 if result['success']:
@@ -549,11 +2701,11 @@ class CloudflareManager:
         if not self.enable:
             return False
             
-        url = f'https://api.cloudflare.com/client/v4/zones/{self.zone_id}/dns_records/{record_id}'
+        url = f'{self.api_base}/zones/{self.zone_id}/dns_records/{record_id}'
         
         try:
             logger.debug(f"删除DNS记录: {record_id}")
-            response = requests.delete(url, headers=self.headers)
+            response = self.request('DELETE', url)
             if response.status_code == 200:
                 result = response.json()
                 if result['success']:
@@ -573,8 +2725,12 @@ class CloudflareManager:
             
         return False
     
-    def upload_ips_to_cloudflare(self):
-        """上传IP到Cloudflare"""
+    def upload_ips_to_cloudflare(self, ranked_files=None):
+        """上传IP到Cloudflare
+
+        ranked_files为 {文件名: [(Candidate, ProbeResult)]}，由本次运行的检测结果提供，
+        选择记录时可以使用实测延迟/速度；没有的文件从上传目录读取，按文件中的顺序排名。
+        """
         if not self.enable:
             logger.info("Cloudflare功能未启用，跳过上传")
             return
@@ -595,12 +2751,313 @@ class CloudflareManager:
         
         logger.info(f"准备上传 {len(files_to_upload)} 个文件: {', '.join([f.stem for f in files_to_upload])}")
         
-        # 遍历指定文件
+        # 按子域名汇总所有文件的标签，多个文件包含同一标签时以后处理的文件为准
+        entries = {}
         for file_path in files_to_upload:
             if file_path.is_file() and file_path.suffix.lower() == '.txt':
-                self.process_single_file(file_path)
-                # 添加延迟，避免请求过于频繁
-                time.sleep(1)  # 1秒延迟
+                if ranked_files is not None and file_path.stem in ranked_files:
+                    tag_groups = group_by_tag(ranked_files[file_path.stem])
+                else:
+                    tag_groups = self.process_single_file(file_path)
+                for tag, tag_entries in tag_groups.items():
+                    entries[self.subdomain_for(tag)] = tag_entries
+        
+        self.sync(entries)
+    
+    def sync(self, entries):
+        """把 {子域名: 排好序的[(Candidate, ProbeResult)]} 同步到Cloudflare
+
+        获取一次区域快照，为每个子域名选择记录，只提交有差异的记录。
+        按状态清单中上次发布的记录选择结果不变的子域名直接跳过，全部不变时不发送任何请求。
+        """
+        start = time.perf_counter()
+        if self.known is not None:
+            stale = {}
+            for subdomain, tag_entries in entries.items():
+                recorded = self.known.get(self.fqdn(subdomain))
+                selected = self.select_records(tag_entries, set(recorded or ()))
+                if recorded is not None and sorted(candidate.host for candidate, _ in selected) == recorded:
+                    self.candidates[subdomain] = tag_entries
+                    self.published[subdomain] = selected
+                else:
+                    stale[subdomain] = tag_entries
+            if len(stale) < len(entries):
+                logger.info(f"{len(entries) - len(stale)} 个子域名的记录与上次发布一致，跳过")
+            if not stale:
+                return
+            entries = stale
+
+        snapshot = self.fetch_zone_records()
+        if snapshot is None:
+            logger.error("获取DNS记录快照失败，跳过本次同步")
+            return
+        
+        desired = {}
+        for subdomain, tag_entries in entries.items():
+            published = {record['content'] for record in snapshot.get(self.fqdn(subdomain), [])}
+            selected = self.select_records(tag_entries, published)
+            self.candidates[subdomain] = tag_entries
+            self.published[subdomain] = selected
+            desired[subdomain] = [candidate.host for candidate, _ in selected]
+        
+        plan = self.plan_changes(desired, snapshot)
+        updates = sum(len(change[0]) for change in plan.values())
+        creates = sum(len(change[1]) for change in plan.values())
+        deletes = sum(len(change[2]) for change in plan.values())
+        logger.info(f"同步计划: {len(desired)} 个子域名, {len(plan)} 个需要变更 "
+                    f"(更新 {updates} 条, 新增 {creates} 条, 删除 {deletes} 条), "
+                    f"{len(desired) - len(plan)} 个无变化")
+        for subdomain, (to_update, to_create, to_delete) in plan.items():
+            changes = ([f"{record['content']}->{ip}" for record, ip in to_update] +
+                       [f"+{ip}" for ip in to_create] + [f"-{record['content']}" for record in to_delete])
+            logger.info(f"  {subdomain}.{self.domain}: {' '.join(changes)}")
+        
+        if self.dry_run:
+            logger.info("dry-run模式，不提交任何变更")
+            return
+        
+        if not plan:
+            applied = True
+        elif self.batch_size > 0:
+            applied = self.apply_batches(plan)
+        else:
+            # 不同子域名并行同步，请求速率由限速器统一控制
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                futures = [executor.submit(self.apply_changes, subdomain, *changes)
+                           for subdomain, changes in plan.items()]
+                applied = all(future.result() for future in futures)
+        # 只在全部变更成功后记录，失败的部分下次运行重新同步
+        if applied and self.known is not None:
+            for subdomain, ips in desired.items():
+                self.known[self.fqdn(subdomain)] = sorted(ips)
+        logger.info(f"Cloudflare同步完成: API请求 {self.limiter.acquired} 次, "
+                    f"耗时 {time.perf_counter() - start:.1f}秒")
+    
+    def replace_failed(self, failed_hosts):
+        """从已发布记录中剔除检测失败的IP，用候选排名中的其他IP补足并立即同步"""
+        affected = {}
+        for subdomain, selected in self.published.items():
+            if any(candidate.host in failed_hosts for candidate, _ in selected):
+                # 失败的IP在下次全量检测之前不再参与选择
+                affected[subdomain] = [(candidate, probe) for candidate, probe in self.candidates[subdomain]
+                                       if candidate.host not in failed_hosts]
+        if affected:
+            logger.warning(f"已发布记录检测失败: {', '.join(sorted(failed_hosts))}, "
+                           f"替换 {len(affected)} 个子域名的记录")
+            self.sync(affected)
+    
+    def fetch_zone_records(self, per_page=1000):
+        """分页获取区域内属于该域名的A/AAAA记录（只保留已启用的类型），返回 {完整域名(小写): [记录]}，失败返回None"""
+        import requests
+        url = f'{self.api_base}/zones/{self.zone_id}/dns_records'
+        snapshot = {}
+        page = 1
+        while True:
+            params = {
+                'name.endswith': f'.{self.domain}',
+                'per_page': per_page,
+                'page': page
+            }
+            try:
+                response = self.request('GET', url, params=params)
+            except requests.RequestException as e:
+                logger.error(f"获取DNS记录时出错: {e}")
+                return None
+            if response.status_code != 200:
+                logger.error(f"HTTP错误: {response.status_code}")
+                logger.error(f"响应内容: {response.text}")
+                return None
+            result = response.json()
+            if not result.get('success'):
+                errors = result.get('errors', [])
+                error_messages = [f"{e.get('code', '未知错误')}: {e.get('message', '无详细信息')}" for e in errors]
+                logger.error(f"获取DNS记录失败: {', '.join(error_messages)}")
+                return None
+            
+            for record in result['result']:
+                if record['type'] in self.record_types:
+                    snapshot.setdefault(record['name'].lower(), []).append(record)
+            info = result.get('result_info') or {}
+            if page >= info.get('total_pages', 1):
+                break
+            page += 1
+        
+        logger.info(f"DNS记录快照: {sum(len(r) for r in snapshot.values())} 条记录, "
+                    f"{len(snapshot)} 个名称, {page} 页")
+        return snapshot
+    
+    def subnet_of(self, candidate):
+        if candidate.is_v6:
+            return (candidate.ip ^ IPV6_FLAG) >> (128 - self.subnet_prefix_v6)
+        return candidate.ip >> (32 - self.subnet_prefix)
+
+    def is_clearly_better(self, new, old):
+        """new的实测速度/延迟是否比old好replace_margin以上，缺少指标时视为不更好"""
+        if new is None or old is None:
+            return False
+        if new.speed is not None and old.speed is not None:
+            return new.speed > old.speed * (1 + self.replace_margin)
+        if new.rtt is not None and old.rtt is not None:
+            return new.rtt < old.rtt * (1 - self.replace_margin)
+        return False
+
+    def select_records(self, entries, published):
+        """从排好序的 [(Candidate, ProbeResult)] 中为一个子域名选择记录
+
+        IPv4（A）和IPv6（AAAA）分别选择，每种最多max_records个，未启用的记录类型不选择。
+        """
+        selected = []
+        for is_v6, record_type in ((False, 'A'), (True, 'AAAA')):
+            if record_type in self.record_types:
+                family = [entry for entry in entries if entry[0].is_v6 == is_v6]
+                selected.extend(self.select_family(family, published))
+        return selected
+
+    def select_family(self, entries, published):
+        """从同一地址族排好序的 [(Candidate, ProbeResult)] 中选出最多max_records个条目
+
+        按排名依次选择，同一网段不超过max_per_subnet个；本次仍然可用的已发布IP只有在
+        新IP明显更好（超过replace_margin）时才被替换，避免DNS记录在相近的节点之间来回切换。
+        """
+        # DNS记录只包含IP，同一IP的多个端口只保留排名最高的一个
+        ranked = []
+        seen = set()
+        for candidate, probe in entries:
+            if candidate.ip not in seen:
+                seen.add(candidate.ip)
+                ranked.append((candidate, probe))
+
+        subnets = collections.Counter()
+
+        def fits(candidate):
+            return self.max_per_subnet <= 0 or subnets[self.subnet_of(candidate)] < self.max_per_subnet
+
+        selected = []
+        for candidate, probe in ranked:
+            if len(selected) >= self.max_records:
+                break
+            if fits(candidate):
+                subnets[self.subnet_of(candidate)] += 1
+                selected.append((candidate, probe))
+
+        # 滞后替换：未入选但仍然可用的已发布IP，挤掉入选的新IP中排名最低且优势不足的一个
+        for candidate, probe in ranked:
+            if candidate.host not in published or any(c is candidate for c, _ in selected):
+                continue
+            newcomers = [entry for entry in selected if entry[0].host not in published]
+            if not newcomers:
+                break
+            worst_candidate, worst_probe = newcomers[-1]
+            if self.is_clearly_better(worst_probe, probe):
+                continue
+            subnets[self.subnet_of(worst_candidate)] -= 1
+            if not fits(candidate):
+                subnets[self.subnet_of(worst_candidate)] += 1
+                continue
+            subnets[self.subnet_of(candidate)] += 1
+            selected.remove((worst_candidate, worst_probe))
+            selected.append((candidate, probe))
+
+        return selected
+
+    def fqdn(self, subdomain):
+        return f'{subdomain}.{self.domain}'.lower()
+
+    def plan_changes(self, desired, snapshot):
+        """对比期望IP和现有记录，返回 {子域名: (待更新[(记录, 新IP)], 待新增IP列表, 待删除记录列表)}
+
+        多余的旧记录优先原地改为同类型（A/AAAA）的新IP，不足的再新增，剩余的删除；无变化的子域名不出现。
+        """
+        plan = {}
+        for subdomain, ips in desired.items():
+            records = snapshot.get(self.fqdn(subdomain), [])
+            to_update, to_create, to_delete = [], [], []
+            for record_type in sorted(self.record_types):
+                wanted = [ip for ip in dict.fromkeys(ips) if self.record_type_for(ip) == record_type]
+                kept = set()
+                stale = []
+                for record in records:
+                    if record['type'] != record_type:
+                        continue
+                    # 同一IP的重复记录只保留一条
+                    if record['content'] in wanted and record['content'] not in kept:
+                        kept.add(record['content'])
+                    else:
+                        stale.append(record)
+                fresh = [ip for ip in wanted if ip not in kept]
+                reuse = min(len(fresh), len(stale))
+                to_update.extend(zip(stale, fresh))
+                to_create.extend(fresh[reuse:])
+                to_delete.extend(stale[reuse:])
+            if to_update or to_create or to_delete:
+                plan[subdomain] = (to_update, to_create, to_delete)
+        return plan
+    
+    def apply_changes(self, subdomain, to_update, to_create, to_delete):
+        """逐条提交一个子域名的变更，出错不影响其他子域名，全部成功返回True
+
+        先更新和新增、最后删除，同步过程中子域名的记录数不会少于目标数量。
+        """
+        try:
+            ok = True
+            for record, ip in to_update:
+                ok = self.update_dns_record(record['id'], subdomain, ip) and ok
+            for ip in to_create:
+                ok = self.create_dns_record(subdomain, ip) and ok
+            for record in to_delete:
+                ok = self.delete_dns_record(record['id']) and ok
+            logger.info(f"处理完成: 子域名 '{subdomain}.{self.domain}', 更新 {len(to_update)} 条, "
+                        f"新增 {len(to_create)} 条, 删除 {len(to_delete)} 条")
+            return ok
+        except Exception as e:
+            logger.error(f"同步子域名 {subdomain} 时出错: {e}")
+            return False
+    
+    def apply_batches(self, plan):
+        """通过 dns_records/batch 分批提交变更，全部成功返回True
+
+        每批在Cloudflare端原子执行。更新和新增排在前面、删除排在最后，
+        即使一个子域名的变更跨越多个批次，记录数也不会少于目标数量。
+        某一批失败后不再提交后续批次（否则可能只删除不新增），下次同步按新的快照重新规划。
+        """
+        operations = []
+        for subdomain, (to_update, _, _) in plan.items():
+            for record, ip in to_update:
+                data = self.record_data(subdomain, ip)
+                operations.append(('patches', {'id': record['id'], 'content': ip,
+                                               'ttl': data['ttl'], 'proxied': data['proxied']}))
+        for subdomain, (_, to_create, _) in plan.items():
+            operations.extend(('posts', self.record_data(subdomain, ip)) for ip in to_create)
+        for _, (_, _, to_delete) in plan.items():
+            operations.extend(('deletes', {'id': record['id']}) for record in to_delete)
+        
+        url = f'{self.api_base}/zones/{self.zone_id}/dns_records/batch'
+        applied = 0
+        for offset in range(0, len(operations), self.batch_size):
+            chunk = operations[offset:offset + self.batch_size]
+            body = {'deletes': [], 'patches': [], 'posts': []}
+            for kind, data in chunk:
+                body[kind].append(data)
+            try:
+                response = self.request('POST', url, json=body)
+                try:
+                    result = response.json()
+                except ValueError:
+                    result = {}
+                if response.status_code == 200 and result.get('success'):
+                    applied += len(chunk)
+                    continue
+                errors = result.get('errors', [])
+                error_messages = [f"{e.get('code', '未知错误')}: {e.get('message', '无详细信息')}" for e in errors]
+                logger.error(f"批量提交失败 (HTTP {response.status_code}): {', '.join(error_messages) or response.text}")
+            except Exception as e:
+                logger.error(f"批量提交DNS变更时出错: {e}")
+            remaining = len(operations) - offset - len(chunk)
+            if remaining:
+                logger.warning(f"剩余 {remaining} 条变更不再提交，下次同步时重新规划")
+            break
+        logger.info(f"批量提交完成: {applied}/{len(operations)} 条变更成功")
+        return applied == len(operations)
     
     def get_files_to_upload(self):
         """获取要上传的文件列表"""
@@ -628,81 +3085,48 @@ class CloudflareManager:
         return files_to_upload
     
     def process_single_file(self, file_path):
-        """处理单个文件"""
+        """读取单个文件，返回 {标签: [(Candidate, None)]}，文件中的顺序即排名"""
         try:
             with open(file_path, 'r', encoding='utf-8') as f:
                 lines = [line.strip() for line in f if line.strip()]
             
             if not lines:
                 logger.warning(f"文件为空: {file_path}")
-                return
+                return {}
             
             # 提取IP和标签
             ip_data = []
             for line in lines:
-                if '#' in line:
-                    ip_part, tag = line.split('#', 1)
-                    ip_match = re.match(r'(\d+\.\d+\.\d+\.\d+)', ip_part)
-                    if ip_match:
-                        ip = ip_match.group(1)
-                        if validate_ip(ip):
-                            ip_data.append((ip, tag))
+                candidate = Candidate.parse(line)
+                if candidate is not None and candidate.tag:
+                    ip_data.append(candidate)
             
             if not ip_data:
                 logger.warning(f"文件中没有有效的IP: {file_path}")
-                return
+                return {}
             
-            # 只取前max_records个IP
-            ip_data = ip_data[:self.max_records]
-            
-            # 按标签分组（同一个标签的IP放在一起）
+            # 按标签分组（同一个标签的IP放在一起），每个标签的数量在选择记录时限制
             tag_groups = {}
-            for ip, tag in ip_data:
-                if tag not in tag_groups:
-                    tag_groups[tag] = []
-                tag_groups[tag].append(ip)
+            for candidate in ip_data:
+                if candidate.tag not in tag_groups:
+                    tag_groups[candidate.tag] = []
+                tag_groups[candidate.tag].append((candidate, None))
             
-            # 为每个标签创建/更新DNS记录
-            for tag, ips in tag_groups.items():
-                self.process_tag_ips(tag, ips, file_path.stem)
+            return tag_groups
                 
         except Exception as e:
             logger.error(f"处理文件 {file_path} 时出错: {e}")
+            return {}
     
-    def process_tag_ips(self, tag, ips, filename):
-        """处理单个标签的IP"""
-        # 生成子域名，添加record_name前缀（如果设置）
+    def subdomain_for(self, tag):
+        """生成标签对应的子域名，添加record_name前缀（如果设置）"""
         if self.record_name and self.record_name.strip():
             subdomain_part = f"{self.record_name}-{tag}"
         else:
             subdomain_part = tag
             
         # 清理子域名，确保适合作为子域名
-        subdomain = self.sanitize_subdomain(subdomain_part)
-        
-        # 获取现有记录
-        existing_records = self.get_existing_records(subdomain)
-        
-        # 创建记录ID到IP的映射
-        existing_ip_map = {record['id']: record['content'] for record in existing_records}
-        
-        # 删除不在新IP列表中的记录
-        for record_id, ip_content in list(existing_ip_map.items()):
-            if ip_content not in ips:
-                self.delete_dns_record(record_id)
-                time.sleep(0.5)
-        
-        # 重新获取现有记录（因为可能已删除部分记录）
-        existing_records = self.get_existing_records(subdomain)
-        existing_ips = {record['content'] for record in existing_records}
-        
-        # 添加不在现有记录中的新IP
-        for ip in ips:
-            if ip not in existing_ips:
-                self.create_dns_record(subdomain, ip)
-                time.sleep(0.5)
-        
-        logger.info(f"处理完成: 标签 '{tag}' -> 子域名 '{subdomain}.{self.domain}', 上传 {len(ips)} 个IP")
+        return self.sanitize_subdomain(subdomain_part)
     
     def sanitize_subdomain(self, subdomain):
         """清理子域名，使其适合作为子域名"""
@@ -723,8 +3147,632 @@ class CloudflareManager:
         
         return cleaned.lower()  # 子域名通常使用小写
 
-def process_files(config):
-    """处理ips目录下的所有文件"""
+class PublishState:
+    """状态清单文件
+
+    outputs: {输出文件名: 文件内容哈希}；dns: {完整域名: 上次成功发布的IP列表}；
+    其他部分为各发布目标上次成功上传的输出文件哈希。
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.data = {}
+        if self.path.exists():
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.data = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"读取状态清单 {self.path} 失败，将重新发布全部文件: {e}")
+
+    def section(self, name):
+        return self.data.setdefault(name, {})
+
+    def save(self):
+        """先写临时文件再替换，中途出错不会留下不完整的状态文件"""
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+class Publisher:
+    """输出文件发布器：复用连接并行上传，跳过内容未变化的文件，失败按指数退避重试"""
+    name = ''
+    label = ''
+
+    def __init__(self, config, state):
+        section = config['PUBLISH']
+        self.state = state.section(self.name)
+        self.outputs = state.section('outputs')
+        self.concurrency = max(1, section.getint('CONCURRENCY'))
+        self.max_retries = max(0, section.getint('MAX_RETRIES'))
+        import requests
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.aborted = False
+
+    def content_for(self, file_path):
+        """要上传的内容"""
+        return file_path.read_bytes()
+
+    def upload(self, file_name, content):
+        """上传一个文件，成功返回True"""
+        raise NotImplementedError
+
+    def publish(self, files):
+        """上传files中自上次成功上传以来有变化的文件，返回成功上传的数量
+
+        是否变化按状态清单中的输出文件哈希判断，未变化的文件不会被读取。
+        """
+        pending = []
+        for file_path in files:
+            digest = self.outputs.get(file_path.name)
+            if digest is None:
+                # 不是本次运行写出的文件，按文件内容判断
+                digest = hashlib.sha256(file_path.read_bytes()).hexdigest()
+            if self.state.get(file_path.name) != digest:
+                pending.append((file_path, digest))
+        skipped = len(files) - len(pending)
+        if not pending:
+            logger.info(f"{self.label}: {len(files)} 个文件均无变化，跳过上传")
+            return 0
+        import requests
+
+        def upload_one(job):
+            file_path, digest = job
+            if self.aborted:
+                return False
+            try:
+                ok = self.upload(file_path.name, self.content_for(file_path))
+            except (OSError, requests.RequestException) as e:
+                logger.error(f"{self.label}上传 {file_path.name} 出错: {e}")
+                ok = False
+            if ok:
+                self.state[file_path.name] = digest
+            return ok
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            uploaded = sum(executor.map(upload_one, pending))
+        logger.info(f"{self.label}: 上传成功 {uploaded}/{len(pending)} 个文件, 未变化跳过 {skipped} 个")
+        return uploaded
+
+class WebDavPublisher(Publisher):
+    """通过WebDAV PUT上传输出文件"""
+    name = 'webdav'
+    label = 'WebDAV'
+
+    def __init__(self, config, state):
+        super().__init__(config, state)
+        section = config['PUBLISH']
+        self.base_url = section.get('WEBDAV_URL').strip().rstrip('/')
+        self.session.auth = (section.get('WEBDAV_USERNAME'), section.get('WEBDAV_PASSWORD'))
+
+    def upload(self, file_name, content):
+        response = send_with_retries(self.session, 'PUT', f"{self.base_url}/{quote(file_name)}",
+                                     self.max_retries, label=self.label, data=content)
+        if response.status_code in (200, 201, 204):
+            return True
+        if response.status_code == 401:
+            # 账号密码错误时后续文件也不会成功，停止上传
+            logger.error("WebDAV认证失败，请检查账号密码")
+            self.aborted = True
+        elif response.status_code == 409:
+            logger.error(f"WebDAV上传 {file_name} 冲突 (HTTP 409)，请检查目标目录是否存在")
+        else:
+            logger.error(f"WebDAV上传 {file_name} 失败 (HTTP {response.status_code})")
+        return False
+
+class KvPublisher(Publisher):
+    """上传到CF-Workers-TEXT2KV，文件内容放在请求体中"""
+    name = 'kv'
+    label = 'Cloudflare KV'
+
+    def __init__(self, config, state):
+        super().__init__(config, state)
+        section = config['PUBLISH']
+        domain = section.get('KV_DOMAIN').strip().rstrip('/')
+        self.base_url = domain if domain.startswith(('http://', 'https://')) else f"https://{domain}"
+        self.token = section.get('KV_TOKEN')
+        self.max_lines = section.getint('KV_MAX_LINES')
+
+    def content_for(self, file_path):
+        """只上传前KV_MAX_LINES行，0表示全部"""
+        content = file_path.read_bytes()
+        if self.max_lines > 0:
+            content = b''.join(content.splitlines(keepends=True)[:self.max_lines])
+        return content
+
+    def upload(self, file_name, content):
+        response = send_with_retries(self.session, 'POST', f"{self.base_url}/{quote(file_name)}",
+                                     self.max_retries, label=self.label, params={'token': self.token},
+                                     data=content, headers={'Content-Type': 'text/plain; charset=utf-8'})
+        if 200 <= response.status_code < 300:
+            return True
+        logger.error(f"Cloudflare KV上传 {file_name} 失败 (HTTP {response.status_code})")
+        return False
+
+def is_configured(value):
+    """配置值非空，且不是未设置的环境变量占位符 ${...}"""
+    value = value.strip()
+    return bool(value) and not value.startswith('${')
+
+def publish_outputs(config, output_dir, state):
+    """把输出目录中有变化的txt文件发布到已启用的WebDAV和Cloudflare KV，state为PublishState"""
+    section = config['PUBLISH']
+    publishers = []
+    if section.getboolean('WEBDAV_ENABLE'):
+        if is_configured(section.get('WEBDAV_URL')):
+            publishers.append(WebDavPublisher)
+        else:
+            logger.warning("WebDAV地址未设置，跳过WebDAV上传")
+    if section.getboolean('KV_ENABLE'):
+        if is_configured(section.get('KV_DOMAIN')) and is_configured(section.get('KV_TOKEN')):
+            publishers.append(KvPublisher)
+        else:
+            logger.warning("Cloudflare KV域名或令牌未设置，跳过KV上传")
+    if not publishers:
+        return
+
+    files = sorted(path for path in Path(output_dir).glob('*.txt') if path.is_file())
+    if not files:
+        logger.info("输出目录中没有要发布的文件")
+        return
+
+    for publisher_class in publishers:
+        publisher_class(config, state).publish(files)
+
+def open_state(config):
+    return PublishState(config.get('PUBLISH', 'STATE_FILE'))
+
+def save_state(state):
+    try:
+        state.save()
+    except OSError as e:
+        logger.warning(f"保存状态清单失败: {e}")
+
+class Exclusions:
+    """排除列表：合并后的地址区间，按二分查找判断地址是否被排除"""
+
+    def __init__(self, ranges):
+        merged = []
+        for first, last in sorted(ranges):
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], last)
+            else:
+                merged.append([first, last])
+        self.starts = [first for first, _ in merged]
+        self.ends = [last for _, last in merged]
+
+    def __bool__(self):
+        return bool(self.starts)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __contains__(self, ip):
+        i = bisect.bisect_right(self.starts, ip) - 1
+        return i >= 0 and ip <= self.ends[i]
+
+    @classmethod
+    def from_config(cls, config):
+        """读取EXCLUDE_FILES中的排除列表，每行一个IP或网段，#之后为注释"""
+        ranges = []
+        for path in config.get('SCAN', 'EXCLUDE_FILES').split(','):
+            path = path.strip()
+            if not path:
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        text = line.split('#', 1)[0].strip()
+                        if not text:
+                            continue
+                        item = CidrRange.parse(text) if '/' in text else Candidate.parse(text)
+                        if item is None:
+                            logger.warning(f"排除列表 {path} 中的条目无效: {text}")
+                        elif isinstance(item, CidrRange):
+                            ranges.append((item.first, item.last))
+                        else:
+                            ranges.append((item.ip, item.ip))
+            except OSError as e:
+                logger.warning(f"读取排除列表 {path} 失败: {e}")
+        exclusions = cls(ranges)
+        if exclusions:
+            logger.info(f"排除列表: {len(exclusions)} 个地址区间")
+        return exclusions
+
+class CidrScan:
+    """一个文件中网段的两阶段抽样检测
+
+    先检测每个块（IPv4为/24）中的少量样本，样本全部返回结果后，
+    只展开样本检测通过较多、延迟较低的块，检测块内其余地址。
+    网段和块都按需展开，不会一次生成网段中的全部地址。
+    """
+
+    def __init__(self, config, exclusions):
+        section = config['SCAN']
+        self.samples = max(1, section.getint('SAMPLES_PER_BLOCK'))
+        self.min_pass = max(1, section.getint('EXPAND_MIN_PASS'))
+        self.max_expand = section.getint('EXPAND_MAX_BLOCKS')
+        self.max_blocks = max(1, section.getint('MAX_BLOCKS_PER_RANGE'))
+        self.bits_v6 = 128 - min(128, max(112, section.getint('BLOCK_PREFIX_V6')))
+        self.exclusions = exclusions
+        self.blocks = {}  # 块编号 -> [起始地址, 结束地址, 端口, 标签, 通过的样本数, 最低延迟]
+        self.pending = False  # 已抽样但还没有决定展开哪些块
+        self.ranges = 0
+        self.sampled = 0
+        self.addresses = 0  # 网段包含的地址总数，即穷举检测需要的次数
+
+    def bits_for(self, ip):
+        return self.bits_v6 if ip >= IPV6_FLAG else 8
+
+    def offsets(self, first, size):
+        """块内样本的偏移，以块起始地址为随机种子，每次运行抽到相同的地址"""
+        count = min(self.samples, size)
+        if count == size:
+            return range(size)
+        rng = random.Random(first)
+        picked = set()
+        while len(picked) < count:
+            picked.add(rng.randrange(size))
+        return sorted(picked)
+
+    def flatten(self, source):
+        """把source中的网段替换为各块的样本地址，单个地址原样产出"""
+        for item in source:
+            if item.__class__ is CidrRange:
+                yield from self.sample(item)
+            else:
+                yield item
+
+    def sample(self, cidr):
+        self.ranges += 1
+        self.addresses += cidr.size
+        self.pending = True
+        bits = self.bits_for(cidr.first)
+        first_block = cidr.first >> bits
+        count = (cidr.last >> bits) - first_block + 1
+        picks = range(count)
+        if count > self.max_blocks:
+            logger.info(f"网段 {cidr} 包含 {count} 个块，随机抽取 {self.max_blocks} 个")
+            rng = random.Random(cidr.first)
+            chosen = set()
+            while len(chosen) < self.max_blocks:
+                chosen.add(rng.randrange(count))
+            picks = sorted(chosen)
+        for index in picks:
+            block = first_block + index
+            first = max(cidr.first, block << bits)
+            last = min(cidr.last, ((block + 1) << bits) - 1)
+            self.blocks.setdefault(block, [first, last, cidr.port, cidr.tag, 0, None])
+            for offset in self.offsets(first, last - first + 1):
+                ip = first + offset
+                if ip not in self.exclusions:
+                    self.sampled += 1
+                    yield Candidate(ip, cidr.port, cidr.tag)
+
+    def record(self, candidate, result):
+        if result:
+            entry = self.blocks.get(candidate.ip >> self.bits_for(candidate.ip))
+            if entry is not None:
+                entry[4] += 1
+                if result.rtt is not None and (entry[5] is None or result.rtt < entry[5]):
+                    entry[5] = result.rtt
+
+    def expansion(self, name):
+        """选择要展开的块，返回块内其余地址的迭代器，没有要展开的块时返回None"""
+        self.pending = False
+        blocks, self.blocks = self.blocks, {}
+        promising = [entry for entry in blocks.values() if entry[4] >= self.min_pass]
+        promising.sort(key=lambda entry: (entry[5] is None, entry[5] or 0))
+        if self.max_expand > 0:
+            promising = promising[:self.max_expand]
+        remaining = sum(last - first + 1 - min(self.samples, last - first + 1)
+                        for first, last, *_ in promising)
+        logger.info(f"{name}: {self.ranges} 个网段抽样 {len(blocks)} 个块, 检测样本 {self.sampled} 个, "
+                    f"展开 {len(promising)} 个块 (共检测约 {self.sampled + remaining} 个地址, "
+                    f"穷举需要 {self.addresses} 个)")
+        if not promising:
+            return None
+        return self.expand(promising)
+
+    def expand(self, blocks):
+        for first, last, port, tag, _, _ in blocks:
+            sampled = set(self.offsets(first, last - first + 1))
+            for offset in range(last - first + 1):
+                ip = first + offset
+                if offset not in sampled and ip not in self.exclusions:
+                    yield Candidate(ip, port, tag)
+
+class FileBatch:
+    """一个输入文件的处理状态：去重 → 先验过滤 → 收集检测结果 → 排序 → 测速
+
+    候选条目按需从source读取，只有检测通过的条目保留在内存中。
+    source中的网段先按块抽样，样本结果全部返回后由expand()决定是否继续检测。
+    目标模式下先读入全部候选条目按先验排序，再分轮检测，每个标签（按地址族）
+    检测通过的数量达到目标后不再检测该标签的其余条目。
+    """
+
+    def __init__(self, name, source, config, exclusions=None, settings=None):
+        self.name = name
+        # 读取和解析输入文件的耗时计入extract阶段
+        self.source = metrics.timed(source, 'extract')
+        self.exclusions = exclusions if exclusions is not None else Exclusions(())
+        self.scan = CidrScan(config, self.exclusions)
+        self.expansion = None
+        self.seq = 0
+        self.keep = csv_prior_filter(config)
+        self.counts = collections.Counter()
+        # 每个标签一个整数集合，按 IP+端口 去重
+        self.seen = collections.defaultdict(set)
+        self.survivors = []  # (输入序号, Candidate, ProbeResult)
+        self.outstanding = 0  # 已交给检测但尚未返回结果的条目数
+        self.exhausted = False
+        self.finished = False
+        # 目标模式：0 表示检测全部候选条目
+        goal = config.getint('IP_CHECK', 'GOAL_COUNT')
+        self.target = goal + max(0, config.getint('IP_CHECK', 'GOAL_MARGIN')) if goal > 0 else 0
+        self.max_latency = config.getfloat('IP_CHECK', 'MAX_LATENCY')
+        self.config = config
+        self.settings = settings  # 整次运行共用的CheckSettings，为None时按需从config解析
+        self.verified = collections.Counter()  # (标签, 是否IPv6) -> 检测通过且未超过最大延迟的数量
+        self.queue = None  # 目标模式下按先验排好序、尚未检测的候选条目
+        self.rounds = 0
+
+    def admitted(self, source):
+        """去重并过滤排除列表和先验较差的条目"""
+        excluded = self.exclusions.__contains__ if self.exclusions else None
+        for candidate in source:
+            self.counts['extracted'] += 1
+            keys = self.seen[candidate.tag]
+            key = candidate.key
+            if key in keys:
+                self.counts['duplicate'] += 1
+                continue
+            keys.add(key)
+            if excluded is not None and excluded(candidate.ip):
+                self.counts['excluded'] += 1
+                continue
+            if not self.keep(candidate):
+                self.counts['slow'] += 1
+                continue
+            yield candidate
+
+    def candidates(self):
+        """产出 (Candidate, token)，token为 (FileBatch, 输入序号, Candidate)"""
+        source = self.scan.flatten(self.source) if self.expansion is None else self.expansion
+        seq = self.seq
+        for candidate in (self.next_round(source) if self.target else self.admitted(source)):
+            if self.target and self.reached(candidate):
+                # 本轮已达到目标，尚未交给检测引擎的条目不再检测
+                self.counts['goal'] += 1
+                continue
+            self.outstanding += 1
+            yield candidate, (self, seq, candidate)
+            seq += 1
+        self.seq = seq
+        self.exhausted = True
+        if not self.scan.pending:
+            # 去重后不再需要，提前释放
+            self.seen = None
+
+    def reached(self, candidate):
+        return self.verified[(candidate.tag, candidate.is_v6)] >= self.target
+
+    def next_round(self, source):
+        """目标模式：每个未达标的标签取 缺少数量×2 个条目，之后每轮翻倍"""
+        if self.queue is None:
+            self.queue = order_by_prior([candidate for candidate in self.admitted(source)
+                                         if not self.reached(candidate)], self.config, self.settings)
+        self.rounds += 1
+        budget = collections.Counter()
+        picked = []
+        rest = []
+        for candidate in self.queue:
+            group = (candidate.tag, candidate.is_v6)
+            missing = self.target - self.verified[group]
+            if missing <= 0:
+                self.counts['goal'] += 1
+            elif budget[group] < max(4, missing * 2) << (self.rounds - 1):
+                budget[group] += 1
+                picked.append(candidate)
+            else:
+                rest.append(candidate)
+        self.queue = rest
+        return picked
+
+    def add_result(self, seq, candidate, result):
+        self.outstanding -= 1
+        self.counts['checked'] += 1
+        metrics.inc('probe_results_total', file=self.name, result='ok' if result else result.error or 'error')
+        if result and result.rtt is not None:
+            metrics.observe('probe_rtt_ms', result.rtt, file=self.name)
+        if self.scan.blocks:
+            self.scan.record(candidate, result)
+        if result:
+            self.survivors.append((seq, candidate, result))
+            if self.target and (self.max_latency <= 0 or result.rtt is None or result.rtt <= self.max_latency):
+                self.verified[(candidate.tag, candidate.is_v6)] += 1
+
+    def has_more(self):
+        """目标模式下还有未达标的标签等待下一轮检测"""
+        if self.queue and not any(not self.reached(candidate) for candidate in self.queue):
+            self.counts['goal'] += len(self.queue)
+            self.queue = []
+        return bool(self.queue)
+
+    def expand(self):
+        """上一轮结果全部返回后决定是否继续：目标模式的下一轮，或展开网段样本结果较好的块，
+        还有地址需要检测时返回True"""
+        if not self.exhausted or self.outstanding:
+            return False
+        if self.target and self.has_more():
+            self.exhausted = False
+            return True
+        if not self.scan.pending:
+            return False
+        if self.target and all(self.verified[(entry[3], entry[0] >= IPV6_FLAG)] >= self.target
+                               for entry in self.scan.blocks.values()):
+            # 网段所属的标签都已达标，不再展开
+            self.scan.pending = False
+            self.scan.blocks = {}
+            self.seen = None
+            return False
+        self.expansion = self.scan.expansion(self.name)
+        if self.expansion is None:
+            self.seen = None
+            return False
+        self.queue = None
+        self.exhausted = False
+        return True
+
+    def complete(self):
+        """所有条目都已读取并返回结果时返回True，每个文件只返回一次"""
+        if self.finished or not self.exhausted or self.outstanding or self.scan.pending:
+            return False
+        if self.target and self.has_more():
+            return False
+        self.finished = True
+        return True
+
+    def rank(self, config, check_enabled=True):
+        """输出统计并返回排好序的 [(Candidate, ProbeResult)]"""
+        counts = self.counts
+        logger.info(f"从文件 {self.name} 中提取到 {counts['extracted']} 个IP")
+        if counts['duplicate']:
+            logger.info(f"{self.name}: 跳过重复条目 {counts['duplicate']} 个")
+        if counts['excluded']:
+            logger.info(f"{self.name}: 跳过排除列表中的地址 {counts['excluded']} 个")
+        if counts['slow']:
+            logger.info(f"{self.name}: 根据CSV延迟/速度跳过 {counts['slow']} 个较慢的IP")
+        if counts['goal']:
+            logger.info(f"{self.name}: 已达到目标数量, {self.rounds} 轮检测后跳过其余 {counts['goal']} 个IP")
+        survivors = self.survivors
+        self.survivors = []
+        if check_enabled:
+            logger.info(f"{self.name}: IP检测完成: {len(survivors)}/{counts['checked']} 个IP有效")
+            log_phase_summary([probe for _, _, probe in survivors])
+
+        # 检测结果按完成顺序到达，先恢复输入顺序，再按先验和延迟排序（均为稳定排序）
+        survivors.sort(key=lambda entry: entry[0])
+        if config.getboolean('IP_CHECK', 'CSV_PRESORT'):
+            survivors.sort(key=lambda entry: prior_sort_key(entry[1]))
+        ranked = rank_by_latency([(candidate, probe) for _, candidate, probe in survivors], config)
+
+        # 下载测速，按实测速度排序
+        if ranked and config.getboolean('SPEED_TEST', 'ENABLE'):
+            ranked = rank_by_speed(ranked, config)
+        return ranked
+
+def interleave(batches, chunk=64, on_exhausted=None):
+    """轮流从每个文件读取最多chunk个候选条目，避免小文件排在大文件后面等待"""
+    active = collections.deque((batch, batch.candidates()) for batch in batches)
+    while active:
+        batch, candidates = active.popleft()
+        taken = 0
+        for entry in candidates:
+            yield entry
+            taken += 1
+            if taken >= chunk:
+                break
+        if taken >= chunk:
+            active.append((batch, candidates))
+        elif on_exhausted is not None:
+            on_exhausted(batch)
+
+def probe_batches(batches, config, on_complete, index=None, use_cache=True, settings=None):
+    """所有文件共用一个检测池，某个文件的条目全部返回结果后立即调用 on_complete(FileBatch)
+
+    use_cache为False时全部重新检测（结果仍写入缓存）。settings为整次运行共用的CheckSettings，
+    为None时解析一次，各轮检测共用，自适应超时不会在轮次之间重置。
+    """
+    if not config.getboolean('IP_CHECK', 'ENABLE_IP_CHECK'):
+        logger.info("IP检测已禁用，跳过检测")
+        for batch in batches:
+            for candidate, (_, seq, _) in batch.candidates():
+                batch.add_result(seq, candidate, ProbeResult(True))
+            # 不检测时无法判断哪些块值得展开，网段只保留样本
+            batch.scan.pending = False
+            batch.complete()
+            on_complete(batch)
+        return
+
+    if index is None:
+        index = ProbeIndex(config)
+    if settings is None:
+        settings = CheckSettings(config)
+
+    def on_exhausted(batch):
+        # 最后一批结果可能在读完文件之前就已返回（例如全部命中缓存）
+        if batch.complete():
+            on_complete(batch)
+
+    def on_result(token, result):
+        batch, seq, candidate = token
+        batch.add_result(seq, candidate, result)
+        if batch.complete():
+            on_complete(batch)
+
+    index.probe(interleave(batches, on_exhausted=on_exhausted), config, on_result, use_cache=use_cache,
+                settings=settings)
+
+    # 后续阶段：目标模式的下一轮检测，或只展开样本检测结果较好的网段块
+    while True:
+        expanding = [batch for batch in batches if batch.expand()]
+        if not expanding:
+            break
+        index.probe(interleave(expanding, on_exhausted=on_exhausted), config, on_result, desc="继续检测",
+                    use_cache=use_cache, settings=settings)
+    # 没有块需要展开的文件在这里完成
+    for batch in batches:
+        if batch.complete():
+            on_complete(batch)
+
+def process_candidates(source, config, index=None, settings=None):
+    """流式处理一组候选条目，返回排好序的 [(Candidate, ProbeResult)]
+
+    source为Candidate的可迭代对象；index为整次运行共享的ProbeIndex，
+    已检测过的端点直接复用结果；settings为已解析的CheckSettings。
+    """
+    if settings is None:
+        settings = CheckSettings(config)
+    batch = FileBatch('input', source, config, Exclusions.from_config(config), settings)
+    probe_batches([batch], config, lambda _: None, index, settings=settings)
+    return batch.rank(config, config.getboolean('IP_CHECK', 'ENABLE_IP_CHECK'))
+
+def write_output(batch, output_dir, config, state=None):
+    """排序并写出一个文件的结果，只在这里把记录格式化为文本，返回排好序的 [(Candidate, ProbeResult)]
+
+    state为PublishState时，要写出的内容（包括排名顺序）与清单中的哈希相同则保留原文件不改写；
+    写入时先写临时文件再替换，不会留下不完整的输出文件。
+    """
+    with metrics.stage('write'):
+        ranked = batch.rank(config, config.getboolean('IP_CHECK', 'ENABLE_IP_CHECK'))
+        if not ranked:
+            logger.info(f"文件 {batch.name} 中没有找到有效的IP地址")
+            return ranked
+        output_file = output_dir / f"{Path(batch.name).stem}.txt"
+        lines = [f"{result}\n" for result, _ in ranked]
+        # 排名顺序变化也要改写：KV只发布前几行，从文件读取的上传也按文件顺序排名
+        digest = hashlib.sha256(''.join(lines).encode('utf-8')).hexdigest()
+        outputs = state.section('outputs') if state is not None else {}
+        if outputs.get(output_file.name) == digest and output_file.exists():
+            logger.info(f"成功处理文件: {batch.name} -> {output_file.name} (找到 {len(ranked)} 个IP, 结果无变化)")
+            return ranked
+        tmp_file = output_file.with_name(output_file.name + '.tmp')
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.writelines(lines)
+            os.replace(tmp_file, output_file)
+            outputs[output_file.name] = digest
+            logger.info(f"成功处理文件: {batch.name} -> {output_file.name} (找到 {len(ranked)} 个IP)")
+        except Exception as e:
+            logger.error(f"写入文件 {output_file} 时出错: {e}")
+        return ranked
+
+def process_files(config, dry_run=False):
+    """处理ips目录下的所有文件，dry_run为True时只输出DNS同步计划"""
     # 创建目录
     input_dir = Path(config.get('INPUT', 'INPUT_DIR'))
     output_dir = Path(config.get('OUTPUT', 'OUTPUT_DIR'))
@@ -741,8 +3789,12 @@ def process_files(config):
             logger.info(f"  {item.name}")
         return
     
+    # 状态清单在整次运行中共享，结束时保存
+    state = open_state(config)
     # 初始化Cloudflare管理器
-    cf_manager = CloudflareManager(config)
+    cf_manager = CloudflareManager(config, dry_run, state)
+    # 所有文件共用一个检测索引，同一端点只检测一次
+    index = ProbeIndex(config)
     
     # 检查输入目录中的文件
     file_count = 0
@@ -758,47 +3810,327 @@ def process_files(config):
         example_file.write_text("8.8.8.8\n1.1.1.1\n", encoding='utf-8')
         logger.info(f"已创建示例文件: {example_file}")
     
-    # 遍历输入目录下的所有文件
-    for file_path in input_dir.iterdir():
+    # 收集输入目录下的所有文件，每个文件对应一个按需读取的候选条目流
+    sources = input_sources(input_dir)
+    
+    try:
+        with metrics.stage('probe'):
+            ranked_files = probe_sources(sources, config, output_dir, index, state)
+        index.log_summary()
+
+        # 上传到Cloudflare
+        with metrics.stage('dns_sync'):
+            cf_manager.upload_ips_to_cloudflare(uploadable(ranked_files, config, output_dir))
+
+        # 发布到WebDAV和Cloudflare KV
+        if not dry_run:
+            with metrics.stage('publish'):
+                publish_outputs(config, output_dir, state)
+    finally:
+        save_state(state)
+        metrics.write_reports(config)
+
+def open_candidate_source(file_path):
+    """返回文件的候选条目迭代器，不支持的文件类型返回None"""
+    filename_without_ext = file_path.stem  # 获取不带扩展名的文件名
+    if file_path.suffix.lower() == '.txt':
+        return iter_ips_from_txt(file_path, filename_without_ext)
+    if file_path.suffix.lower() == '.csv':
+        return iter_ips_from_csv(file_path, filename_without_ext)
+    return None
+
+def input_sources(input_dir):
+    """返回输入目录下每个支持的文件的 (文件名, 候选条目迭代器)，文件在检测时才按需读取"""
+    sources = []
+    for file_path in sorted(input_dir.iterdir()):
         if file_path.is_file():
-            filename_without_ext = file_path.stem  # 获取不带扩展名的文件名
-            results = []
-            
-            logger.info(f"处理文件: {file_path.name}")
-            
-            if file_path.suffix.lower() == '.txt':
-                results = extract_ips_from_txt(file_path, filename_without_ext)
-            elif file_path.suffix.lower() == '.csv':
-                results = extract_ips_from_csv(file_path, filename_without_ext)
-            else:
+            source = open_candidate_source(file_path)
+            if source is None:
                 logger.info(f"跳过不支持的文件类型: {file_path}")
                 continue
-            
-            logger.info(f"从文件中提取到 {len(results)} 个IP")
-            
-            # 检测IP可用性
-            if results and config.getboolean('IP_CHECK', 'ENABLE_IP_CHECK'):
-                valid_results = check_ips(results, config)
-                # 只保留有效的IP
-                filtered_results = [result for result, valid in zip(results, valid_results) if valid]
-                logger.info(f"IP检测完成: {len(filtered_results)}/{len(results)} 个IP有效")
-                results = filtered_results
-            
-            # 写入输出文件
-            if results:
-                output_file = output_dir / f"{file_path.stem}.txt"
-                try:
-                    with open(output_file, 'w', encoding='utf-8') as f:
-                        for result in results:
-                            f.write(result + '\n')
-                    logger.info(f"成功处理文件: {file_path.name} -> {output_file.name} (找到 {len(results)} 个IP)")
-                except Exception as e:
-                    logger.error(f"写入文件 {output_file} 时出错: {e}")
-            else:
-                logger.info(f"文件 {file_path.name} 中没有找到有效的IP地址")
-    
-    # 上传到Cloudflare
-    cf_manager.upload_ips_to_cloudflare()
+            logger.info(f"处理文件: {file_path.name}")
+            sources.append((file_path.name, source))
+    return sources
+
+def probe_sources(sources, config, output_dir, index=None, state=None, use_cache=True, settings=None):
+    """检测 [(文件名, 候选条目)] 并写出结果，返回 {文件名(不含扩展名): [(Candidate, ProbeResult)]}
+
+    所有文件轮流送入同一个检测池，某个文件检测完成后立即在后台排序、测速并写出，
+    不阻塞其他文件的检测。settings为已解析的CheckSettings，为None时解析一次供所有文件共用。
+    """
+    if settings is None:
+        settings = CheckSettings(config)
+    exclusions = Exclusions.from_config(config)
+    batches = [FileBatch(name, source, config, exclusions, settings) for name, source in sources]
+    ranked_files = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as writer:
+        pending = []
+
+        def on_complete(batch):
+            pending.append((batch, writer.submit(write_output, batch, output_dir, config, state)))
+
+        probe_batches(batches, config, on_complete, index, use_cache, settings)
+        for batch, future in pending:
+            ranked_files[Path(batch.name).stem] = future.result()
+    return ranked_files
+
+def uploadable(ranked_files, config, output_dir):
+    """上传目录就是输出目录时，上传时直接使用内存中的检测结果选择记录"""
+    if Path(config.get('cloudflare', 'upload_dir')).resolve() != output_dir.resolve():
+        return None
+    return ranked_files
+
+class InputFiles:
+    """常驻模式下缓存输入目录中已解析的候选条目，只有修改过的文件才重新读取"""
+
+    def __init__(self, input_dir):
+        self.input_dir = input_dir
+        self.files = {}  # 路径 -> ((修改时间, 大小), [Candidate])
+
+    def stamps(self):
+        stamps = {}
+        if self.input_dir.exists():
+            for file_path in sorted(self.input_dir.iterdir()):
+                if file_path.is_file() and file_path.suffix.lower() in ('.txt', '.csv'):
+                    stat = file_path.stat()
+                    stamps[file_path] = (stat.st_mtime_ns, stat.st_size)
+        return stamps
+
+    def changed(self):
+        return self.stamps() != {path: stamp for path, (stamp, _) in self.files.items()}
+
+    def load(self):
+        """返回 [(文件名, [Candidate])]，未修改的文件直接使用上次解析的结果"""
+        stamps = self.stamps()
+        for path in list(self.files):
+            if path not in stamps:
+                del self.files[path]
+        for path, stamp in stamps.items():
+            cached = self.files.get(path)
+            if cached is None or cached[0] != stamp:
+                logger.info(f"读取文件: {path.name}")
+                self.files[path] = (stamp, list(open_candidate_source(path)))
+        return [(path.name, candidates) for path, (_, candidates) in self.files.items()]
+
+def reprobe_published(cf_manager, config, settings=None):
+    """不使用缓存重新检测所有已发布的记录，失败的立即替换"""
+    entries = [(candidate, candidate) for selected in cf_manager.published.values()
+               for candidate, _ in selected]
+    if not entries:
+        return
+    failed = set()
+
+    def on_result(candidate, result):
+        if not result:
+            failed.add(candidate.host)
+
+    ProbeIndex(config).probe(entries, config, on_result, desc="检测已发布IP", use_cache=False, settings=settings)
+    if failed:
+        cf_manager.replace_failed(failed)
+    else:
+        logger.info(f"已发布的 {len(entries)} 条记录检测正常")
+
+def run_daemon(config, dry_run=False):
+    """常驻模式：定期重新检测已发布记录和全部候选IP，输入文件变化时立即重新加载"""
+    input_dir = Path(config.get('INPUT', 'INPUT_DIR'))
+    output_dir = Path(config.get('OUTPUT', 'OUTPUT_DIR'))
+    output_dir.mkdir(exist_ok=True)
+    published_interval = config.getfloat('DAEMON', 'PUBLISHED_INTERVAL')
+    pool_interval = config.getfloat('DAEMON', 'POOL_INTERVAL')
+    reload_interval = config.getfloat('DAEMON', 'RELOAD_INTERVAL')
+    logger.info(f"常驻模式: 已发布记录每 {published_interval:g} 秒检测一次, "
+                f"候选IP每 {pool_interval:g} 秒检测一次")
+
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        logger.info("收到退出信号，正在停止")
+        stop.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    state = open_state(config)
+    cf_manager = CloudflareManager(config, dry_run, state)
+    inputs = InputFiles(input_dir)
+    # 检测参数只解析一次，自适应超时的延迟统计在各次检测间保留
+    settings = CheckSettings(config)
+    next_pool = next_published = time.monotonic()
+    next_reload = next_pool + reload_interval
+    first = True
+    while not stop.is_set():
+        now = time.monotonic()
+        reload = now >= next_reload and inputs.changed()
+        if now >= next_reload:
+            next_reload = now + reload_interval
+        if reload or now >= next_pool:
+            if reload:
+                logger.info("输入文件有变化，重新加载")
+            # 定时的全量检测不使用缓存，否则只会重放缓存中的旧结果，发现不了候选IP的失效和恢复；
+            # 启动时和只因输入文件变化触发的检测仍使用缓存
+            use_cache = first or now < next_pool
+            first = False
+            index = ProbeIndex(config)
+            with metrics.stage('probe'):
+                ranked_files = probe_sources(inputs.load(), config, output_dir, index, state, use_cache, settings)
+            index.log_summary()
+            with metrics.stage('dns_sync'):
+                cf_manager.upload_ips_to_cloudflare(uploadable(ranked_files, config, output_dir))
+            if not dry_run:
+                with metrics.stage('publish'):
+                    publish_outputs(config, output_dir, state)
+            save_state(state)
+            metrics.write_reports(config)
+            next_pool = time.monotonic() + pool_interval
+            next_published = time.monotonic() + published_interval
+        elif now >= next_published:
+            with metrics.stage('reprobe'):
+                reprobe_published(cf_manager, config, settings)
+            save_state(state)
+            metrics.write_reports(config)
+            next_published = time.monotonic() + published_interval
+        stop.wait(max(0.0, min(next_pool, next_published, next_reload) - time.monotonic()))
+
+class Settings:
+    """库接口使用的配置，创建时从configparser配置解析一次
+
+    check为解析后的CheckSettings，Prober的所有检测都使用它（包括文件检测的每一轮），
+    不会按IP或按文件重新解析，自适应超时的统计也在各次检测间保留。
+    config保留原始配置，只供网段扫描、缓存、DNS同步等组件在创建时读取各自的参数。
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.check = CheckSettings(config)
+        self.input_dir = Path(config.get('INPUT', 'INPUT_DIR'))
+        self.output_dir = Path(config.get('OUTPUT', 'OUTPUT_DIR'))
+        self.dns_enabled = config.getboolean('cloudflare', 'enable')
+
+    @classmethod
+    def load(cls, path='config.ini', overrides=None):
+        """读取path（不存在或为None时使用默认配置，不会创建文件），overrides为 {节: {键: 值}}"""
+        config = load_config(path)
+        if overrides:
+            config.read_dict(overrides)
+        return cls(config)
+
+def parse_candidate(item):
+    """解析 "ip:端口#标签" 或 "网段#标签" 格式的文本，返回Candidate或CidrRange，无效返回None"""
+    address, _, tag = item.partition('#')
+    if '/' in address:
+        return CidrRange.parse(address, tag=tag.strip())
+    return Candidate.parse(item)
+
+class Extractor:
+    """从输入文件读取候选条目的库接口，产出Candidate和CidrRange（网段），文件按需流式读取"""
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    def iter_file(self, file_path):
+        """逐条产出文件中的候选条目，标签默认为不带扩展名的文件名；不支持的文件类型不产出任何条目"""
+        file_path = Path(file_path)
+        source = open_candidate_source(file_path)
+        if source is None:
+            logger.warning(f"不支持的文件类型: {file_path}")
+            return iter(())
+        return source
+
+    def sources(self):
+        """输入目录下每个支持的文件的 (文件名, 候选条目迭代器)，目录不存在时返回空列表"""
+        if not self.settings.input_dir.is_dir():
+            logger.warning(f"输入目录不存在: {self.settings.input_dir}")
+            return []
+        return input_sources(self.settings.input_dir)
+
+    def extract(self, file_path):
+        return list(self.iter_file(file_path))
+
+    async def async_extract(self, file_path):
+        """在线程中读取文件，不阻塞调用方的事件循环"""
+        return await asyncio.to_thread(self.extract, file_path)
+
+class Prober:
+    """检测候选条目的库接口
+
+    check/async_check检测单个端点；probe/async_probe完整处理一组候选条目（展开网段、
+    排除列表、端点去重、检测缓存、目标模式和排序），返回排好序的 [(Candidate, ProbeResult)]。
+    所有检测共用settings.check；检测引擎自己控制并发，同一Prober上的probe调用依次执行。
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.lock = threading.Lock()
+
+    def check(self, ip, port=None):
+        """检测一个IP，port为None时使用CHECK_PORT，返回ProbeResult"""
+        return check_ip(ip, port, self.settings.check)
+
+    async def async_check(self, ip, port=None):
+        """在调用方的事件循环中检测一个IP，ping检测使用系统ping命令"""
+        check = self.settings.check
+        if not check.enabled:
+            return ProbeResult(True)
+        return await async_check_ip(ip, port or check.check_port, check.method, check.timeout,
+                                    check.attempts, check.options)
+
+    def probe(self, candidates):
+        """candidates为Candidate、CidrRange或可由parse_candidate解析的文本，按需读取，无效的文本跳过"""
+        source = (parse_candidate(item) if isinstance(item, str) else item for item in candidates)
+        with self.lock:
+            return process_candidates((item for item in source if item is not None), self.settings.config,
+                                      settings=self.settings.check)
+
+    def probe_files(self, write=False):
+        """检测输入目录下的所有文件，所有文件共用一个检测池，返回 {文件名(不含扩展名): [(Candidate, ProbeResult)]}
+
+        write为True时同时把结果写入输出目录（与命令行运行相同）。
+        """
+        config = self.settings.config
+        check = self.settings.check
+        sources = Extractor(self.settings).sources()
+        with self.lock:
+            if write:
+                self.settings.output_dir.mkdir(parents=True, exist_ok=True)
+                return probe_sources(sources, config, self.settings.output_dir, settings=check)
+            exclusions = Exclusions.from_config(config)
+            batches = [FileBatch(name, source, config, exclusions, check) for name, source in sources]
+            ranked_files = {}
+
+            def on_complete(batch):
+                ranked_files[Path(batch.name).stem] = batch.rank(config, check.enabled)
+
+            probe_batches(batches, config, on_complete, ProbeIndex(config), settings=check)
+            return ranked_files
+
+    async def async_probe(self, candidates):
+        """在线程中运行probe，不阻塞调用方的事件循环；并发由检测引擎自己控制"""
+        return await asyncio.to_thread(self.probe, candidates)
+
+class DnsSync:
+    """把检测结果同步到Cloudflare DNS的库接口，每个标签对应一个子域名，只提交有差异的记录
+
+    state为PublishState时记录已发布的结果，结果不变的子域名不再发送请求。
+    """
+
+    def __init__(self, settings, dry_run=False, state=None):
+        self.manager = CloudflareManager(settings.config, dry_run, state)
+
+    @property
+    def enabled(self):
+        return self.manager.enable
+
+    def sync(self, ranked):
+        """ranked为排好序的 [(Candidate, ProbeResult)]（如Prober.probe的结果）或 {标签: [(Candidate, ProbeResult)]}"""
+        if not self.manager.enable:
+            logger.info("Cloudflare功能未启用，跳过同步")
+            return
+        tag_groups = ranked if isinstance(ranked, dict) else group_by_tag(ranked)
+        self.manager.sync({self.manager.subdomain_for(tag): entries for tag, entries in tag_groups.items()})
+
+    async def async_sync(self, ranked):
+        """在线程中同步，不阻塞调用方的事件循环"""
+        await asyncio.to_thread(self.sync, ranked)
 
 def print_config_summary(config):
     """打印配置摘要"""
@@ -810,11 +4142,43 @@ def print_config_summary(config):
     logger.info(f"  IP检测启用: {config.getboolean('IP_CHECK', 'ENABLE_IP_CHECK')}")
     if config.getboolean('IP_CHECK', 'ENABLE_IP_CHECK'):
         logger.info(f"  检测方法: {config.get('IP_CHECK', 'CHECK_METHOD')}")
-        if config.get('IP_CHECK', 'CHECK_METHOD') == 'port':
+        if config.get('IP_CHECK', 'CHECK_METHOD') in ('port', 'tls', 'http'):
             logger.info(f"  检测端口: {config.getint('IP_CHECK', 'CHECK_PORT')}")
+        if config.get('IP_CHECK', 'CHECK_METHOD') in ('tls', 'http'):
+            logger.info(f"  SNI/Host: {config.get('IP_CHECK', 'TLS_SNI') or config.get('IP_CHECK', 'HTTP_HOST')}")
         logger.info(f"  检测超时: {config.getfloat('IP_CHECK', 'CHECK_TIMEOUT')}秒")
-        logger.info(f"  检测线程数: {config.getint('IP_CHECK', 'CHECK_THREADS')}")
+        if config.getboolean('IP_CHECK', 'ADAPTIVE_TIMEOUT'):
+            logger.info(f"  自适应超时: P{config.getfloat('IP_CHECK', 'TIMEOUT_PERCENTILE'):g} × "
+                        f"{config.getfloat('IP_CHECK', 'TIMEOUT_MULTIPLIER'):g}, "
+                        f"下限 {config.getfloat('IP_CHECK', 'TIMEOUT_FLOOR'):g}秒")
+        logger.info(f"  检测次数: {config.getint('IP_CHECK', 'CHECK_ATTEMPTS')}")
+        if config.getfloat('IP_CHECK', 'MAX_LATENCY') > 0:
+            logger.info(f"  最大延迟: {config.getfloat('IP_CHECK', 'MAX_LATENCY')}毫秒")
+        logger.info(f"  按延迟排序: {config.getboolean('IP_CHECK', 'SORT_BY_LATENCY')}")
+        logger.info(f"  检测引擎: {config.get('IP_CHECK', 'CHECK_ENGINE')}")
+        if config.get('IP_CHECK', 'CHECK_ENGINE').strip().lower() == 'asyncio':
+            logger.info(f"  检测并发数: {config.getint('IP_CHECK', 'CHECK_CONCURRENCY')}")
+        else:
+            logger.info(f"  检测线程数: {config.getint('IP_CHECK', 'CHECK_THREADS')}")
     
+    if config.getboolean('CACHE', 'ENABLE'):
+        logger.info(f"  检测缓存: {config.get('CACHE', 'CACHE_FILE')} "
+                    f"(成功 {config.getfloat('CACHE', 'POSITIVE_TTL'):g}秒, "
+                    f"失败 {config.getfloat('CACHE', 'NEGATIVE_TTL'):g}秒)")
+
+    if config.getboolean('SPEED_TEST', 'ENABLE'):
+        logger.info(f"  下载测速: 前{config.getint('SPEED_TEST', 'TOP_K')}个IP, "
+                    f"并发 {config.getint('SPEED_TEST', 'CONCURRENCY')}, "
+                    f"最低速度 {config.getfloat('SPEED_TEST', 'MIN_SPEED')}kB/s")
+
+    if config.get('REPORT', 'REPORT_FILE').strip():
+        logger.info(f"  运行报告: {config.get('REPORT', 'REPORT_FILE').strip()}")
+
+    publish_targets = [name for key, name in (('WEBDAV_ENABLE', 'WebDAV'), ('KV_ENABLE', 'Cloudflare KV'))
+                       if config.getboolean('PUBLISH', key)]
+    if publish_targets:
+        logger.info(f"  发布目标: {', '.join(publish_targets)}")
+
     # Cloudflare配置
     if config.getboolean('cloudflare', 'enable'):
         logger.info("  Cloudflare配置:")
@@ -827,20 +4191,46 @@ def print_config_summary(config):
         logger.info(f"    记录名称前缀: '{config.get('cloudflare', 'record_name')}'")
         logger.info(f"    记录类型: {config.get('cloudflare', 'record_type')}")
         logger.info(f"    每行最大记录数: {config.getint('cloudflare', 'max_records_per_line')}")
+        if config.getint('cloudflare', 'max_per_subnet') > 0:
+            logger.info(f"    同一/{config.getint('cloudflare', 'subnet_prefix')} (IPv6 /{config.getint('cloudflare', 'subnet_prefix_v6')})网段最多: "
+                        f"{config.getint('cloudflare', 'max_per_subnet')} 个")
+        logger.info(f"    替换阈值: {config.getfloat('cloudflare', 'replace_margin'):g}%")
         logger.info(f"    上传目录: {config.get('cloudflare', 'upload_dir')}")
         logger.info(f"    上传文件: {config.get('cloudflare', 'upload_files')}")
+        logger.info(f"    API速率: 每秒{config.getfloat('cloudflare', 'api_rate'):g}次, "
+                    f"并发 {config.getint('cloudflare', 'api_concurrency')}, "
+                    f"批量大小 {config.getint('cloudflare', 'batch_size')}")
     else:
         logger.info("  Cloudflare功能: 禁用")
     
     logger.info("=" * 50)
 
-if __name__ == "__main__":
+def main(argv=None):
+    """命令行入口：配置日志，加载配置（不存在时创建带注释的模板），处理一次或常驻运行"""
+    parser = argparse.ArgumentParser(description="IP提取、检测并上传到Cloudflare DNS")
+    parser.add_argument('--dry-run', action='store_true', help="只输出Cloudflare DNS同步计划，不提交变更")
+    parser.add_argument('--daemon', action='store_true', help="常驻运行，持续检测已发布的记录并及时替换失效IP")
+    parser.add_argument('--profile', action='store_true', help="按阶段收集cProfile数据，写入[REPORT] PROFILE_DIR")
+    args = parser.parse_args(argv)
+    setup_logging()
+    
     # 加载配置
-    config = load_config()
+    config = load_config(create_missing=True)
+    if args.profile:
+        metrics.profile_dir = Path(config.get('REPORT', 'PROFILE_DIR'))
+    prometheus_port = config.getint('REPORT', 'PROMETHEUS_PORT')
+    if args.daemon and prometheus_port > 0:
+        metrics.serve(prometheus_port, config.get('REPORT', 'PROMETHEUS_BIND').strip() or '127.0.0.1')
     
     # 打印配置摘要
     print_config_summary(config)
     
-    # 处理文件
-    process_files(config)
-    logger.info("处理完成！请检查output目录下的文件。")
+    if args.daemon:
+        run_daemon(config, args.dry_run)
+    else:
+        # 处理文件
+        process_files(config, args.dry_run)
+        logger.info("处理完成！请检查output目录下的文件。")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+"""ip_processor的离线测试：不访问网络，Cloudflare API使用benchmark.py中的MockCloudflare"""
+import socket
+
+import pytest
+
+import ip_processor as ipp
+from benchmark import MockCloudflare
+
+
+class RankedBatch:
+    """write_output只需要文件名和排好序的结果"""
+
+    def __init__(self, name, ranked):
+        self.name = name
+        self.ranked = ranked
+
+    def rank(self, config, enabled):
+        return self.ranked
+
+
+def ranked(*hosts):
+    return [(ipp.Candidate.parse(f"{host}#HK"), ipp.ProbeResult(True, rtt)) for rtt, host in enumerate(hosts, 1)]
+
+
+def test_write_output_rewrites_when_order_changes(tmp_path):
+    config = ipp.load_config(None)
+    state = ipp.PublishState(tmp_path / 'state.json')
+    output_file = tmp_path / 'HK.txt'
+
+    ipp.write_output(RankedBatch('HK.txt', ranked('1.1.1.1', '2.2.2.2')), tmp_path, config, state)
+    assert output_file.read_text(encoding='utf-8').splitlines() == ['1.1.1.1#HK', '2.2.2.2#HK']
+
+    # 同一组IP排名变化后必须改写，否则KV等只取前几行的发布目标会发布旧的排名
+    ipp.write_output(RankedBatch('HK.txt', ranked('2.2.2.2', '1.1.1.1')), tmp_path, config, state)
+    assert output_file.read_text(encoding='utf-8').splitlines() == ['2.2.2.2#HK', '1.1.1.1#HK']
+
+    # 内容完全相同时不改写
+    mtime = output_file.stat().st_mtime_ns
+    ipp.write_output(RankedBatch('HK.txt', ranked('2.2.2.2', '1.1.1.1')), tmp_path, config, state)
+    assert output_file.stat().st_mtime_ns == mtime
+
+
+def test_shortened_timeout_failures_are_not_cached(tmp_path):
+    config = ipp.load_config(None)
+    config.read_dict({'IP_CHECK': {'TIMEOUT_MIN_SAMPLES': '2', 'TIMEOUT_FLOOR': '0.5'}})
+    cache = ipp.ProbeCache(str(tmp_path / 'cache.sqlite'), 86400, 3600, 0)
+    timeouts = ipp.AdaptiveTimeout(config, 2.0)
+    results = {}
+    record, flush = cache.recorder(results.__setitem__)
+    hosts = ['10.0.0.1', '10.0.1.1', '10.0.2.1', '10.0.3.1']
+    keys = {ip: cache.make_key(ip, 443, 'port') for ip in hosts}
+    jobs, on_result = timeouts.wrap(((ip, 443, (keys[ip], ip)) for ip in hosts), record)
+    outcomes = [ipp.ProbeResult(False, error='timeout'), ipp.ProbeResult(True, 10.0),
+                ipp.ProbeResult(True, 12.0), ipp.ProbeResult(False, error='timeout')]
+
+    # 模拟检测引擎：取得超时后检测，结果在调度线程中回调
+    used = []
+    for (ip, port, token), outcome in zip(jobs, outcomes):
+        used.append(timeouts.timeout_for(ip))
+        on_result(token, outcome)
+    flush()
+
+    assert used[0] == 2.0 and used[3] < 2.0
+    cached = cache.lookup(keys.values())
+    # 使用完整CHECK_TIMEOUT的失败照常缓存，缩短超时后的失败只影响本次运行
+    assert not cached[keys['10.0.0.1']]
+    assert cached[keys['10.0.1.1']]
+    assert keys['10.0.3.1'] not in cached
+    assert results['10.0.3.1'].error == 'timeout'
+    cache.close()
+
+
+def test_check_settings_resolved_once_per_run(tmp_path, monkeypatch):
+    created = []
+    original = ipp.CheckSettings.__init__
+
+    def counting(self, config):
+        created.append(self)
+        original(self, config)
+
+    monkeypatch.setattr(ipp.CheckSettings, '__init__', counting)
+    config = ipp.load_config(None)
+    # 回环地址的1端口拒绝连接，目标模式会检测多轮；启用缓存时目标模式还会按缓存排序
+    config.read_dict({
+        'IP_CHECK': {'CHECK_METHOD': 'port', 'CHECK_PORT': '1', 'GOAL_COUNT': '1'},
+        'CACHE': {'ENABLE': 'true', 'CACHE_FILE': str(tmp_path / 'cache.sqlite')},
+    })
+    sources = [(f"{name}.txt", [ipp.Candidate.parse(f"127.0.0.{i}#{name}") for i in range(1, 21)])
+               for name in ('A', 'B')]
+    ipp.probe_sources(sources, config, tmp_path)
+    assert len(created) == 1
+
+    # 直接传入配置时同一配置对象只解析一次
+    created.clear()
+    for _ in range(3):
+        assert not ipp.check_ip('127.0.0.1', 1, config)
+    assert len(created) == 1
+
+
+@pytest.fixture
+def cloudflare():
+    mock = MockCloudflare()
+    yield mock
+    mock.close()
+
+
+def dns_config(mock, **overrides):
+    config = ipp.load_config(None)
+    config.read_dict({'cloudflare': {
+        'enable': 'true', 'api_token': 'token', 'zone_id': 'zone', 'domain': 'example.com',
+        'record_name': 'ip', 'record_type': 'A', 'api_base': mock.api_base, 'api_rate': '0',
+        'max_records_per_line': '3', **overrides}})
+    return config
+
+
+def contents(mock, name):
+    return sorted(record['content'] for record in mock.records.values() if record['name'] == name)
+
+
+def test_apply_batches_stops_at_first_failed_chunk(cloudflare):
+    manager = ipp.CloudflareManager(dns_config(cloudflare, batch_size='1'))
+    name = manager.fqdn(manager.subdomain_for('HK'))
+    for i in range(1, 5):
+        cloudflare.create({'name': name, 'type': 'A', 'content': f"10.0.0.{i}"})
+    # 4条旧记录换成3个新IP：3条原地更新 + 1条删除，每批1条变更，第2批失败
+    cloudflare.fail_batches = {2}
+    manager.sync({manager.subdomain_for('HK'): ranked('10.1.0.1', '10.1.0.2', '10.1.0.3')})
+
+    # 失败之后的更新和删除都没有提交，记录数不会少于目标数量
+    assert cloudflare.batch_calls == 2
+    assert len(contents(cloudflare, name)) == 4
+    assert '10.1.0.1' in contents(cloudflare, name)
+
+    # 下次同步按新的快照重新规划并补齐
+    cloudflare.fail_batches = set()
+    manager.sync({manager.subdomain_for('HK'): ranked('10.1.0.1', '10.1.0.2', '10.1.0.3')})
+    assert contents(cloudflare, name) == ['10.1.0.1', '10.1.0.2', '10.1.0.3']
+
+
+def test_sync_submits_changes_in_batches(cloudflare):
+    manager = ipp.CloudflareManager(dns_config(cloudflare, batch_size='2'))
+    entries = {manager.subdomain_for(tag): ranked(*(f"10.{n}.0.{i}" for i in range(1, 4)))
+               for n, tag in enumerate(('HK', 'US'), 1)}
+    manager.sync(entries)
+
+    # 6条新增按batch_size分成3批，不再逐条请求
+    assert cloudflare.batch_calls == 3
+    assert contents(cloudflare, manager.fqdn(manager.subdomain_for('US'))) == ['10.2.0.1', '10.2.0.2', '10.2.0.3']
+
+    # 记录与期望一致时不提交任何批次
+    manager.sync(entries)
+    assert cloudflare.batch_calls == 3
+
+
+def test_plan_changes_reuses_stale_records(cloudflare):
+    manager = ipp.CloudflareManager(dns_config(cloudflare))
+    records = [{'id': str(i), 'type': 'A', 'content': ip}
+               for i, ip in enumerate(('10.0.0.1', '10.0.0.1', '10.9.0.1', '10.9.0.2'))]
+    snapshot = {manager.fqdn('hk'): records, manager.fqdn('us'): [{'id': '9', 'type': 'A', 'content': '10.2.0.1'}]}
+
+    plan = manager.plan_changes({'hk': ['10.0.0.1', '10.0.0.2'], 'us': ['10.2.0.1'], 'jp': ['10.3.0.1']}, snapshot)
+
+    # 重复的10.0.0.1和旧记录先原地改为新IP，多余的删除；无变化的子域名不出现
+    to_update, to_create, to_delete = plan['hk']
+    assert [(record['id'], ip) for record, ip in to_update] == [('1', '10.0.0.2')]
+    assert to_create == []
+    assert [record['id'] for record in to_delete] == ['2', '3']
+    assert plan['jp'] == ([], ['10.3.0.1'], [])
+    assert 'us' not in plan
+
+
+def test_select_records_keeps_published_ip_within_margin(cloudflare):
+    manager = ipp.CloudflareManager(dns_config(cloudflare, max_records_per_line='1', replace_margin='10'))
+
+    def entries(new_rtt):
+        return [(ipp.Candidate.parse('10.0.0.1#HK'), ipp.ProbeResult(True, new_rtt)),
+                (ipp.Candidate.parse('10.0.0.2#HK'), ipp.ProbeResult(True, 100.0))]
+
+    def selected(new_rtt, published):
+        return [candidate.host for candidate, _ in manager.select_records(entries(new_rtt), published)]
+
+    # 新IP只快5%，仍然可用的已发布IP保留
+    assert selected(95.0, {'10.0.0.2'}) == ['10.0.0.2']
+    # 快20%超过replace_margin，替换
+    assert selected(80.0, {'10.0.0.2'}) == ['10.0.0.1']
+    # 没有已发布记录时按排名选择
+    assert selected(95.0, set()) == ['10.0.0.1']
+
+
+class RecordingPublisher(ipp.Publisher):
+    """记录上传内容的发布器，fail中的文件上传失败"""
+    name = 'recording'
+    label = 'Recording'
+
+    def __init__(self, config, state):
+        super().__init__(config, state)
+        self.uploads = []
+        self.fail = set()
+
+    def upload(self, file_name, content):
+        self.uploads.append((file_name, content))
+        return file_name not in self.fail
+
+
+def test_publisher_skips_unchanged_files(tmp_path):
+    config = ipp.load_config(None)
+    state = ipp.PublishState(tmp_path / 'state.json')
+    files = [tmp_path / 'HK.txt', tmp_path / 'US.txt']
+    for file_path in files:
+        file_path.write_text(f"{file_path.stem}\n", encoding='utf-8')
+    publisher = RecordingPublisher(config, state)
+    publisher.fail = {'US.txt'}
+
+    assert publisher.publish(files) == 1
+    # 未变化的文件跳过，上次失败的文件重新上传
+    publisher.uploads.clear()
+    publisher.fail = set()
+    assert publisher.publish(files) == 1
+    assert publisher.uploads == [('US.txt', b'US\n')]
+
+    # 清单保存后新的运行同样跳过，只上传内容变化的文件
+    state.save()
+    files[0].write_text("HK2\n", encoding='utf-8')
+    publisher = RecordingPublisher(config, ipp.PublishState(tmp_path / 'state.json'))
+    assert publisher.publish(files) == 1
+    assert publisher.uploads == [('HK.txt', b'HK2\n')]
+    assert publisher.publish(files) == 0
+
+
+def test_candidate_parse_packs_ipv4():
+    candidate = ipp.Candidate.parse(' 1.2.3.4:8443#HK ')
+    assert (candidate.ip, candidate.port, candidate.tag) == (0x01020304, 8443, 'HK')
+    assert candidate.key == (0x01020304 << 16) | 8443
+    assert str(candidate) == '1.2.3.4:8443#HK'
+    assert candidate.endpoint(443) == ('1.2.3.4', 8443)
+
+    bare = ipp.Candidate.parse('1.2.3.4')
+    assert (bare.port, bare.tag, str(bare)) == (0, '', '1.2.3.4')
+    assert bare.endpoint(443) == ('1.2.3.4', 443)
+
+    for text in ('1.2.3.256', '1.2.3', '1.2.3.4:0', '1.2.3.4:65536', '1.2.3.4:https', 'example.com#HK'):
+        assert ipp.Candidate.parse(text) is None, text
+
+
+def test_candidate_parse_packs_ipv6():
+    candidate = ipp.Candidate.parse('[2606:4700::1]:2053#HK')
+    assert candidate.is_v6
+    assert (candidate.host, candidate.port, candidate.tag) == ('2606:4700::1', 2053, 'HK')
+    assert str(candidate) == '[2606:4700::1]:2053#HK'
+    assert candidate.endpoint(443) == ('2606:4700::1', 2053)
+
+    # 不带端口时方括号可以省略，同一地址的不同写法得到相同的去重键
+    assert ipp.Candidate.parse('2606:4700:0::1#HK').key == ipp.Candidate.parse('[2606:4700::1]#HK').key
+    # IPv6的整数带标记位，::1与0.0.0.1不会被当作同一个地址
+    assert ipp.Candidate.parse('::1').ip != ipp.Candidate.parse('0.0.0.1').ip
+    assert not ipp.Candidate.parse('0.0.0.1').is_v6
+
+    for text in ('[2606:4700::1', '[2606:4700::1]x', '2606:4700::g', '[2606:4700::1]:0'):
+        assert ipp.Candidate.parse(text) is None, text
+
+
+@pytest.fixture
+def listeners():
+    """在127.0.0.1的临时端口上监听，内核完成握手，port检测视为通过"""
+    sockets = []
+
+    def open_ports(count):
+        for _ in range(count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.bind(('127.0.0.1', 0))
+            sock.listen(64)
+            sockets.append(sock)
+        return [sock.getsockname()[1] for sock in sockets[-count:]]
+
+    yield open_ports
+    for sock in sockets:
+        sock.close()
+
+
+def test_probe_index_probes_each_endpoint_once(listeners):
+    port = listeners(1)[0]
+    config = ipp.load_config(None)
+    config.read_dict({'IP_CHECK': {'CHECK_METHOD': 'port', 'CHECK_PORT': str(port)}})
+    index = ipp.ProbeIndex(config)
+    # 两个文件引用同一端点；未写端口的条目使用CHECK_PORT，与写明该端口的条目是同一端点
+    candidates = [ipp.Candidate.parse(text) for text in
+                  (f"127.0.0.1:{port}#A", f"127.0.0.1:{port}#B", '127.0.0.1#C', '127.0.0.2:1#A')]
+    results = {}
+    index.probe([(candidate, i) for i, candidate in enumerate(candidates)], config, results.__setitem__)
+
+    assert index.probed == 2
+    assert [bool(results[i]) for i in range(len(candidates))] == [True, True, True, False]
+
+    # 之后的文件直接复用已有结果，不再检测
+    later = {}
+    index.probe([(candidates[2], 'ok'), (candidates[3], 'refused')], config, later.__setitem__)
+    assert index.probed == 2 and index.references == 6
+    assert later['ok'] and later['refused'].error == 'refused'
+
+
+CSV_HEADER = "IP地址,端口,TLS,数据中心,源IP位置,地区,城市,地区(中文),国家,城市(中文),国旗,网络延迟,下载速度"
+
+
+def test_csv_layout_and_fast_split(tmp_path):
+    path = tmp_path / 'HK.csv'
+    path.write_text('\n'.join([
+        CSV_HEADER,
+        "1.1.1.1,443,true,HKG,HK,Asia Pacific,Hong Kong,亚洲,香港,香港,🇭🇰,88 ms,28150 kB/s",
+        # 含引号的行交给csv模块解析，字段中的逗号不拆分
+        '"2.2.2.2","8443 (tls)",true,SIN,SG,Asia Pacific,"Singapore, SG",亚洲,新加坡,新加坡,🇸🇬,0.1 s,2 MB/s',
+        "3.3.3.999,443,true,HKG,HK,Asia Pacific,Hong Kong,亚洲,香港,香港,🇭🇰,10 ms,1 kB/s",
+        "4.4.4.0/30,2053,true,HKG,,Asia Pacific,Hong Kong,亚洲,香港,香港,🇭🇰,,",
+    ]) + '\n', encoding='utf-8')
+
+    layout = ipp.detect_csv_layout(CSV_HEADER, path.read_text(encoding='utf-8'))
+    assert (layout.has_header, layout.region_index, layout.latency_index, layout.speed_index) == (True, 4, 11, 12)
+
+    first, second, block = ipp.iter_ips_from_csv(path, 'HK')
+    assert (str(first), first.latency, first.speed) == ('1.1.1.1:443#HK', 88.0, 28150.0)
+    assert (str(second), second.latency, second.speed) == ('2.2.2.2:8443#SG', 100.0, 2048.0)
+    # 无效IP的行被跳过；地区列为空时使用文件名
+    assert isinstance(block, ipp.CidrRange) and str(block) == '4.4.4.0/30#HK' and block.port == 2053
+
+    # 没有表头时按分隔符检测，地区取第5列
+    plain = tmp_path / 'plain.csv'
+    plain.write_text("5.5.5.5;443;x;y;US\n6.6.6.6;2053;x;y;JP\n", encoding='utf-8')
+    assert [str(candidate) for candidate in ipp.iter_ips_from_csv(plain, 'plain')] == \
+        ['5.5.5.5:443#US', '6.6.6.6:2053#JP']
+
+
+def test_cidr_scan_samples_blocks_and_expands_passing_ones():
+    config = ipp.load_config(None)
+    cidr = ipp.CidrRange.parse('10.0.0.0/23', 443, 'HK')
+    assert (cidr.size, str(cidr)) == (512, '10.0.0.0/23#HK')
+    assert isinstance(ipp.CidrRange.parse('10.0.0.7/32'), ipp.Candidate)
+    base = cidr.first
+    # 排除第一个块的前64个地址
+    exclusions = ipp.Exclusions([(base, base + 63)])
+
+    scan = ipp.CidrScan(config, exclusions)
+    items = list(scan.flatten([cidr, ipp.Candidate.parse('9.9.9.9#HK')]))
+    # 单个地址原样产出，网段替换为每块的样本，排除的地址不抽样
+    assert str(items[-1]) == '9.9.9.9#HK'
+    sampled = {candidate.ip - base for candidate in items[:-1]}
+    assert sampled and all(64 <= offset < 512 for offset in sampled)
+    assert len(sampled) <= 2 * config.getint('SCAN', 'SAMPLES_PER_BLOCK')
+    # 样本以块起始地址为种子，每次运行相同
+    assert {c.ip - base for c in ipp.CidrScan(config, exclusions).flatten([cidr])} == sampled
+
+    # 只有第一个块的样本通过，只展开第一个块中未检测、未排除的地址
+    for candidate in items[:-1]:
+        scan.record(candidate, ipp.ProbeResult(candidate.ip - base < 256, 5.0))
+    expanded = list(scan.expansion('HK.txt'))
+    assert {candidate.ip - base for candidate in expanded} == set(range(64, 256)) - sampled
+    assert all(candidate.port == 443 and candidate.tag == 'HK' for candidate in expanded)
+
+
+def test_goal_mode_stops_after_enough_passes(listeners):
+    ports = listeners(40)
+    config = ipp.load_config(None)
+    config.read_dict({'IP_CHECK': {'CHECK_METHOD': 'port', 'CHECK_PORT': '1',
+                                   'GOAL_COUNT': '2', 'GOAL_MARGIN': '0'}})
+    # CSV延迟先验较好的条目拒绝连接：第一轮全部失败，下一轮检测到足够的可用IP后停止
+    refused = [ipp.Candidate.parse(f"127.0.0.{i}:1#HK") for i in range(2, 8)]
+    accepting = [ipp.Candidate.parse(f"127.0.0.1:{port}#HK") for port in ports]
+    for candidate in refused:
+        candidate.latency = 10.0
+    for candidate in accepting:
+        candidate.latency = 50.0
+    batch = ipp.FileBatch('HK.csv', refused + accepting, config)
+    index = ipp.ProbeIndex(config)
+    completed = []
+    ipp.probe_batches([batch], config, completed.append, index)
+
+    assert completed == [batch] and batch.rounds == 2
+    assert index.probed < len(refused) + len(accepting)
+    assert batch.counts['goal'] == len(refused) + len(accepting) - index.probed
+    ranked = batch.rank(config)
+    assert len(ranked) >= 2 and all(candidate.port in ports for candidate, _ in ranked)